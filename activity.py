@@ -0,0 +1,142 @@
+"""
+User activity for the Driver Rating Application
+Merges a user's ratings, comments, incidents and favorites into one
+timeline with a single UNION ALL query and keyset pagination, and reads
+statistics without writing on GET requests
+"""
+
+from datetime import datetime
+
+from sqlalchemy import Integer, String, and_, cast, func, literal, null, or_, select, union_all
+
+from models import db, Comment, Favorite, Incident, Rating, Report, UserStatistics, Vehicle, \
+    RATING_REPUTATION, COMMENT_REPUTATION, INCIDENT_REPUTATION, HELPFUL_VOTE_REPUTATION
+
+MAX_TIMELINE_LIMIT = 100
+
+
+def _branches(user_id):
+    """kind -> (model, SELECT with the shared timeline columns)"""
+    return {
+        'rating': (Rating, select(
+            literal('rating').label('kind'), Rating.id, Rating.vehicle_id,
+            cast(null(), String).label('license_plate'), Rating.rating.label('value'),
+            cast(null(), String).label('text'), cast(null(), String).label('detail'),
+            Rating.created_at).where(Rating.user_id == user_id)),
+        'comment': (Comment, select(
+            literal('comment').label('kind'), Comment.id, Comment.vehicle_id,
+            cast(null(), String).label('license_plate'), Comment.helpful_votes.label('value'),
+            Comment.content.label('text'), cast(null(), String).label('detail'),
+            Comment.created_at).where(Comment.user_id == user_id)),
+        'incident': (Incident, select(
+            literal('incident').label('kind'), Incident.id, cast(null(), Integer).label('vehicle_id'),
+            Incident.license_plate, Incident.severity.label('value'),
+            Incident.description.label('text'), Incident.incident_type.label('detail'),
+            Incident.created_at).where(Incident.user_id == user_id)),
+        'favorite': (Favorite, select(
+            literal('favorite').label('kind'), Favorite.id, Favorite.vehicle_id,
+            cast(null(), String).label('license_plate'), cast(null(), Integer).label('value'),
+            Favorite.notes.label('text'), cast(null(), String).label('detail'),
+            Favorite.created_at).where(Favorite.user_id == user_id)),
+    }
+
+
+def encode_cursor(item):
+    """Keyset cursor pointing just past a timeline item"""
+    return f"{item['created_at'].isoformat()},{item['kind']},{item['id']}"
+
+
+def decode_cursor(cursor):
+    """
+    Parse a timeline cursor
+    Returns:
+        tuple: (created_at, kind, id)
+    Raises:
+        ValueError: If the cursor is malformed
+    """
+    created_at, kind, item_id = cursor.split(',')
+    return datetime.fromisoformat(created_at), kind, int(item_id)
+
+
+def activity_timeline(user_id, before=None, limit=20):
+    """
+    A page of a user's activity, newest first
+    Args:
+        user_id: User ID
+        before: Optional cursor from a previous page
+        limit: Items per page
+    Returns:
+        tuple: (list of item dicts, cursor for the next page or None)
+    """
+    limit = max(1, min(limit, MAX_TIMELINE_LIMIT))
+    parts = []
+    for kind, (model, query) in _branches(user_id).items():
+        if before:
+            created_at, after_kind, after_id = before
+            # Order is (created_at, kind, id) descending; kind is constant per
+            # branch, so each branch gets a plain range on its own index
+            if kind < after_kind:
+                query = query.where(model.created_at <= created_at)
+            elif kind == after_kind:
+                query = query.where(or_(model.created_at < created_at, and_(
+                    model.created_at == created_at, model.id < after_id)))
+            else:
+                query = query.where(model.created_at < created_at)
+        # Each branch only needs its own newest ``limit`` rows
+        branch = query.order_by(model.created_at.desc(), model.id.desc()).limit(
+            limit + 1).subquery()
+        parts.append(select(branch))
+
+    timeline = union_all(*parts).subquery()
+    rows = db.session.execute(
+        select(timeline).order_by(timeline.c.created_at.desc(), timeline.c.kind.desc(),
+                                  timeline.c.id.desc()).limit(limit + 1)).mappings().all()
+
+    items = [dict(row) for row in rows[:limit]]
+
+    # Plates of all referenced vehicles in one query
+    vehicle_ids = {item['vehicle_id'] for item in items if item['vehicle_id']}
+    if vehicle_ids:
+        plates = dict(db.session.execute(
+            select(Vehicle.id, Vehicle.license_plate).where(Vehicle.id.in_(vehicle_ids))).all())
+        for item in items:
+            if item['vehicle_id']:
+                item['license_plate'] = plates.get(item['vehicle_id'])
+
+    next_cursor = encode_cursor(items[-1]) if len(rows) > limit else None
+    return items, next_cursor
+
+
+def statistics_snapshot(user_id):
+    """
+    A user's statistics without writing to the database
+    Args:
+        user_id: User ID
+    Returns:
+        UserStatistics: The stored row, or a transient one counted on the fly
+        for users whose row has not been created by the background job yet
+    """
+    stats = db.session.execute(
+        select(UserStatistics).where(UserStatistics.user_id == user_id)).scalar()
+    if stats is not None:
+        return stats
+
+    def count(model):
+        return select(func.count(model.id)).where(model.user_id == user_id).scalar_subquery()
+
+    ratings, comments, reports, incidents, helpful = db.session.execute(select(
+        count(Rating), count(Comment), count(Report), count(Incident),
+        select(func.coalesce(func.sum(Comment.helpful_votes), 0)).where(
+            Comment.user_id == user_id).scalar_subquery())).one()
+
+    stats = UserStatistics()
+    stats.user_id = user_id
+    stats.total_ratings = ratings
+    stats.total_comments = comments
+    stats.total_reports = reports
+    stats.total_incidents = incidents
+    stats.helpful_votes = helpful
+    stats.reputation_score = (ratings * RATING_REPUTATION + comments * COMMENT_REPUTATION +
+                              incidents * INCIDENT_REPUTATION +
+                              helpful * HELPFUL_VOTE_REPUTATION)
+    return stats
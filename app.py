@@ -1,14 +1,15 @@
 import os
 import logging
-import re
 from datetime import datetime
 from functools import wraps
 
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, session
+from flask import Flask, Response, abort, g, render_template, request, jsonify, redirect, send_file, url_for, flash, session
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy import func, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import DeclarativeBase, joinedload
 from werkzeug.middleware.proxy_fix import ProxyFix
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import generate_password_hash
 
 # Load environment variables from .env file if it exists
 try:
@@ -19,6 +20,27 @@ except ImportError:
     pass
 
 from models import db, User, Vehicle, Rating, Comment, Report, Incident, UserStatistics, CommentVote, Favorite
+from database import configure_database, db_route
+from jobs import job_queue
+from events import event_broker, parse_bbox, parse_stream_filters
+from votes import cast_comment_vote, VOTE_TYPES
+from moderation import file_report, moderation_queue, clear_reports, delete_comments, set_vehicles_blocked
+from cli import init_cli
+from migrations import migrate
+from credentials import credential_service, CredentialServiceBusy
+from auth import authenticate_user
+from tokens import token_auth, bearer_token
+from plates import plate_directory
+from plate_format import canonical_plate, classify_plate
+from incidents import ingest_incident
+from heatmap import heatmap_tiles
+from traffic import parse_viewport, traffic_flow
+from traffic_history import traffic_history
+from assets import asset_manifest
+from serialization import Schema, json_response
+from activity import activity_timeline, decode_cursor, statistics_snapshot
+from favorites import (favorite_status, favorites_page, favorite_changes,
+                       mark_favorites_seen, MAX_STATUS_PLATES)
 
 # Create the app
 app = Flask(__name__)
@@ -28,40 +50,52 @@ app.config['SECRET_KEY'] = os.environ.get(
     "SESSION_SECRET",
     "4+d1eDMn4D5d1Op1bg5a3PfDb45XEXLcDr1Te3P7+Dc4glg9XXNvmazD3D6GXanmB2fMthgRw09T0mH3COkUhw=="
 )
-app.config['DEBUG'] = os.environ.get("FLASK_DEBUG", "True").lower() == "true"
+app.config['DEBUG'] = os.environ.get("FLASK_DEBUG", "False").lower() == "true"
 app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
 
-# Configure the database - Use PostgreSQL only
-database_url = os.environ.get("DATABASE_URL")
-if not database_url:
-    raise ValueError(
-        "DATABASE_URL environment variable is required. Please set up PostgreSQL database in Replit."
-    )
-
-app.config["SQLALCHEMY_DATABASE_URI"] = database_url
-app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
-    "pool_recycle": 300,
-    "pool_pre_ping": True,
-}
+# Configure the database - Use PostgreSQL only (optional read replica)
+configure_database(app, db)
 
 # Initialize the app with the extension
 db.init_app(app)
-
-# External API configuration
-tomtom_api_key = os.getenv("TOMTOM_API_KEY")
+job_queue.init_app(app)
+event_broker.init_app(app)
+credential_service.init_app(app)
+token_auth.init_app(app)
+plate_directory.init_app(app)
+heatmap_tiles.init_app(app)
+traffic_flow.init_app(app)
+traffic_history.init_app(app)
+asset_manifest.init_app(app)
 
 
 # Helper functions for authentication
+def get_token_claims():
+    """Verified claims of the request's bearer token, or None"""
+    if 'token_claims' not in g:
+        token = bearer_token(request)
+        g.token_claims = token_auth.verify(token) if token else None
+    return g.token_claims
+
+
+def current_user_id():
+    """ID of the logged in user, from the API token or the session"""
+    claims = get_token_claims()
+    if claims:
+        return claims.user_id
+    return session.get('user_id')
+
+
 def is_logged_in():
     """Check if user is currently logged in"""
-    return 'user_id' in session
+    return current_user_id() is not None
 
 
 def get_current_user():
     """Get the currently logged in user object"""
     if is_logged_in():
         try:
-            user_id = session.get('user_id')
+            user_id = current_user_id()
             if user_id:
                 return User.query.get(user_id)
         except Exception as e:
@@ -72,6 +106,10 @@ def get_current_user():
 
 def is_admin():
     """Check if current user has admin privileges"""
+    claims = get_token_claims()
+    if claims:
+        # Admin flag is signed into the token, no user lookup needed
+        return claims.is_admin
     user = get_current_user()
     return user and user.is_admin
 
@@ -81,6 +119,11 @@ def login_required(f):
 
     @wraps(f)
     def decorated_function(*args, **kwargs):
+        if bearer_token(request):
+            if not get_token_claims():
+                return jsonify({'error': 'Nieprawidłowy lub wygasły token'}), 401
+            return f(*args, **kwargs)
+
         if not is_logged_in():
             flash('Musisz być zalogowany, aby uzyskać dostęp do tej strony.',
                   'warning')
@@ -95,6 +138,14 @@ def admin_required(f):
 
     @wraps(f)
     def decorated_function(*args, **kwargs):
+        if bearer_token(request):
+            claims = get_token_claims()
+            if not claims:
+                return jsonify({'error': 'Nieprawidłowy lub wygasły token'}), 401
+            if not claims.is_admin:
+                return jsonify({'error': 'Brak uprawnień administratora'}), 403
+            return f(*args, **kwargs)
+
         if not is_logged_in():
             flash('Musisz być zalogowany, aby uzyskać dostęp do tej strony.',
                   'warning')
@@ -109,14 +160,6 @@ def admin_required(f):
     return decorated_function
 
 
-def validate_license_plate(plate):
-    """Validate Polish license plate format"""
-    if not plate:
-        return False
-    # Polish license plate validation - only letters and numbers
-    return bool(re.match(r'^[A-Z0-9]+$', plate.upper().replace(' ', '')))
-
-
 def create_admin_user():
     """Create default admin user if it doesn't exist"""
     admin_user = User.query.filter_by(username='admin').first()
@@ -124,7 +167,9 @@ def create_admin_user():
         admin_user = User()
         admin_user.username = 'admin'
         admin_user.email = 'admin@example.com'
-        admin_user.password_hash = generate_password_hash('admin123')
+        # Hashed inline: this runs once at startup, before any worker forks
+        admin_user.password_hash = generate_password_hash(
+            'admin123', method=app.config['PASSWORD_HASH_METHOD'])
         admin_user.is_admin = True
         db.session.add(admin_user)
         db.session.commit()
@@ -143,12 +188,56 @@ def init_auth(app):
         }
 
 
+@job_queue.handler('refresh_user_statistics')
+def refresh_user_statistics(user_id, recount_helpful_votes=False):
+    """Background job recomputing a user's statistics after new activity"""
+    user = db.session.get(User, user_id)
+    if user is None:
+        # Account deleted before the job ran
+        return
+
+    user_stats = UserStatistics.query.filter_by(user_id=user_id).first()
+    if not user_stats:
+        user_stats = UserStatistics()
+        user_stats.user_id = user_id
+        db.session.add(user_stats)
+
+    if recount_helpful_votes:
+        user_stats.helpful_votes = CommentVote.query.join(Comment).filter(
+            Comment.user_id == user_id,
+            CommentVote.vote_type == 'helpful').count()
+
+    user_stats.update_statistics()
+
+
+@job_queue.handler('invalidate_heatmap_tiles')
+def invalidate_heatmap_tiles(latitude, longitude):
+    """Background job dropping the cached heatmap tiles around a new incident"""
+    heatmap_tiles.invalidate_point(latitude, longitude)
+
+
+@job_queue.handler('build_traffic_profiles')
+def build_traffic_profiles():
+    """Background job rebuilding hour-of-week traffic profiles"""
+    # Several workers may have queued a rebuild in the same interval
+    if traffic_history.profiles_due():
+        traffic_history.build_profiles()
+
+
+@job_queue.handler('flush_traffic_samples')
+def flush_traffic_samples():
+    """Background job writing the traffic samples buffered by this process"""
+    traffic_history.flush()
+
+
 # Initialize authentication system and create admin user
 init_auth(app)
+init_cli(app)
 
 # Create database tables
 with app.app_context():
     db.create_all()
+    migrate()
     create_admin_user()
 
 
@@ -156,18 +245,17 @@ with app.app_context():
 @app.route('/')
 def index():
     """Home page with recently rated vehicles"""
-    recent_ratings = db.session.query(Rating).order_by(
-        Rating.created_at.desc()).limit(10).all()
-    recent_vehicles = []
-    seen_plates = set()
-
-    for rating in recent_ratings:
-        vehicle = Vehicle.query.get(rating.vehicle_id)
-        if vehicle and vehicle.license_plate not in seen_plates:
-            recent_vehicles.append(vehicle)
-            seen_plates.add(vehicle.license_plate)
-            if len(recent_vehicles) >= 5:
-                break
+    recent_ids = []
+    for vehicle_id in db.session.scalars(select(Rating.vehicle_id).order_by(
+            Rating.created_at.desc()).limit(10)):
+        if vehicle_id not in recent_ids:
+            recent_ids.append(vehicle_id)
+    recent_ids = recent_ids[:5]
+
+    vehicles = db.session.scalars(select(Vehicle).where(
+        Vehicle.id.in_(recent_ids)).options(*Vehicle.with_rating_stats())).all()
+    by_id = {vehicle.id: vehicle for vehicle in vehicles}
+    recent_vehicles = [by_id[vehicle_id] for vehicle_id in recent_ids if vehicle_id in by_id]
 
     return render_template('index.html', recent_vehicles=recent_vehicles)
 
@@ -183,9 +271,14 @@ def login():
             flash('Wprowadź login i hasło!', 'danger')
             return render_template('login.html')
 
-        user = User.query.filter_by(username=username).first()
+        try:
+            user = authenticate_user(username, password)
+        except CredentialServiceBusy:
+            flash('Serwer jest przeciążony, spróbuj ponownie za chwilę.',
+                  'warning')
+            return render_template('login.html'), 503
 
-        if user and check_password_hash(user.password_hash, password):
+        if user:
             session['user_id'] = user.id
             flash('Zalogowano pomyślnie!', 'success')
             return redirect(url_for('index'))
@@ -215,10 +308,17 @@ def register():
             flash('Email jest już zarejestrowany!', 'danger')
             return render_template('register.html')
 
+        try:
+            password_hash = credential_service.hash_password(password)
+        except CredentialServiceBusy:
+            flash('Serwer jest przeciążony, spróbuj ponownie za chwilę.',
+                  'warning')
+            return render_template('register.html'), 503
+
         user = User()
         user.username = username
         user.email = email
-        user.password_hash = generate_password_hash(password)
+        user.password_hash = password_hash
 
         db.session.add(user)
         db.session.commit()
@@ -242,20 +342,22 @@ def logout():
 def vehicle_detail(license_plate):
     """Vehicle detail page"""
     # Validate license plate format
-    if not validate_license_plate(license_plate):
+    plate = canonical_plate(license_plate)
+    if not plate:
         flash('Nieprawidłowy format numeru rejestracyjnego!', 'warning')
         return redirect(url_for('index'))
+    if plate != license_plate:
+        return redirect(url_for('vehicle_detail', license_plate=plate), code=301)
 
-    vehicle = Vehicle.query.filter_by(
-        license_plate=license_plate.upper()).first()
+    vehicle = Vehicle.query.filter_by(license_plate=plate).first()
 
     # Create vehicle if it doesn't exist
     if not vehicle:
         vehicle = Vehicle()
-        vehicle.license_plate = license_plate.upper()
+        vehicle.license_plate = plate
         db.session.add(vehicle)
         db.session.commit()
-        flash(f'Pojazd {license_plate.upper()} został dodany do bazy danych!',
+        flash(f'Pojazd {plate} został dodany do bazy danych!',
               'success')
 
     if vehicle.is_blocked and not is_admin():
@@ -263,39 +365,46 @@ def vehicle_detail(license_plate):
         return redirect(url_for('index'))
 
     ratings = Rating.query.filter_by(vehicle_id=vehicle.id).all()
-    comments = Comment.query.filter_by(vehicle_id=vehicle.id).order_by(
-        Comment.created_at.desc()).all()
+    comments = Comment.query.filter_by(vehicle_id=vehicle.id).options(
+        joinedload(Comment.user)).order_by(Comment.created_at.desc()).all()
 
     avg_rating = sum(r.rating
                      for r in ratings) / len(ratings) if ratings else 0
 
-    # Check if current user has already rated this vehicle
+    # Check if current user has already rated or favorited this vehicle
     user_rating = None
+    is_favorite = False
     if is_logged_in():
         user_rating = Rating.query.filter_by(
-            vehicle_id=vehicle.id, user_id=session['user_id']).first()
+            vehicle_id=vehicle.id, user_id=current_user_id()).first()
+        is_favorite = favorite_status(current_user_id(), [plate])[plate]
 
     return render_template('vehicle_detail.html',
                            vehicle=vehicle,
                            ratings=ratings,
                            comments=comments,
                            avg_rating=avg_rating,
-                           user_rating=user_rating)
+                           user_rating=user_rating,
+                           is_favorite=is_favorite,
+                           plate_info=classify_plate(plate))
 
 
 @app.route('/search')
 def search():
     """Search for vehicles by license plate"""
-    query = request.args.get('q', '').strip().upper()
+    query = request.args.get('q', '').strip()
     vehicles = []
 
     if query:
-        if validate_license_plate(query):
-            vehicles = Vehicle.query.filter(
-                Vehicle.license_plate.like(f'%{query}%')).all()
-
+        plate = canonical_plate(query)
+        if plate:
+            query = plate
+            matches = select(Vehicle).where(
+                Vehicle.license_plate.like(f'%{plate}%')).options(
+                *Vehicle.with_rating_stats())
             if not is_admin():
-                vehicles = [v for v in vehicles if not v.is_blocked]
+                matches = matches.where(Vehicle.is_blocked.is_(False))
+            vehicles = db.session.scalars(matches).all()
         else:
             flash('Nieprawidłowy format numeru rejestracyjnego!', 'warning')
 
@@ -303,26 +412,22 @@ def search():
 
 
 @app.route('/ranking')
+@db_route(db, replica=True, statement_timeout_ms=5000)
 def ranking():
     """Ranking page for vehicles"""
     sort_order = request.args.get('sort', 'best')  # best or worst
 
-    # Get all vehicles with their average ratings
-    vehicles_with_ratings = []
-    vehicles = Vehicle.query.all()
-
-    for vehicle in vehicles:
-        if vehicle.is_blocked and not is_admin():
-            continue
+    # Rated vehicles with their average ratings, aggregated in one query
+    query = select(Vehicle).join(Rating, Rating.vehicle_id == Vehicle.id).group_by(
+        Vehicle.id).options(*Vehicle.with_rating_stats(grouped=True))
+    if not is_admin():
+        query = query.where(Vehicle.is_blocked.is_(False))
 
-        ratings = Rating.query.filter_by(vehicle_id=vehicle.id).all()
-        if ratings:
-            avg_rating = sum(r.rating for r in ratings) / len(ratings)
-            vehicles_with_ratings.append({
-                'vehicle': vehicle,
-                'avg_rating': avg_rating,
-                'rating_count': len(ratings)
-            })
+    vehicles_with_ratings = [{
+        'vehicle': vehicle,
+        'avg_rating': vehicle.average_rating,
+        'rating_count': vehicle.rating_count
+    } for vehicle in db.session.scalars(query)]
 
     # Sort by average rating
     reverse_order = sort_order == 'best'
@@ -335,6 +440,7 @@ def ranking():
 
 
 @app.route('/ranking_users')
+@db_route(db, replica=True, statement_timeout_ms=5000)
 def ranking_users():
     """User ranking page"""
     sort_by = request.args.get('sort', 'reputation')
@@ -364,9 +470,16 @@ def ranking_users():
 @admin_required
 def admin():
     """Admin panel"""
-    reported_comments = Comment.query.filter(Comment.reports > 0).order_by(
-        Comment.reports.desc()).all()
-    blocked_vehicles = Vehicle.query.filter_by(is_blocked=True).all()
+    page = request.args.get('page', 1, type=int)
+    blocked_page = request.args.get('blocked_page', 1, type=int)
+
+    reported_comments = moderation_queue(page=page, per_page=20)
+    blocked_vehicles = db.paginate(
+        db.select(Vehicle).filter_by(is_blocked=True).order_by(
+            Vehicle.license_plate),
+        page=blocked_page,
+        per_page=50,
+        error_out=False)
 
     return render_template('admin.html',
                            reported_comments=reported_comments,
@@ -389,27 +502,16 @@ def profile():
         flash('Błąd sesji użytkownika. Zaloguj się ponownie.', 'danger')
         return redirect(url_for('login'))
 
-    # Get user's activity
-    user_ratings = Rating.query.filter_by(user_id=user.id).order_by(
-        Rating.created_at.desc()).limit(10).all()
-    user_comments = Comment.query.filter_by(user_id=user.id).order_by(
-        Comment.created_at.desc()).limit(10).all()
-    user_favorites = Favorite.query.filter_by(user_id=user.id).order_by(
-        Favorite.created_at.desc()).all()
-
-    # Get user statistics
-    user_stats = UserStatistics.query.filter_by(user_id=user.id).first()
-    if not user_stats:
-        user_stats = UserStatistics()
-        user_stats.user_id = user.id
-        db.session.add(user_stats)
-        db.session.commit()
-        user_stats.update_statistics()
+    # Get user's activity; read-only, statistics are maintained by the job queue
+    activity, activity_cursor = activity_timeline(user.id, limit=10)
+    user_favorites = favorites_page(
+        user.id, page=request.args.get('favorites_page', 1, type=int))
+    user_stats = statistics_snapshot(user.id)
 
     return render_template('profile.html',
                            user=user,
-                           user_ratings=user_ratings,
-                           user_comments=user_comments,
+                           activity=activity,
+                           activity_cursor=activity_cursor,
                            user_favorites=user_favorites,
                            user_stats=user_stats)
 
@@ -423,14 +525,7 @@ def statistics():
         flash('Błąd sesji użytkownika. Zaloguj się ponownie.', 'danger')
         return redirect(url_for('login'))
 
-    user_stats = UserStatistics.query.filter_by(user_id=user.id).first()
-
-    if not user_stats:
-        user_stats = UserStatistics()
-        user_stats.user_id = user.id
-        db.session.add(user_stats)
-        db.session.commit()
-        user_stats.update_statistics()
+    user_stats = statistics_snapshot(user.id)
 
     # Get top users for comparison
     top_users = db.session.query(UserStatistics, User).join(User).order_by(
@@ -442,54 +537,51 @@ def statistics():
 
 
 @app.route('/map')
+@db_route(db, replica=True, statement_timeout_ms=5000)
 def map_view():
     """Map view with incidents"""
-    incidents = Incident.query.order_by(
-        Incident.created_at.desc()).limit(50).all()
-    return render_template('map.html', incidents=incidents)
+    # Rows with the sidebar's columns only, no ORM objects
+    incidents = db.session.execute(
+        select(Incident.license_plate, Incident.latitude, Incident.longitude,
+               Incident.incident_type, Incident.description, Incident.severity,
+               Incident.corroborations, Incident.is_verified, Incident.created_at)
+        .order_by(Incident.created_at.desc()).limit(50)).all()
+    return render_template('map.html', incidents=incidents,
+                           heatmap_available=heatmap_tiles.available)
 
 
 @app.route('/traffic')
+@db_route(db, replica=True, statement_timeout_ms=5000)
 def traffic():
     """Community dashboard page"""
     from datetime import datetime, timedelta
     
     # Get recent ratings (last 20)
-    recent_ratings = Rating.query.order_by(Rating.created_at.desc()).limit(20).all()
+    recent_ratings = Rating.query.options(joinedload(Rating.vehicle)).order_by(
+        Rating.created_at.desc()).limit(20).all()
     
     # Get recent comments (last 10)
-    recent_comments = Comment.query.order_by(Comment.created_at.desc()).limit(10).all()
+    recent_comments = Comment.query.options(
+        joinedload(Comment.vehicle), joinedload(Comment.user)).order_by(
+        Comment.created_at.desc()).limit(10).all()
     
-    # Get today's top vehicles
+    # Get today's top vehicles: well rated today, best first, then by count
     today = datetime.utcnow().date()
-    today_ratings = Rating.query.filter(Rating.created_at >= today).all()
-    
-    # Group by vehicle and calculate averages
-    vehicle_ratings = {}
-    for rating in today_ratings:
-        if rating.vehicle_id not in vehicle_ratings:
-            vehicle_ratings[rating.vehicle_id] = {
-                'vehicle': rating.vehicle,
-                'ratings': [],
-                'license_plate': rating.vehicle.license_plate
-            }
-        vehicle_ratings[rating.vehicle_id]['ratings'].append(rating.rating)
-    
-    # Calculate averages and sort
-    top_vehicles_today = []
-    for vehicle_id, data in vehicle_ratings.items():
-        avg_rating = sum(data['ratings']) / len(data['ratings'])
-        if avg_rating >= 4.0:  # Only show vehicles with good ratings
-            top_vehicles_today.append({
-                'vehicle': data['vehicle'],
-                'license_plate': data['license_plate'],
-                'avg_rating': avg_rating,
-                'rating_count': len(data['ratings'])
-            })
-    
-    # Sort by rating, then by count
-    top_vehicles_today.sort(key=lambda x: (x['avg_rating'], x['rating_count']), reverse=True)
-    top_vehicles_today = top_vehicles_today[:6]  # Top 6
+    average = func.avg(Rating.rating)
+    top_today = db.session.execute(
+        select(Vehicle, average, func.count(Rating.id))
+        .join(Rating, Rating.vehicle_id == Vehicle.id)
+        .where(Rating.created_at >= today)
+        .group_by(Vehicle.id)
+        .having(average >= 4.0)  # Only show vehicles with good ratings
+        .order_by(average.desc(), func.count(Rating.id).desc())
+        .limit(6)).all()
+    top_vehicles_today = [{
+        'vehicle': vehicle,
+        'license_plate': vehicle.license_plate,
+        'avg_rating': float(avg_rating),
+        'rating_count': rating_count
+    } for vehicle, avg_rating, rating_count in top_today]
     
     # Get community statistics
     total_vehicles = Vehicle.query.count()
@@ -513,20 +605,67 @@ def manifest():
     return app.send_static_file('manifest.json')
 
 
+@app.route('/sw.js')
+def service_worker():
+    """Service worker, served from the root so its scope is the whole site"""
+    return asset_manifest.send_service_worker()
+
+
 # API Routes
-@app.route('/api/rate', methods=['POST'])
+@app.route('/api/token', methods=['POST'])
+def api_token():
+    """API endpoint issuing a bearer token for username (or email) and password"""
+    data = request.get_json() or {}
+    username = data.get('username', '')
+    password = data.get('password', '')
+
+    if not username or not password:
+        return jsonify({'error': 'Wprowadź login i hasło!'}), 400
+
+    try:
+        user = authenticate_user(username, password)
+    except CredentialServiceBusy:
+        return jsonify({'error': 'Serwer jest przeciążony, spróbuj ponownie za chwilę'}), 503
+
+    if not user:
+        return jsonify({'error': 'Nieprawidłowy login lub hasło!'}), 401
+
+    token, expires = token_auth.issue(user)
+    return jsonify({'success': True, 'token': token, 'expires_at': expires})
+
+
+@app.route('/api/token/revoke', methods=['POST'])
 @login_required
-def api_rate():
-    """API endpoint for rating a vehicle"""
-    data = request.get_json()
-    license_plate = data.get('license_plate', '').strip().upper()
+def api_revoke_token():
+    """API endpoint revoking the bearer token used for this request"""
+    claims = get_token_claims()
+    if not claims:
+        return jsonify({'error': 'Brak tokenu'}), 400
+
+    token_auth.revoke(claims)
+    db.session.commit()
+
+    return jsonify({'success': True, 'message': 'Token został unieważniony'})
+
+
+def _rate_vehicle(user_id, data):
+    """
+    Validate and store a rating (caller commits)
+    Args:
+        user_id: Rating user's ID
+        data: Request JSON with license_plate and rating
+    Returns:
+        tuple: (response payload, HTTP status)
+    """
+    license_plate = canonical_plate(data.get('license_plate'))
     rating_value = data.get('rating')
 
-    if not validate_license_plate(license_plate):
-        return jsonify({'error': 'Nieprawidłowy numer rejestracyjny'}), 400
+    if not license_plate:
+        return {'error': 'Nieprawidłowy numer rejestracyjny'}, 400
 
-    if not rating_value or rating_value < 1 or rating_value > 5:
-        return jsonify({'error': 'Ocena musi być w przedziale 1-5'}), 400
+    if (not isinstance(rating_value, int) or isinstance(rating_value, bool)
+            or rating_value < 1 or rating_value > 5):
+        return {'error': 'Ocena musi być w przedziale 1-5'}, 400
 
     # Get or create vehicle
     vehicle = Vehicle.query.filter_by(license_plate=license_plate).first()
@@ -537,35 +676,43 @@ def api_rate():
         db.session.flush()
 
     if vehicle.is_blocked:
-        return jsonify({'error': 'Ten pojazd został zablokowany'}), 403
+        return {'error': 'Ten pojazd został zablokowany'}, 403
 
     # Check if user already rated this vehicle
     existing_rating = Rating.query.filter_by(
-        vehicle_id=vehicle.id, user_id=session['user_id']).first()
+        vehicle_id=vehicle.id, user_id=user_id).first()
 
     if existing_rating:
-        existing_rating.rating = rating_value
-        existing_rating.created_at = datetime.utcnow()
+        rating = existing_rating
+        rating.rating = rating_value
+        rating.created_at = datetime.utcnow()
     else:
         rating = Rating()
         rating.vehicle_id = vehicle.id
-        rating.user_id = session['user_id']
+        rating.user_id = user_id
         rating.rating = rating_value
         db.session.add(rating)
+    db.session.flush()
 
-    db.session.commit()
+    event_broker.publish('rating',
+                         rating_id=rating.id,
+                         license_plate=vehicle.license_plate,
+                         rating=rating.rating,
+                         created_at=rating.created_at.isoformat())
+
+    # Statistics are recomputed in the background after the commit
+    job_queue.enqueue('refresh_user_statistics', user_id=user_id)
+    return {'success': True, 'message': 'Ocena została zapisana'}, 200
 
-    # Update user statistics
-    user_stats = UserStatistics.query.filter_by(
-        user_id=session['user_id']).first()
-    if not user_stats:
-        user_stats = UserStatistics()
-        user_stats.user_id = session['user_id']
-        db.session.add(user_stats)
-        db.session.commit()
-    user_stats.update_statistics()
 
-    return jsonify({'success': True, 'message': 'Ocena została zapisana'})
+@app.route('/api/rate', methods=['POST'])
+@login_required
+def api_rate():
+    """API endpoint for rating a vehicle"""
+    payload, status = _rate_vehicle(current_user_id(), request.get_json())
+    if status == 200:
+        db.session.commit()
+    return jsonify(payload), status
 
 
 @app.route('/api/comment', methods=['POST'])
@@ -573,10 +720,10 @@ def api_rate():
 def api_comment():
     """API endpoint for adding a comment"""
     data = request.get_json()
-    license_plate = data.get('license_plate', '').strip().upper()
+    license_plate = canonical_plate(data.get('license_plate'))
     comment_text = data.get('comment', '').strip()
 
-    if not validate_license_plate(license_plate):
+    if not license_plate:
         return jsonify({'error': 'Nieprawidłowy numer rejestracyjny'}), 400
 
     if not comment_text:
@@ -595,22 +742,20 @@ def api_comment():
 
     comment = Comment()
     comment.vehicle_id = vehicle.id
-    comment.user_id = session['user_id']
+    comment.user_id = current_user_id()
     comment.content = comment_text
 
     db.session.add(comment)
+    db.session.flush()
+
+    event_broker.publish('comment',
+                         comment_id=comment.id,
+                         license_plate=vehicle.license_plate,
+                         content=comment.content,
+                         created_at=comment.created_at.isoformat())
+    job_queue.enqueue('refresh_user_statistics', user_id=current_user_id())
     db.session.commit()
 
-    # Update user statistics
-    user_stats = UserStatistics.query.filter_by(
-        user_id=session['user_id']).first()
-    if not user_stats:
-        user_stats = UserStatistics()
-        user_stats.user_id = session['user_id']
-        db.session.add(user_stats)
-        db.session.commit()
-    user_stats.update_statistics()
-
     return jsonify({'success': True, 'message': 'Komentarz został dodany'})
 
 
@@ -621,24 +766,15 @@ def api_report_comment():
     data = request.get_json()
     comment_id = data.get('comment_id')
 
-    comment = Comment.query.get(comment_id)
-    if not comment:
-        return jsonify({'error': 'Komentarz nie został znaleziony'}), 404
-
-    # Check if user already reported this comment
-    existing_report = Report.query.filter_by(
-        comment_id=comment_id, user_id=session['user_id']).first()
-
-    if existing_report:
-        return jsonify({'error': 'Już zgłosiłeś ten komentarz'}), 400
-
-    report = Report()
-    report.comment_id = comment_id
-    report.user_id = session['user_id']
+    try:
+        found = file_report(comment_id, current_user_id())
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
 
-    comment.reports += 1
+    if not found:
+        return jsonify({'error': 'Komentarz nie został znaleziony'}), 404
 
-    db.session.add(report)
     db.session.commit()
 
     return jsonify({'success': True, 'message': 'Komentarz został zgłoszony'})
@@ -652,109 +788,208 @@ def api_vote_comment():
     comment_id = data.get('comment_id')
     vote_type = data.get('vote_type')  # 'helpful' or 'unhelpful'
 
-    if vote_type not in ['helpful', 'unhelpful']:
+    if vote_type not in VOTE_TYPES:
         return jsonify({'error': 'Nieprawidłowy typ głosu'}), 400
 
-    comment = Comment.query.get(comment_id)
-    if not comment:
-        return jsonify({'error': 'Komentarz nie został znaleziony'}), 404
-
-    # Check if user already voted
-    existing_vote = CommentVote.query.filter_by(
-        comment_id=comment_id, user_id=session['user_id']).first()
-
-    if existing_vote:
-        # Update existing vote
-        if existing_vote.vote_type != vote_type:
-            # Remove old vote count
-            if existing_vote.vote_type == 'helpful':
-                comment.helpful_votes -= 1
-            else:
-                comment.unhelpful_votes -= 1
-
-            # Add new vote count
-            if vote_type == 'helpful':
-                comment.helpful_votes += 1
-            else:
-                comment.unhelpful_votes += 1
-
-            existing_vote.vote_type = vote_type
-            existing_vote.created_at = datetime.utcnow()
-        else:
-            return jsonify({'error': 'Już oddałeś ten głos'}), 400
-    else:
-        # Create new vote
-        vote = CommentVote()
-        vote.comment_id = comment_id
-        vote.user_id = session['user_id']
-        vote.vote_type = vote_type
-
-        if vote_type == 'helpful':
-            comment.helpful_votes += 1
-        else:
-            comment.unhelpful_votes += 1
+    try:
+        result = cast_comment_vote(comment_id, current_user_id(), vote_type)
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
 
-        db.session.add(vote)
+    if result is None:
+        return jsonify({'error': 'Komentarz nie został znaleziony'}), 404
 
+    if result['author_stats_missing']:
+        # First vote for this author, build their statistics from scratch
+        job_queue.enqueue('refresh_user_statistics',
+                          user_id=result['author_id'],
+                          recount_helpful_votes=True)
     db.session.commit()
 
-    # Update comment author's statistics
-    comment_author_stats = UserStatistics.query.filter_by(
-        user_id=comment.user_id).first()
-    if comment_author_stats and vote_type == 'helpful':
-        comment_author_stats.helpful_votes = CommentVote.query.join(
-            Comment).filter(Comment.user_id == comment.user_id,
-                            CommentVote.vote_type == 'helpful').count()
-        comment_author_stats.update_statistics()
-
-    return jsonify({'success': True, 'message': 'Głos został zapisany'})
+    return jsonify({
+        'success': True,
+        'message': 'Głos został zapisany',
+        'helpful_votes': result['helpful_votes'],
+        'unhelpful_votes': result['unhelpful_votes']
+    })
 
 
-@app.route('/api/add_incident', methods=['POST'])
-@login_required
-def api_add_incident():
-    """API endpoint for adding an incident"""
-    data = request.get_json()
-    license_plate = data.get('license_plate', '').strip().upper()
+def _report_incident(user_id, data):
+    """
+    Validate and store an incident report (caller commits)
+    Args:
+        user_id: Reporting user's ID
+        data: Request JSON of the incident form
+    Returns:
+        tuple: (response payload, HTTP status)
+    """
+    license_plate = canonical_plate(data.get('license_plate'))
     latitude = data.get('latitude')
     longitude = data.get('longitude')
     incident_type = data.get('incident_type')
     description = data.get('description', '').strip()
     severity = data.get('severity', 1)
 
-    if not license_plate or not validate_license_plate(license_plate):
-        return jsonify({'error': 'Nieprawidłowy numer rejestracyjny'}), 400
+    if not license_plate:
+        return {'error': 'Nieprawidłowy numer rejestracyjny'}, 400
 
     if not latitude or not longitude:
-        return jsonify({'error': 'Lokalizacja jest wymagana'}), 400
+        return {'error': 'Lokalizacja jest wymagana'}, 400
+
+    try:
+        latitude, longitude, severity = float(latitude), float(longitude), int(severity)
+    except (TypeError, ValueError):
+        return {'error': 'Nieprawidłowa lokalizacja lub waga zdarzenia'}, 400
 
     if not incident_type or incident_type not in [
             'aggressive_driving', 'poor_parking', 'traffic_violation', 'other'
     ]:
-        return jsonify({'error': 'Nieprawidłowy typ zdarzenia'}), 400
+        return {'error': 'Nieprawidłowy typ zdarzenia'}, 400
 
     if not description:
-        return jsonify({'error': 'Opis zdarzenia jest wymagany'}), 400
-
-    incident = Incident()
-    incident.user_id = session['user_id']
-    incident.license_plate = license_plate
-    incident.latitude = float(latitude)
-    incident.longitude = float(longitude)
-    incident.incident_type = incident_type
-    incident.description = description
-    incident.severity = int(severity)
-
-    db.session.add(incident)
+        return {'error': 'Opis zdarzenia jest wymagany'}, 400
+
+    incident, created, corroborated = ingest_incident(
+        user_id, license_plate, latitude, longitude, incident_type, description, severity)
+    if not created:
+        return {
+            'success': True,
+            'message': ('Zdarzenie zostało już zgłoszone, dodano potwierdzenie' if corroborated
+                        else 'To zdarzenie zostało już przez Ciebie zgłoszone'),
+            'incident_id': incident.id,
+            'corroborations': incident.corroborations,
+            'is_verified': incident.is_verified
+        }, 200
+
+    event_broker.publish('incident',
+                         incident_id=incident.id,
+                         license_plate=incident.license_plate,
+                         latitude=incident.latitude,
+                         longitude=incident.longitude,
+                         incident_type=incident.incident_type,
+                         description=incident.description,
+                         severity=incident.severity,
+                         created_at=incident.created_at.isoformat())
+    job_queue.enqueue('refresh_user_statistics', user_id=user_id)
+    job_queue.enqueue('invalidate_heatmap_tiles', latitude=incident.latitude,
+                      longitude=incident.longitude)
+    return {'success': True, 'message': 'Zdarzenie zostało dodane',
+            'incident_id': incident.id}, 200
+
+
+@app.route('/api/add_incident', methods=['POST'])
+@login_required
+def api_add_incident():
+    """API endpoint for adding an incident"""
+    payload, status = _report_incident(current_user_id(), request.get_json())
+    if status == 200:
+        db.session.commit()
+    return jsonify(payload), status
+
+
+# Map markers, newest first; columnar, see serialization.py
+INCIDENT_MAP_SCHEMA = Schema('id', 'latitude', 'longitude', 'license_plate', 'incident_type',
+                             'description', 'severity', 'corroborations', 'is_verified',
+                             'created_at')
+MAX_MAP_INCIDENTS = 2000
+
+
+@app.route('/api/incidents', methods=['GET'])
+@db_route(db, replica=True, statement_timeout_ms=5000)
+def api_incidents():
+    """API endpoint for the incidents in a map viewport"""
+    bbox = parse_bbox(request.args.get('bbox'))
+    if bbox is None:
+        return jsonify({'error': 'Nieprawidłowy obszar (bbox)'}), 400
+    limit = min(max(request.args.get('limit', 500, type=int), 1), MAX_MAP_INCIDENTS)
+
+    min_lng, min_lat, max_lng, max_lat = bbox
+    rows = db.session.execute(
+        select(*(getattr(Incident, name) for name in INCIDENT_MAP_SCHEMA.names))
+        .where(Incident.latitude.between(min_lat, max_lat),
+               Incident.longitude.between(min_lng, max_lng))
+        .order_by(Incident.created_at.desc())
+        .limit(limit))
+    return json_response(dict(INCIDENT_MAP_SCHEMA.dump_columns(rows), success=True))
+
+
+# Offline writes are replayed by the service worker in batches, see static/sw.js
+MAX_BATCH_OPERATIONS = 50
+
+
+def _apply_operation(user_id, operation):
+    """
+    Apply one operation of a batch (caller commits)
+    Returns:
+        tuple: (response payload, HTTP status)
+    """
+    kind = operation.get('type')
+    payload = operation.get('data')
+    if not isinstance(payload, dict):
+        return {'error': 'Nieprawidłowa operacja'}, 400
+    if kind == 'rate':
+        return _rate_vehicle(user_id, payload)
+    if kind == 'incident':
+        return _report_incident(user_id, payload)
+    return {'error': 'Nieprawidłowa operacja'}, 400
+
+
+@app.route('/api/batch', methods=['POST'])
+@login_required
+def api_batch():
+    """
+    API endpoint applying queued offline writes in one transaction.
+    Every operation runs in its own savepoint and gets its own result (with
+    the status its single endpoint would have returned); an invalid or
+    failing one is rolled back alone and does not fail the batch.
+    """
+    data = request.get_json(silent=True) or {}
+    operations = data.get('operations')
+    if not isinstance(operations, list) or not operations:
+        return jsonify({'error': 'Nieprawidłowa lista operacji'}), 400
+    if len(operations) > MAX_BATCH_OPERATIONS:
+        return jsonify({'error': f'Maksymalnie {MAX_BATCH_OPERATIONS} operacji naraz'}), 400
+
+    user_id = current_user_id()
+    # Offline writes are queued per user; another session must not send them
+    if 'user_id' in data and data['user_id'] != user_id:
+        return jsonify({'error': 'Zapisane operacje należą do innego konta'}), 409
+    results = []
+    for operation in operations:
+        if not isinstance(operation, dict):
+            operation = {}
+        savepoint = db.session.begin_nested()
+        try:
+            result, status = _apply_operation(user_id, operation)
+            if status == 200:
+                savepoint.commit()
+            else:
+                # e.g. a vehicle created before its rating was refused
+                savepoint.rollback()
+        except IntegrityError as e:
+            savepoint.rollback()
+            logging.warning(f"Batch operation {operation.get('type')} conflicted: {e}")
+            result, status = {'error': 'Operacja koliduje z innymi zmianami'}, 409
+        except Exception:
+            savepoint.rollback()
+            logging.exception(f"Batch operation {operation.get('type')} failed")
+            result, status = {'error': 'Nie udało się wykonać operacji'}, 500
+        results.append(dict(result, id=operation.get('id'), status=status))
+
     db.session.commit()
+    return jsonify({'success': True, 'results': results})
+
 
-    # Update user statistics
-    user_stats = UserStatistics.query.filter_by(
-        user_id=session['user_id']).first()
-    if user_stats:
-        user_stats.update_statistics()
+@app.route('/api/heatmap/<int:z>/<int:x>/<int:y>.png', methods=['GET'])
+def api_heatmap_tile(z, x, y):
+    """Incident density heatmap tile"""
+    if not heatmap_tiles.available or not heatmap_tiles.valid_tile(z, x, y):
+        abort(404)
 
-    return jsonify({'success': True, 'message': 'Zdarzenie zostało dodane'})
+    # Cached file; tiles touched by new incidents are deleted and re-rendered
+    return send_file(heatmap_tiles.get_tile(z, x, y), mimetype='image/png',
+                     max_age=60, conditional=True)
 
 
 @app.route('/api/favorite', methods=['POST'])
@@ -762,23 +997,26 @@ def api_add_incident():
 def api_add_favorite():
     """API endpoint for adding a vehicle to favorites"""
     data = request.get_json()
-    license_plate = data.get('license_plate', '').strip().upper()
+    license_plate = canonical_plate(data.get('license_plate'))
     notes = data.get('notes', '').strip()
 
-    if not validate_license_plate(license_plate):
+    if not license_plate:
         return jsonify({'error': 'Nieprawidłowy numer rejestracyjny'}), 400
 
     # Get or create vehicle
-    vehicle = Vehicle.query.filter_by(license_plate=license_plate).first()
-    if not vehicle:
+    entry = plate_directory.get(license_plate)
+    if entry:
+        vehicle_id = entry.vehicle_id
+    else:
         vehicle = Vehicle()
         vehicle.license_plate = license_plate
         db.session.add(vehicle)
         db.session.flush()
+        vehicle_id = vehicle.id
 
     # Check if already favorited
     existing_favorite = Favorite.query.filter_by(
-        user_id=session['user_id'], vehicle_id=vehicle.id).first()
+        user_id=current_user_id(), vehicle_id=vehicle_id).first()
 
     if existing_favorite:
         return jsonify({'error':
@@ -786,12 +1024,18 @@ def api_add_favorite():
 
     # Create favorite
     favorite = Favorite()
-    favorite.user_id = session['user_id']
-    favorite.vehicle_id = vehicle.id
+    favorite.user_id = current_user_id()
+    favorite.vehicle_id = vehicle_id
     favorite.notes = notes
 
     db.session.add(favorite)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # The directory entry outlived a deleted vehicle
+        db.session.rollback()
+        plate_directory.discard(license_plate)
+        return jsonify({'error': 'Pojazd nie został znaleziony'}), 404
 
     return jsonify({
         'success': True,
@@ -804,14 +1048,14 @@ def api_add_favorite():
 def api_remove_favorite():
     """API endpoint for removing a vehicle from favorites"""
     data = request.get_json()
-    license_plate = data.get('license_plate', '').strip().upper()
+    license_plate = canonical_plate(data.get('license_plate'))
 
-    vehicle = Vehicle.query.filter_by(license_plate=license_plate).first()
-    if not vehicle:
+    entry = plate_directory.get(license_plate) if license_plate else None
+    if not entry:
         return jsonify({'error': 'Pojazd nie został znaleziony'}), 404
 
-    favorite = Favorite.query.filter_by(user_id=session['user_id'],
-                                        vehicle_id=vehicle.id).first()
+    favorite = Favorite.query.filter_by(user_id=current_user_id(),
+                                        vehicle_id=entry.vehicle_id).first()
 
     if not favorite:
         return jsonify({'error':
@@ -830,17 +1074,109 @@ def api_remove_favorite():
 @login_required
 def api_check_favorite(license_plate):
     """API endpoint for checking if a vehicle is in favorites"""
-    vehicle = Vehicle.query.filter_by(
-        license_plate=license_plate.upper()).first()
-    if not vehicle:
+    license_plate = canonical_plate(license_plate)
+    entry = plate_directory.get(license_plate) if license_plate else None
+    if not entry:
         return jsonify({'is_favorite': False})
 
-    favorite = Favorite.query.filter_by(user_id=session['user_id'],
-                                        vehicle_id=vehicle.id).first()
+    favorite = Favorite.query.filter_by(user_id=current_user_id(),
+                                        vehicle_id=entry.vehicle_id).first()
 
     return jsonify({'is_favorite': favorite is not None})
 
 
+@app.route('/api/activity', methods=['GET'])
+@login_required
+def api_activity():
+    """API endpoint for the current user's activity timeline (keyset paginated)"""
+    before = None
+    if request.args.get('before'):
+        try:
+            before = decode_cursor(request.args['before'])
+        except ValueError:
+            return jsonify({'error': 'Nieprawidłowy kursor'}), 400
+
+    items, next_cursor = activity_timeline(
+        current_user_id(), before=before, limit=request.args.get('limit', 20, type=int))
+    for item in items:
+        item['created_at'] = item['created_at'].isoformat()
+    return jsonify({'items': items, 'next_cursor': next_cursor})
+
+
+@app.route('/api/favorites/status', methods=['GET'])
+@login_required
+def api_favorites_status():
+    """API endpoint for the favorite status of many plates at once"""
+    plates = [
+        plate for plate in map(canonical_plate, request.args.get('plates', '').split(','))
+        if plate
+    ]
+    if len(plates) > MAX_STATUS_PLATES:
+        return jsonify({'error': f'Maksymalnie {MAX_STATUS_PLATES} numerów naraz'}), 400
+
+    return jsonify({'favorites': favorite_status(current_user_id(), plates)})
+
+
+@app.route('/api/favorites', methods=['GET'])
+@login_required
+def api_favorites():
+    """API endpoint for the current user's favorites, paginated"""
+    favorites = favorites_page(current_user_id(),
+                               page=request.args.get('page', 1, type=int),
+                               per_page=request.args.get('per_page', 20, type=int))
+    return jsonify({
+        'favorites': [{
+            'license_plate': row.vehicle.license_plate,
+            'is_blocked': row.vehicle.is_blocked,
+            'notes': row.favorite.notes,
+            'created_at': row.favorite.created_at.isoformat(),
+            'rating_count': row.rating_count,
+            'avg_rating': round(row.avg_rating, 2),
+            'comment_count': row.comment_count
+        } for row in favorites.items],
+        'page': favorites.page,
+        'pages': favorites.pages,
+        'total': favorites.total
+    })
+
+
+@app.route('/api/favorites/changes', methods=['GET'])
+@login_required
+def api_favorites_changes():
+    """API endpoint for new activity on favorite vehicles since the last visit"""
+    since, changes = favorite_changes(current_user_id())
+    for change in changes:
+        change['latest_at'] = change['latest_at'].isoformat()
+    return jsonify({'since': since.isoformat(), 'changes': changes})
+
+
+@app.route('/api/favorites/changes/seen', methods=['POST'])
+@login_required
+def api_favorites_changes_seen():
+    """API endpoint for marking the favorites feed as seen"""
+    mark_favorites_seen(current_user_id())
+    db.session.commit()
+    return jsonify({'success': True})
+
+
+@app.route('/api/plates/autocomplete', methods=['GET'])
+def api_plates_autocomplete():
+    """API endpoint for license plate prefix suggestions"""
+    prefix = canonical_plate(request.args.get('q', ''))
+    limit = min(request.args.get('limit', 10, type=int), 50)
+
+    if not prefix:
+        return jsonify({'plates': []})
+
+    return jsonify({
+        'plates': [{
+            'license_plate': plate,
+            'rating_count': entry.rating_count,
+            'avg_rating': round(entry.avg_rating, 2)
+        } for plate, entry in plate_directory.complete(prefix, limit=limit)]
+    })
+
+
 @app.route('/api/delete_my_comment', methods=['POST'])
 @login_required
 def api_delete_my_comment():
@@ -849,84 +1185,73 @@ def api_delete_my_comment():
     comment_id = data.get('comment_id')
 
     comment = Comment.query.filter_by(id=comment_id,
-                                      user_id=session['user_id']).first()
+                                      user_id=current_user_id()).first()
     if not comment:
         return jsonify({
             'error':
             'Komentarz nie został znaleziony lub nie masz uprawnień'
         }), 404
 
-    db.session.delete(comment)
+    delete_comments([comment.id])
     db.session.commit()
 
     return jsonify({'success': True, 'message': 'Komentarz został usunięty'})
 
 
+@app.route('/api/events/stream', methods=['GET'])
+def api_events_stream():
+    """Server-Sent Events stream of new ratings, comments and incidents
+
+    Optional filters: ``plates`` (comma separated), ``bbox``
+    (minLng,minLat,maxLng,maxLat) and ``types`` (rating,comment,incident).
+    """
+    try:
+        plates, bbox, types = parse_stream_filters(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    subscription = event_broker.subscribe(plates=plates, bbox=bbox, types=types)
+    if subscription is None:
+        return jsonify({'error': 'Zbyt wiele połączeń, spróbuj później'}), 503
+
+    response = Response(event_broker.stream(subscription),
+                        mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Disable proxy buffering (nginx) so events are flushed immediately
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
 @app.route('/api/tomtom-traffic', methods=['GET'])
 def api_tomtom_traffic():
-    """Proxy endpoint for TomTom Traffic API"""
+    """Traffic flow for the whole map viewport, sampled on a grid of points"""
     try:
-        lat = request.args.get('lat', type=float)
-        lng = request.args.get('lng', type=float)
-        zoom = request.args.get('zoom', type=int, default=12)
-
-        if not lat or not lng:
-            return jsonify({'error': 'Missing latitude or longitude'}), 400
-
-        # Check if TomTom API key is available
-        if not tomtom_api_key:
-            logging.info(
-                "TomTom API key not configured, returning simulated data")
-            return jsonify({
-                'flowSegmentData': [],
-                'simulated':
-                True,
-                'message':
-                'Using simulated data - API key not configured'
-            })
-
-        # TomTom Traffic Flow API for traffic density and speed data
-        tomtom_url = "https://api.tomtom.com/traffic/services/4/flowSegmentData/absolute/10/json"
-
-        import requests
-        headers = {'User-Agent': 'Driver-Rating-App/1.0'}
-        params = {
-            'key': tomtom_api_key,
-            'point': f'{lat},{lng}',
-            'unit': 'KMPH'
-        }
+        bbox, zoom = parse_viewport(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
-        response = requests.get(tomtom_url,
-                                headers=headers,
-                                params=params,
-                                timeout=10)
-
-        if response.status_code == 200:
-            data = response.json()
-            logging.info(
-                f"TomTom API success: Retrieved flow data with {len(data.get('flowSegmentData', []))} segments"
-            )
-            return jsonify(data)
-        else:
-            logging.error(
-                f"TomTom API error: {response.status_code} - {response.text}")
-            # Return simulated data as fallback
-            return jsonify({
-                'flowSegmentData': [],
-                'simulated':
-                True,
-                'message':
-                f'TomTom API error {response.status_code}, using simulated data'
-            })
-
-    except Exception as e:
-        logging.error(f"TomTom proxy error: {e}")
-        # Return simulated data as fallback
+    if not traffic_flow.configured:
+        return _modelled_traffic(bbox, 'Using simulated data - API key not configured')
+
+    # Cached, stale or freshly sampled; never blocks longer than TOMTOM_TIMEOUT
+    data = traffic_flow.viewport_flow(bbox, zoom)
+    if data['failed'] == data['points']:
+        return _modelled_traffic(bbox, 'TomTom API unavailable, using simulated data')
+    return jsonify(dict(data, source='live'))
+
+
+def _modelled_traffic(bbox, fallback_message):
+    """Traffic from the hour-of-week model, or an empty simulated payload"""
+    segments = traffic_history.model_flow(bbox)
+    if segments:
         return jsonify({
-            'flowSegmentData': [],
-            'simulated': True,
-            'message': f'API error: {str(e)}, using simulated data'
+            'segments': segments,
+            'source': 'model',
+            'simulated': False,
+            'message': 'TomTom API unavailable, showing typical traffic for this hour'
         })
+    logging.info(f"No traffic model for viewport: {fallback_message}")
+    return jsonify({'segments': [], 'simulated': True, 'message': fallback_message})
 
 
 # Admin API Routes
@@ -937,11 +1262,9 @@ def api_admin_delete_comment():
     data = request.get_json()
     comment_id = data.get('comment_id')
 
-    comment = Comment.query.get(comment_id)
-    if not comment:
+    if not delete_comments([comment_id]):
         return jsonify({'error': 'Komentarz nie został znaleziony'}), 404
 
-    db.session.delete(comment)
     db.session.commit()
 
     return jsonify({'success': True, 'message': 'Komentarz został usunięty'})
@@ -952,9 +1275,9 @@ def api_admin_delete_comment():
 def api_admin_block_vehicle():
     """Admin API endpoint for blocking/unblocking vehicles"""
     data = request.get_json()
-    license_plate = data.get('license_plate', '').strip().upper()
+    license_plate = canonical_plate(data.get('license_plate'))
 
-    vehicle = Vehicle.query.filter_by(license_plate=license_plate).first()
+    vehicle = Vehicle.query.filter_by(license_plate=license_plate).first() if license_plate else None
     if not vehicle:
         return jsonify({'error': 'Pojazd nie został znaleziony'}), 404
 
@@ -972,14 +1295,10 @@ def api_admin_clear_reports():
     data = request.get_json()
     comment_id = data.get('comment_id')
 
-    comment = Comment.query.get(comment_id)
-    if not comment:
+    if not clear_reports([comment_id]):
+        db.session.rollback()
         return jsonify({'error': 'Komentarz nie został znaleziony'}), 404
 
-    # Clear reports for this comment
-    comment.reports = 0
-    # Delete all report entries for this comment
-    Report.query.filter_by(comment_id=comment_id).delete()
     db.session.commit()
 
     return jsonify({
@@ -988,8 +1307,77 @@ def api_admin_clear_reports():
     })
 
 
+@app.route('/api/admin/moderation/bulk', methods=['POST'])
+@admin_required
+def api_admin_moderation_bulk():
+    """Admin API endpoint for clearing reports or deleting many comments"""
+    data = request.get_json()
+    action = data.get('action')
+    comment_ids = data.get('comment_ids') or []
+
+    if not isinstance(comment_ids, list) or not all(
+            isinstance(i, int) for i in comment_ids):
+        return jsonify({'error': 'Nieprawidłowa lista komentarzy'}), 400
+
+    if action == 'clear':
+        count = clear_reports(comment_ids)
+        message = f'Wyczyszczono zgłoszenia {count} komentarzy'
+    elif action == 'delete':
+        count = delete_comments(comment_ids)
+        message = f'Usunięto {count} komentarzy'
+    else:
+        return jsonify({'error': 'Nieprawidłowa akcja'}), 400
+
+    db.session.commit()
+
+    return jsonify({'success': True, 'message': message, 'count': count})
+
+
+@app.route('/api/admin/bulk/block_vehicles', methods=['POST'])
+@admin_required
+def api_admin_bulk_block_vehicles():
+    """Admin API endpoint for blocking or unblocking many vehicles at once"""
+    data = request.get_json()
+    license_plates = data.get('license_plates') or []
+    blocked = data.get('blocked', True)
+
+    if not isinstance(license_plates, list) or not all(
+            isinstance(p, str) for p in license_plates):
+        return jsonify({'error': 'Nieprawidłowa lista numerów rejestracyjnych'}), 400
+    # bool("false") is True: anything but a JSON boolean would block by mistake
+    if not isinstance(blocked, bool):
+        return jsonify({'error': 'Pole blocked musi mieć wartość true lub false'}), 400
+
+    invalid = [p for p in license_plates if p.strip() and not canonical_plate(p)]
+    license_plates = [plate for plate in map(canonical_plate, license_plates) if plate]
+    updated, missing = set_vehicles_blocked(license_plates, blocked=blocked)
+    db.session.commit()
+    missing.extend(invalid)
+
+    return jsonify({
+        'success': True,
+        'message': f'Zaktualizowano {updated} pojazdów',
+        'count': updated,
+        'not_found': missing
+    })
+
+
+@app.route('/api/admin/upstreams', methods=['GET'])
+@admin_required
+def api_admin_upstreams():
+    """Admin API endpoint for external API cache and circuit breaker metrics"""
+    return jsonify({'success': True, 'upstreams': {'tomtom': traffic_flow.snapshot()}})
+
+
+# PostgreSQL returns EXTRACT() and AVG() as numeric
+MONTHLY_USERS_SCHEMA = Schema(('month', int), ('year', int), 'count')
+TOP_VEHICLES_SCHEMA = Schema('license_plate', ('avg_rating', float), 'rating_count')
+RATING_DISTRIBUTION_SCHEMA = Schema('rating', 'count')
+
+
 @app.route('/api/admin/stats', methods=['GET'])
 @admin_required
+@db_route(db, replica=True, statement_timeout_ms=30000)
 def api_admin_stats():
     """Admin API endpoint for comprehensive statistics"""
     # Calculate comprehensive statistics
@@ -1001,62 +1389,45 @@ def api_admin_stats():
     blocked_vehicles = Vehicle.query.filter_by(is_blocked=True).count()
 
     # Monthly registration stats (last 6 months)
-    from sqlalchemy import extract, func
-    monthly_users = db.session.query(
+    from sqlalchemy import extract
+    monthly_users = db.session.execute(select(
         extract('month', User.created_at).label('month'),
         extract('year', User.created_at).label('year'),
         func.count(User.id).label('count')).group_by(
             extract('year', User.created_at),
             extract('month', User.created_at)).order_by(
                 extract('year', User.created_at),
-                extract('month', User.created_at)).limit(6).all()
+                extract('month', User.created_at)).limit(6))
 
     # Top rated vehicles
-    top_vehicles = db.session.query(
+    top_vehicles = db.session.execute(select(
         Vehicle.license_plate,
         func.avg(Rating.rating).label('avg_rating'),
         func.count(Rating.id).label('rating_count')).join(Rating).group_by(
             Vehicle.id).having(func.count(Rating.id) >= 3).order_by(
-                func.avg(Rating.rating).desc()).limit(10).all()
+                func.avg(Rating.rating).desc()).limit(10))
 
     # Rating distribution
-    rating_distribution = db.session.query(
+    rating_distribution = db.session.execute(select(
         Rating.rating,
         func.count(Rating.id).label('count')).group_by(Rating.rating).order_by(
-            Rating.rating).all()
+            Rating.rating))
 
-    return jsonify({
+    return json_response({
         'success': True,
         'stats': {
-            'total_users':
-            total_users,
-            'total_vehicles':
-            total_vehicles,
-            'total_ratings':
-            total_ratings,
-            'total_comments':
-            total_comments,
-            'total_reports':
-            total_reports,
-            'blocked_vehicles':
-            blocked_vehicles,
-            'monthly_users': [{
-                'month': row.month,
-                'year': row.year,
-                'count': row.count
-            } for row in monthly_users],
-            'top_vehicles': [{
-                'license_plate': row.license_plate,
-                'avg_rating': float(row.avg_rating),
-                'rating_count': row.rating_count
-            } for row in top_vehicles],
-            'rating_distribution': [{
-                'rating': row.rating,
-                'count': row.count
-            } for row in rating_distribution]
+            'total_users': total_users,
+            'total_vehicles': total_vehicles,
+            'total_ratings': total_ratings,
+            'total_comments': total_comments,
+            'total_reports': total_reports,
+            'blocked_vehicles': blocked_vehicles,
+            'monthly_users': MONTHLY_USERS_SCHEMA.dump(monthly_users),
+            'top_vehicles': TOP_VEHICLES_SCHEMA.dump(top_vehicles),
+            'rating_distribution': RATING_DISTRIBUTION_SCHEMA.dump(rating_distribution)
         }
     })
 
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    app.run(host='0.0.0.0', port=5000)
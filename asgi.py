@@ -0,0 +1,343 @@
+"""
+Async (ASGI) serving mode for the Driver Rating Application
+
+    uvicorn asgi:application --host 0.0.0.0 --port 5000
+    gunicorn -k uvicorn.workers.UvicornWorker asgi:application
+
+I/O-bound endpoints run as coroutines on the event loop: the TomTom proxy
+(aiohttp, async database driver for the traffic model) and the live event
+stream, so thousands of waiting clients cost one worker nothing but
+memory. Every other route is the unchanged Flask app, run on a thread pool.
+That includes the admin data export: the CSV is built in the browser from
+/api/admin/stats, a handful of aggregate queries on the replica behind the
+session-based admin check, requested rarely and answered in one go, so it
+costs a pool thread briefly rather than holding a connection open.
+Needs uvicorn and aiohttp, plus asyncpg (PostgreSQL) or aiosqlite (SQLite):
+the ``asgi`` extra.
+"""
+
+import asyncio
+import io
+import json
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+
+import aiohttp
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from app import app
+from events import Subscription, event_broker, format_event, parse_stream_filters
+from traffic import HEADERS, parse_viewport, traffic_flow
+from traffic_history import traffic_history
+
+app.config.setdefault('ASGI_WSGI_THREADS', int(os.environ.get('ASGI_WSGI_THREADS', 16)))
+# Streams no longer hold threads: pages subscribe, no WSGI per-worker cap
+app.config['EVENTS_STREAMING'] = True
+
+ASYNC_DRIVERS = {'postgresql': 'postgresql+asyncpg', 'sqlite': 'sqlite+aiosqlite'}
+
+
+def async_database_url(url):
+    """
+    Async driver URL and connect arguments for a database URL
+    Returns:
+        tuple: (URL, connect_args)
+    """
+    url = make_url(url)
+    backend = url.get_backend_name()
+    url = url.set(drivername=ASYNC_DRIVERS.get(backend, url.drivername))
+    connect_args = {}
+    if backend == 'postgresql':
+        # asyncpg takes ssl/server_settings instead of libpq options
+        query = dict(url.query)
+        if 'sslmode' in query:
+            connect_args['ssl'] = query.pop('sslmode')
+        url = url.set(query=query)
+        timeout_ms = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 15000))
+        connect_args['server_settings'] = {'statement_timeout': str(timeout_ms)}
+    return url, connect_args
+
+
+class AsyncSubscription(Subscription):
+    """Subscription that wakes a coroutine instead of a blocked thread"""
+
+    __slots__ = ('_loop', '_wakeup')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+
+    def _notify(self):
+        try:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+        except RuntimeError:
+            # Loop already closed (worker shutting down)
+            pass
+
+    def push(self, evt):
+        # Called from the LISTEN thread or whichever thread committed
+        super().push(evt)
+        self._notify()
+
+    def close(self):
+        super().close()
+        self._notify()
+
+    async def wait(self, timeout):
+        """
+        Wait for buffered events
+        Returns:
+            list: Events received since the last call, empty on timeout
+        """
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup.clear()
+        with self._cond:
+            events = list(self.buffer)
+            self.buffer.clear()
+            return events
+
+
+class Resources:
+    """Per-process async clients, created on first use after the fork"""
+
+    def __init__(self):
+        self.http = None
+        self.engine = None
+
+    def get(self):
+        if self.http is None:
+            # Must be created inside the running loop
+            self.http = aiohttp.ClientSession(
+                headers=HEADERS, timeout=aiohttp.ClientTimeout(total=traffic_flow.timeout),
+                connector=aiohttp.TCPConnector(limit=traffic_flow.max_in_flight))
+            url, connect_args = async_database_url(app.config['SQLALCHEMY_DATABASE_URI'])
+            self.engine = create_async_engine(url, connect_args=connect_args,
+                                              pool_recycle=int(os.environ.get('DB_POOL_RECYCLE', 300)))
+        return self
+
+    async def close(self):
+        if self.http is not None:
+            await self.http.close()
+            await self.engine.dispose()
+            self.http = self.engine = None
+
+
+resources = Resources()
+
+
+async def send_json(send, payload, status=200, headers=()):
+    body = json.dumps(payload).encode()
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json'),
+                            (b'content-length', str(len(body)).encode()), *headers]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def wait_disconnect(receive):
+    """Returns once the client has gone (the request body is skipped)"""
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+def query_args(scope):
+    return dict(parse_qsl(scope['query_string'].decode('latin-1')))
+
+
+async def modelled_traffic(send, bbox, fallback_message):
+    """Async twin of the Flask _modelled_traffic() helper"""
+    async with resources.get().engine.connect() as conn:
+        rows = (await conn.execute(traffic_history.model_query(bbox))).all()
+    segments = traffic_history.model_segments(rows)
+    if segments:
+        await send_json(send, {
+            'segments': segments,
+            'source': 'model',
+            'simulated': False,
+            'message': 'TomTom API unavailable, showing typical traffic for this hour'
+        })
+    else:
+        await send_json(send, {'segments': [], 'simulated': True, 'message': fallback_message})
+
+
+async def tomtom_traffic(scope, receive, send):
+    """Async twin of api_tomtom_traffic()"""
+    try:
+        bbox, zoom = parse_viewport(query_args(scope))
+    except ValueError as e:
+        await send_json(send, {'error': str(e)}, 400)
+        return
+
+    if not traffic_flow.configured:
+        await modelled_traffic(send, bbox, 'Using simulated data - API key not configured')
+        return
+
+    data = await traffic_flow.viewport_flow_async(resources.get().http, bbox, zoom)
+    if data['failed'] == data['points']:
+        await modelled_traffic(send, bbox, 'TomTom API unavailable, using simulated data')
+        return
+    await send_json(send, dict(data, source='live'))
+
+
+async def events_stream(scope, receive, send):
+    """Async twin of api_events_stream()"""
+    try:
+        plates, bbox, types = parse_stream_filters(query_args(scope))
+    except ValueError as e:
+        await send_json(send, {'error': str(e)}, 400)
+        return
+
+    with app.app_context():
+        sub = event_broker.subscribe(plates=plates, bbox=bbox, types=types,
+                                     subscription_class=AsyncSubscription)
+    if sub is None:
+        await send_json(send, {'error': 'Zbyt wiele połączeń, spróbuj później'}, 503)
+        return
+
+    heartbeat = app.config['EVENTS_HEARTBEAT']
+    disconnected = asyncio.ensure_future(wait_disconnect(receive))
+    try:
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream; charset=utf-8'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no')]})
+        await send({'type': 'http.response.body', 'body': b'retry: 5000\n\n', 'more_body': True})
+        while not sub.closed:
+            waiter = asyncio.ensure_future(sub.wait(heartbeat))
+            await asyncio.wait({waiter, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+            if disconnected.done():
+                waiter.cancel()
+                break
+            events = waiter.result()
+            chunk = ''.join(map(format_event, events)) if events else ': keep-alive\n\n'
+            await send({'type': 'http.response.body', 'body': chunk.encode(), 'more_body': True})
+    except OSError:
+        pass
+    finally:
+        disconnected.cancel()
+        event_broker.unsubscribe(sub)
+
+
+def wsgi_environ(scope, body):
+    """WSGI environ for an ASGI HTTP scope (PEP 3333 string handling)"""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name, value = name.decode('latin-1'), value.decode('latin-1')
+        if name == 'content-type':
+            key = 'CONTENT_TYPE'
+        elif name == 'content-length':
+            key = 'CONTENT_LENGTH'
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+        if key in environ:
+            # Repeated headers are joined; cookies use their own separator
+            value = environ[key] + ('; ' if key == 'HTTP_COOKIE' else ',') + value
+        environ[key] = value
+    return environ
+
+
+class WsgiBridge:
+    """
+    Serves the Flask app from a thread pool of ``ASGI_WSGI_THREADS``.
+    Unlike asgiref's adapter, requests are not serialized onto one thread,
+    and streamed bodies are forwarded chunk by chunk.
+    """
+
+    _DONE = object()
+
+    def __init__(self, wsgi_app, threads):
+        self.wsgi_app = wsgi_app
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='wsgi')
+
+    async def __call__(self, scope, receive, send):
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+
+        loop = asyncio.get_running_loop()
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1'))
+                                  for k, v in headers]
+
+        def run():
+            result = self.wsgi_app(wsgi_environ(scope, bytes(body)), start_response)
+            return result, iter(result)
+
+        result, chunks = await loop.run_in_executor(self.pool, run)
+        try:
+            chunk = await loop.run_in_executor(self.pool, next, chunks, self._DONE)
+            await send({'type': 'http.response.start', 'status': started['status'],
+                        'headers': started['headers']})
+            while chunk is not self._DONE:
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                chunk = await loop.run_in_executor(self.pool, next, chunks, self._DONE)
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(result, 'close'):
+                await loop.run_in_executor(self.pool, result.close)
+
+
+ASYNC_ROUTES = {
+    ('GET', '/api/tomtom-traffic'): tomtom_traffic,
+    ('GET', '/api/events/stream'): events_stream,
+}
+
+flask_bridge = WsgiBridge(app, app.config['ASGI_WSGI_THREADS'])
+
+
+async def application(scope, receive, send):
+    """ASGI entry point: async views first, the Flask app for everything else"""
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await resources.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    elif scope['type'] == 'http':
+        view = ASYNC_ROUTES.get((scope['method'], scope['path']), flask_bridge)
+        try:
+            await view(scope, receive, send)
+        except Exception:
+            logging.exception(f"ASGI view failed: {scope['path']}")
+            raise
+    else:
+        # No websocket endpoints
+        await send({'type': 'websocket.close', 'code': 1000})
@@ -0,0 +1,285 @@
+"""
+Static asset pipeline for the Driver Rating Application
+Builds minified, content-hashed copies of the files in static/ with gzip
+and brotli variants, and serves them with immutable caching headers
+
+    python assets.py            # writes static/dist/ and its assets.json
+    python assets.py --clean    # drops earlier builds first
+
+The minifiers and brotli come with the ``build`` extra
+(``uv run --extra build python assets.py``).
+
+Templates keep calling ``url_for('static', filename='css/style.css')``; once
+a build exists the URL points at the hashed copy. Without a build (and in
+debug mode) the original files are served as before.
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import re
+import shutil
+import sys
+
+try:
+    import rjsmin
+except ImportError:
+    # Optional minifiers; without them files are only hashed and compressed
+    rjsmin = None
+try:
+    import rcssmin
+except ImportError:
+    rcssmin = None
+try:
+    import brotli
+except ImportError:
+    # Optional; without it only gzip variants are written
+    brotli = None
+
+from flask import request, send_from_directory
+
+DIST_DIR = 'dist'
+MANIFEST_NAME = 'assets.json'
+
+# Need stable URLs: the service worker is generated, the PWA manifest is
+# referenced by browsers and the app itself
+UNHASHED = {'sw.js', 'manifest.json'}
+
+COMPRESSIBLE = {'.js', '.css', '.json', '.svg', '.ico'}
+
+# Variants are only kept when they save at least this fraction
+MIN_SAVING = 0.1
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+
+def minify(name, data):
+    """
+    Minified contents of a static file
+    Args:
+        name: File name, selects the minifier by extension
+        data: File contents
+    Returns:
+        bytes: Minified contents, or ``data`` when there is no minifier
+    """
+    ext = os.path.splitext(name)[1]
+    if ext == '.json':
+        return json.dumps(json.loads(data), ensure_ascii=False,
+                          separators=(',', ':')).encode('utf-8')
+    if ext == '.js' and rjsmin is not None:
+        return rjsmin.jsmin(data.decode('utf-8')).encode('utf-8')
+    if ext == '.css' and rcssmin is not None:
+        return rcssmin.cssmin(data.decode('utf-8')).encode('utf-8')
+    return data
+
+
+def compress(data):
+    """
+    Pre-compressed variants worth serving
+    Returns:
+        dict: Encoding name -> compressed bytes
+    """
+    variants = {'gzip': gzip.compress(data, 9, mtime=0)}
+    if brotli is not None:
+        variants['br'] = brotli.compress(data, quality=11)
+    limit = len(data) * (1 - MIN_SAVING)
+    return {encoding: body for encoding, body in variants.items() if len(body) <= limit}
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def build_assets(static_folder, clean=False):
+    """
+    Build the hashed copies, their compressed variants, the manifest and
+    the service worker
+    Args:
+        static_folder: Path of the static directory
+        clean: Remove earlier builds first (by default their files are kept,
+            pages rendered by workers still running the old build use them)
+    Returns:
+        dict: The manifest written to dist/assets.json
+    """
+    dist = os.path.join(static_folder, DIST_DIR)
+    if clean and os.path.isdir(dist):
+        shutil.rmtree(dist)
+
+    files = {}
+    for root, dirs, names in os.walk(static_folder):
+        if os.path.abspath(root) == os.path.abspath(static_folder):
+            dirs[:] = [d for d in dirs if d != DIST_DIR]
+        for name in sorted(names):
+            source = os.path.join(root, name)
+            rel = os.path.relpath(source, static_folder).replace(os.sep, '/')
+            if rel in UNHASHED:
+                continue
+            with open(source, 'rb') as f:
+                data = minify(name, f.read())
+            stem, ext = os.path.splitext(rel)
+            digest = hashlib.sha256(data).hexdigest()[:12]
+            target = f'{DIST_DIR}/{stem}.{digest}{ext}'
+            _write(os.path.join(static_folder, target), data)
+
+            encodings = []
+            if ext in COMPRESSIBLE:
+                variants = compress(data)
+                for encoding, suffix in ENCODINGS:
+                    if encoding in variants:
+                        _write(os.path.join(static_folder, target + suffix), variants[encoding])
+                        encodings.append(encoding)
+            files[rel] = {'path': target, 'encodings': encodings}
+
+    version = hashlib.sha256(json.dumps(files, sort_keys=True).encode()).hexdigest()[:12]
+    manifest = {'version': version, 'files': files}
+    _write(os.path.join(dist, 'sw.js'), build_service_worker(static_folder, manifest))
+    _write(os.path.join(dist, MANIFEST_NAME),
+           json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+    return manifest
+
+
+def build_service_worker(static_folder, manifest):
+    """
+    static/sw.js with its precache list pointed at the hashed files and a
+    cache name tied to the build, so a new build replaces the old cache
+    Returns:
+        bytes: Service worker source
+    """
+    with open(os.path.join(static_folder, 'sw.js'), encoding='utf-8') as f:
+        source = f.read()
+
+    def hashed(match):
+        entry = manifest['files'].get(match.group(2))
+        if entry is None:
+            return match.group(0)
+        return f"{match.group(1)}/static/{entry['path']}{match.group(1)}"
+
+    source = re.sub(r"""(['"])/static/([^'"]+)\1""", hashed, source)
+    source = re.sub(r"const CACHE_NAME = '([^']*?)(-[^'-]*)?';",
+                    lambda m: f"const CACHE_NAME = '{m.group(1)}-{manifest['version']}';",
+                    source, count=1)
+    return minify('sw.js', source.encode('utf-8'))
+
+
+class AssetManifest:
+    """
+    Serves the pipeline's output.
+
+    ``url_for('static', ...)`` resolves files listed in the manifest to their
+    hashed copies. Those are sent with a year-long immutable Cache-Control
+    and, when the client accepts it, as their brotli or gzip variant. The
+    service worker (also served at /sw.js) is replaced by the generated one
+    and always revalidated.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.files = {}
+        self.version = None
+        self._hashed = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Configure the asset manifest for a Flask application
+        Args:
+            app: Flask application instance
+        """
+        app.config.setdefault('ASSETS_MANIFEST', os.environ.get(
+            'ASSETS_MANIFEST', os.path.join(app.static_folder, DIST_DIR, MANIFEST_NAME)))
+        self.app = app
+        app.extensions['assets'] = self
+
+        if app.debug:
+            # Sources change while developing, serve them directly
+            return
+        try:
+            with open(app.config['ASSETS_MANIFEST'], encoding='utf-8') as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            logging.info("No asset build found, serving static files unhashed")
+            return
+        except ValueError as e:
+            logging.error(f"Unreadable asset manifest, serving static files unhashed: {e}")
+            return
+
+        self.files = manifest['files']
+        self.version = manifest['version']
+        self._hashed = {entry['path']: (name, entry['encodings'])
+                        for name, entry in self.files.items()}
+        app.url_defaults(self._url_defaults)
+        app.view_functions['static'] = self.send_static
+
+    def _url_defaults(self, endpoint, values):
+        if endpoint == 'static':
+            entry = self.files.get(values.get('filename'))
+            if entry is not None:
+                values['filename'] = entry['path']
+
+    def send_service_worker(self):
+        """The generated service worker when built, else the source; always revalidated"""
+        folder = self.app.static_folder
+        if self.version is not None:
+            folder = os.path.join(folder, DIST_DIR)
+        response = send_from_directory(folder, 'sw.js', max_age=0)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    def send_static(self, filename):
+        """Static view: hashed files immutable and pre-compressed, the rest as before"""
+        static_folder = self.app.static_folder
+        if filename == 'sw.js':
+            return self.send_service_worker()
+
+        hashed = self._hashed.get(filename)
+        if hashed is None:
+            return self.app.send_static_file(filename)
+
+        original, encodings = hashed
+        encoding = next((name for name, _ in ENCODINGS
+                         if name in encodings and request.accept_encodings[name] > 0), None)
+        path = filename + dict(ENCODINGS)[encoding] if encoding else filename
+        response = send_from_directory(static_folder, path,
+                                       mimetype=mimetypes.guess_type(original)[0])
+        if encoding:
+            response.content_encoding = encoding
+        if encodings:
+            response.vary.add('Accept-Encoding')
+        response.headers['Cache-Control'] = IMMUTABLE
+        return response
+
+
+asset_manifest = AssetManifest()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build hashed, compressed static assets')
+    parser.add_argument('--static', default=os.path.join(os.path.dirname(
+        os.path.abspath(__file__)), 'static'), help='Static directory')
+    parser.add_argument('--clean', action='store_true', help='Remove earlier builds first')
+    args = parser.parse_args()
+
+    for name, module in (('rjsmin', rjsmin), ('rcssmin', rcssmin), ('brotli', brotli)):
+        if module is None:
+            print(f"{name} is not installed, skipping that step", file=sys.stderr)
+
+    manifest = build_assets(args.static, clean=args.clean)
+    before = after = 0
+    for name, entry in manifest['files'].items():
+        before += os.path.getsize(os.path.join(args.static, name))
+        after += os.path.getsize(os.path.join(args.static, entry['path']))
+    print(f"Built {len(manifest['files'])} assets (version {manifest['version']}): "
+          f"{before / 1024:.0f} KiB -> {after / 1024:.0f} KiB minified")
+
+
+if __name__ == '__main__':
+    main()
@@ -5,7 +5,8 @@ Handles user authentication, session management, and authorization checks
 
 from flask import session, request, redirect, url_for, flash
 from functools import wraps
-from werkzeug.security import check_password_hash, generate_password_hash
+from sqlalchemy import or_
+from credentials import credential_service
 from models import User, db
 import re
 
@@ -95,13 +96,19 @@ def authenticate_user(username_or_email, password):
         password: Plain text password
     Returns:
         User object if authentication successful, None otherwise
-    """
-    # Try to find user by username first, then by email
-    user = User.query.filter_by(username=username_or_email).first()
-    if not user:
-        user = User.query.filter_by(email=username_or_email).first()
+    Raises:
+        CredentialServiceBusy: If the password hashing pool is saturated
+    """
+    # Single lookup by username or email; prefer the username match
+    users = User.query.filter(
+        or_(User.username == username_or_email,
+            User.email == username_or_email)).limit(2).all()
+    users.sort(key=lambda u: u.username != username_or_email)
+    user = users[0] if users else None
     
-    if user and check_password_hash(user.password_hash, password):
+    if user and credential_service.verify_password(user.password_hash, password):
+        if credential_service.upgrade_hash(user, password):
+            db.session.commit()
         return user
     
     return None
@@ -141,7 +148,7 @@ def create_user(username, email, password, is_admin=False):
     user = User()
     user.username = username
     user.email = email
-    user.password_hash = generate_password_hash(password)
+    user.password_hash = credential_service.hash_password(password)
     user.is_admin = is_admin
     
     try:
@@ -163,13 +170,13 @@ def change_password(user, current_password, new_password):
     Returns:
         bool: True if successful, False otherwise
     """
-    if not check_password_hash(user.password_hash, current_password):
+    if not credential_service.verify_password(user.password_hash, current_password):
         return False
     
     if not validate_password(new_password):
         return False
     
-    user.password_hash = generate_password_hash(new_password)
+    user.password_hash = credential_service.hash_password(new_password)
     
     try:
         db.session.commit()
@@ -0,0 +1,134 @@
+"""
+Benchmark: concurrent connections per worker, sync (gunicorn) vs async (uvicorn)
+
+    python benchmarks/bench_asgi_concurrency.py --clients 50 --streams 200 --latency 0.2
+
+Starts one worker in each mode against a scratch SQLite database and the
+fake TomTom upstream, then measures:
+  * traffic proxy throughput with ``--clients`` concurrent callers, every
+    request on a new viewport so the cache never answers;
+  * how many live event streams the worker holds open while a normal page
+    request still completes.
+Needs gunicorn, uvicorn, aiohttp and aiosqlite installed.
+"""
+
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from fake_tomtom import start_fake_tomtom
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(mode, port, env):
+    if mode == 'sync':
+        command = [sys.executable, '-m', 'gunicorn', '--workers', '1', '--timeout', '120',
+                   '--bind', f'127.0.0.1:{port}', 'main:app']
+    else:
+        command = [sys.executable, '-m', 'uvicorn', '--workers', '1', '--no-access-log',
+                   '--port', str(port), 'asgi:application']
+    process = subprocess.Popen(command, cwd=ROOT, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base = f'http://127.0.0.1:{port}'
+    for _ in range(100):
+        try:
+            requests.get(f'{base}/login', timeout=1)
+            return process, base
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f'{mode} server did not start')
+
+
+def traffic_load(base, clients, per_client):
+    def client(n):
+        session = requests.Session()
+        latencies = []
+        for i in range(per_client):
+            # A new viewport every time, about 10 km apart
+            lng = 14.0 + (n * per_client + i) * 0.1
+            start = time.perf_counter()
+            session.get(f'{base}/api/tomtom-traffic',
+                        params={'zoom': 13, 'bbox': f'{lng},52.20,{lng + 0.05},52.24'},
+                        timeout=120).raise_for_status()
+            latencies.append(time.perf_counter() - start)
+        return latencies
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        latencies = [x for result in pool.map(client, range(clients)) for x in result]
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return len(latencies) / elapsed, statistics.median(latencies), latencies[int(len(latencies) * 0.95)]
+
+
+def stream_capacity(base, streams):
+    """Open streams one by one; returns how many were held with the page still served"""
+    held = []
+    try:
+        for _ in range(streams):
+            try:
+                response = requests.get(f'{base}/api/events/stream', stream=True, timeout=2)
+                next(response.iter_content(chunk_size=None))  # "retry:" preamble
+                held.append(response)
+            except requests.RequestException:
+                break
+        try:
+            requests.get(f'{base}/login', timeout=2).raise_for_status()
+            page_ok = True
+        except requests.RequestException:
+            page_ok = False
+        return len(held), page_ok
+    finally:
+        for response in held:
+            response.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=4, help='Requests per client')
+    parser.add_argument('--streams', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.2,
+                        help='Simulated upstream latency per request (s)')
+    parser.add_argument('--modes', nargs='+', default=['sync', 'async'])
+    args = parser.parse_args()
+
+    upstream, url = start_fake_tomtom(latency=args.latency)
+    for mode in args.modes:
+        env = dict(os.environ,
+                   DATABASE_URL=f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}",
+                   FLASK_DEBUG='False', CREDENTIAL_WORKERS='0',
+                   TOMTOM_API_KEY='bench', TOMTOM_FLOW_URL=url, TOMTOM_GRID_POINTS='4',
+                   TOMTOM_MAX_IN_FLIGHT='1000', TOMTOM_MAX_WORKERS='8', TOMTOM_TIMEOUT='30')
+        process, base = start_server(mode, free_port(), env)
+        try:
+            rate, p50, p95 = traffic_load(base, args.clients, args.requests)
+            held, page_ok = stream_capacity(base, args.streams)
+        finally:
+            process.terminate()
+            process.wait()
+        print(f"{mode:<6} traffic: {rate:7.1f} req/s  p50 {p50 * 1000:7.0f} ms  "
+              f"p95 {p95 * 1000:7.0f} ms | streams held: {held:4d}  "
+              f"page while held: {'ok' if page_ok else 'timed out'}")
+    upstream.shutdown()
+
+
+if __name__ == '__main__':
+    main()
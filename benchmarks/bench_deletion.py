@@ -0,0 +1,63 @@
+"""
+Benchmark: deleting a user and a vehicle that each own many child rows
+
+    python benchmarks/bench_deletion.py --children 100000
+"""
+
+import argparse
+from datetime import datetime
+
+from common import load_app, timed
+
+
+def seed(db, children):
+    from models import User, Vehicle, Comment, Rating
+
+    owner = User(username='bench_owner', email='owner@bench.local', password_hash='x')
+    vehicle = Vehicle(license_plate='BENCH1')
+    db.session.add_all([owner, vehicle])
+    db.session.flush()
+
+    now = datetime.utcnow()
+    # The user writes `children` comments on the vehicle ...
+    db.session.execute(Comment.__table__.insert(), [
+        {'vehicle_id': vehicle.id, 'user_id': owner.id, 'content': f'comment {i}',
+         'reports': 0, 'report_priority': 0, 'helpful_votes': 0,
+         'unhelpful_votes': 0, 'created_at': now} for i in range(children)])
+
+    # ... and the vehicle is rated by `children` distinct users
+    db.session.execute(User.__table__.insert(), [
+        {'username': f'bench_{i}', 'email': f'bench_{i}@bench.local',
+         'password_hash': 'x', 'is_admin': False, 'created_at': now}
+        for i in range(children)])
+    rater_ids = [row.id for row in db.session.query(User.id).filter(
+        User.username.like('bench\\_%', escape='\\'))]
+    db.session.execute(Rating.__table__.insert(), [
+        {'vehicle_id': vehicle.id, 'user_id': user_id, 'rating': 1 + i % 5,
+         'created_at': now} for i, user_id in enumerate(rater_ids)])
+    db.session.commit()
+    return owner.id, vehicle.id
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--children', type=int, default=100000)
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    app, db = load_app()
+    from deletion import delete_user, delete_vehicle
+
+    with app.app_context():
+        with timed('seed', args.children * 3):
+            owner_id, vehicle_id = seed(db, args.children)
+
+        with timed(f'delete_user ({args.children} comments)', args.children):
+            delete_user(owner_id, chunk_size=args.chunk_size)
+
+        with timed(f'delete_vehicle ({args.children} ratings)', args.children):
+            delete_vehicle(vehicle_id, chunk_size=args.chunk_size)
+
+
+if __name__ == '__main__':
+    main()
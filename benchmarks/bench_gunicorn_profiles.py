@@ -0,0 +1,167 @@
+"""
+Benchmark: memory per worker and throughput of gunicorn configurations
+
+    python benchmarks/bench_gunicorn_profiles.py --clients 32 --seconds 10
+
+Each configuration from gunicorn.conf.py's knobs is started against the
+same scratch SQLite database and the fake TomTom upstream, loaded with
+``--clients`` concurrent callers for ``--seconds`` (vehicle pages plus
+traffic proxy calls that wait on the upstream), and then measured:
+  * RSS per worker, and PSS/USS, which count pages shared copy-on-write
+    with the master once per sharer and not at all (Linux only);
+  * requests per second and p95 latency of the mixed load.
+"""
+
+import argparse
+import itertools
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+
+import requests
+
+from common import ROOT, load_app
+from fake_tomtom import start_fake_tomtom
+from bench_asgi_concurrency import free_port
+
+CONFIGS = {
+    'sync-4': {'GUNICORN_WORKER_CLASS': 'sync', 'WEB_CONCURRENCY': '4',
+               'GUNICORN_PRELOAD': 'false'},
+    'sync-4-preload': {'GUNICORN_WORKER_CLASS': 'sync', 'WEB_CONCURRENCY': '4'},
+    'gthread-2x8-preload': {'WEB_CONCURRENCY': '2', 'GUNICORN_THREADS': '8'},
+    'gthread-4x8-preload': {'WEB_CONCURRENCY': '4', 'GUNICORN_THREADS': '8'},
+}
+
+PLATES = [f'WB{i:05d}' for i in range(50)]
+
+
+def seed(db):
+    from models import User, Vehicle, Rating
+
+    now = datetime.utcnow()
+    db.session.execute(User.__table__.insert(), [
+        {'username': f'bench_{i}', 'email': f'bench_{i}@bench.local', 'password_hash': 'x',
+         'is_admin': False, 'created_at': now} for i in range(20)])
+    db.session.execute(Vehicle.__table__.insert(), [
+        {'license_plate': plate, 'is_blocked': False, 'created_at': now, 'updated_at': now}
+        for plate in PLATES])
+    db.session.execute(Rating.__table__.insert(), [
+        {'vehicle_id': v, 'user_id': u, 'rating': 1 + (u + v) % 5, 'created_at': now}
+        for v in range(1, len(PLATES) + 1) for u in range(1, 21)])
+    db.session.commit()
+
+
+def memory(pid):
+    """(RSS, PSS, USS) of a process in MiB"""
+    fields = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                fields[parts[0].rstrip(':')] = int(parts[1]) / 1024
+    return (fields['Rss'], fields['Pss'],
+            fields['Private_Clean'] + fields['Private_Dirty'])
+
+
+def worker_pids(master):
+    with open(f'/proc/{master}/task/{master}/children') as f:
+        return [int(pid) for pid in f.read().split()]
+
+
+def start_server(env, port, expected_workers):
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py',
+         '--bind', f'127.0.0.1:{port}', 'main:app'],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base = f'http://127.0.0.1:{port}'
+    for _ in range(150):
+        try:
+            requests.get(f'{base}/login', timeout=1)
+            if len(worker_pids(process.pid)) >= expected_workers:
+                return process, base
+        except (requests.RequestException, OSError):
+            pass
+        time.sleep(0.2)
+    process.kill()
+    raise RuntimeError('gunicorn did not start')
+
+
+def load(base, clients, seconds):
+    deadline = time.perf_counter() + seconds
+    latencies, errors = [], []
+    viewports = itertools.count()
+
+    def client(n):
+        session = requests.Session()
+        i = 0
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                if i % 2:
+                    lng = 14.0 + next(viewports) * 0.1
+                    response = session.get(f'{base}/api/tomtom-traffic', timeout=30, params={
+                        'zoom': 13, 'bbox': f'{lng},52.20,{lng + 0.05},52.24'})
+                else:
+                    response = session.get(f'{base}/vehicle/{PLATES[(n + i) % len(PLATES)]}',
+                                           timeout=30)
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - start)
+            except requests.RequestException:
+                errors.append(1)
+            i += 1
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    p95 = latencies[int(len(latencies) * 0.95)] if latencies else float('nan')
+    return len(latencies) / elapsed, p95, len(errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='Simulated upstream latency per request (s)')
+    parser.add_argument('--configs', nargs='+', default=list(CONFIGS), choices=list(CONFIGS))
+    args = parser.parse_args()
+
+    app, db = load_app()
+    with app.app_context():
+        seed(db)
+    upstream, url = start_fake_tomtom(latency=args.latency)
+
+    print(f"{'config':<22}{'workers':>8}{'RSS/w':>8}{'PSS/w':>8}{'USS/w':>8}"
+          f"{'PSS total':>11}{'req/s':>8}{'p95 ms':>8}{'errors':>7}")
+    for name in args.configs:
+        env = dict(os.environ, **CONFIGS[name],
+                   TOMTOM_API_KEY='bench', TOMTOM_FLOW_URL=url, TOMTOM_GRID_POINTS='4',
+                   CREDENTIAL_WORKERS='0', GUNICORN_MAX_REQUESTS='0')
+        expected = int(CONFIGS[name]['WEB_CONCURRENCY'])
+        process, base = start_server(env, free_port(), expected)
+        try:
+            rate, p95, errors = load(base, args.clients, args.seconds)
+            workers = [memory(pid) for pid in worker_pids(process.pid)]
+            master = memory(process.pid)
+        finally:
+            process.terminate()
+            process.wait()
+        rss, pss, uss = (statistics.mean(column) for column in zip(*workers))
+        total = master[1] + sum(w[1] for w in workers)
+        print(f"{name:<22}{len(workers):>8}{rss:>8.1f}{pss:>8.1f}{uss:>8.1f}"
+              f"{total:>11.1f}{rate:>8.1f}{p95 * 1000:>8.0f}{errors:>7}")
+    upstream.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Benchmark: password verification throughput (logins per second per core)
+
+    python benchmarks/bench_password_hashing.py --methods scrypt:32768:8:1 pbkdf2:sha256:600000
+"""
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from credentials import CredentialService  # noqa: E402
+
+
+class _Config:
+    def __init__(self, **config):
+        self.config = config
+        self.extensions = {}
+
+
+def run(method, workers, logins, clients):
+    service = CredentialService()
+    service.init_app(_Config(PASSWORD_HASH_METHOD=method,
+                             CREDENTIAL_WORKERS=workers,
+                             CREDENTIAL_MAX_PENDING=max(clients, 1),
+                             CREDENTIAL_TIMEOUT=60))
+    stored = service.hash_password('correct horse battery staple')
+
+    # Warm the pool up so process start-up is not measured
+    service.verify_password(stored, 'warm-up')
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        results = list(pool.map(
+            lambda _: service.verify_password(stored, 'correct horse battery staple'),
+            range(logins)))
+    elapsed = time.perf_counter() - start
+    service.shutdown()
+
+    assert all(results)
+    rate = logins / elapsed
+    cores = max(workers, 1)
+    print(f"{method:<24} workers={workers:<2} {rate:8.1f} logins/s "
+          f"{rate / cores:8.1f} logins/s/core")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--methods', nargs='+',
+                        default=['scrypt:32768:8:1', 'scrypt:16384:8:1', 'pbkdf2:sha256:600000'])
+    parser.add_argument('--workers', nargs='+', type=int,
+                        default=[0, 1, os.cpu_count() or 1])
+    parser.add_argument('--logins', type=int, default=50)
+    parser.add_argument('--clients', type=int, default=8)
+    args = parser.parse_args()
+
+    for method in args.methods:
+        for workers in args.workers:
+            run(method, workers, args.logins, args.clients)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+Benchmark: license plate validation hot path
+
+    python benchmarks/bench_plate_validation.py --plates 100000 --repeat 5
+
+Compares the old per-request handling (``.strip().upper()`` followed by an
+uncompiled ``re.match`` on an upper-cased, space-stripped copy) with
+``plate_format.canonical_plate`` on a mix of canonical and hand-typed input.
+"""
+
+import argparse
+import os
+import random
+import re
+import string
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from plate_format import canonical_plate, classify_plate  # noqa: E402
+
+
+def legacy_validate(plate):
+    plate = plate.strip().upper()
+    if not plate:
+        return None
+    if not re.match(r'^[A-Z0-9]+$', plate.upper().replace(' ', '')):
+        return None
+    return plate
+
+
+def sample_plates(count, canonical_share, seed=0):
+    rng = random.Random(seed)
+    plates = []
+    for _ in range(count):
+        district = ''.join(rng.choices(string.ascii_uppercase, k=rng.choice((2, 3))))
+        number = ''.join(rng.choices(string.digits, k=7 - len(district) + rng.randint(0, 1)))
+        if rng.random() < canonical_share:
+            plates.append(district + number)
+        else:
+            plates.append(f" {district.lower()} {number} ")
+    return plates
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--plates', type=int, default=100000)
+    parser.add_argument('--canonical-share', type=float, default=0.8,
+                        help='Fraction of input that is already canonical')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    plates = sample_plates(args.plates, args.canonical_share)
+    canonical = [canonical_plate(p) for p in plates]
+    candidates = {
+        'legacy strip/upper + re.match': lambda: [legacy_validate(p) for p in plates],
+        'canonical_plate': lambda: [canonical_plate(p) for p in plates],
+        'classify_plate (canonical input)': lambda: [classify_plate(p) for p in canonical],
+    }
+
+    for label, fn in candidates.items():
+        best = min(timeit.repeat(fn, number=1, repeat=args.repeat))
+        print(f"{label:<34} {best * 1e9 / len(plates):8.1f} ns/plate")
+
+
+if __name__ == '__main__':
+    main()
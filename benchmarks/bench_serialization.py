@@ -0,0 +1,125 @@
+"""
+Benchmark: JSON list responses from ORM objects vs. row schemas
+
+    python benchmarks/bench_serialization.py --incidents 20000 --repeat 5
+
+Serializes the newest ``--incidents`` incidents the way list endpoints did
+(ORM objects, a dict per object, jsonify) and through serialization.py
+(column query, compiled schema, one object per row or columnar), with the
+standard library encoder and, when installed, orjson. Reports the best time
+per response, split into query and encoding, and the payload size.
+"""
+
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+
+from common import load_app
+
+TYPES = ['aggressive_driving', 'poor_parking', 'traffic_violation', 'other']
+
+
+def seed(db, count):
+    from models import User, Incident
+
+    now = datetime.utcnow()
+    db.session.execute(User.__table__.insert(), [
+        {'username': 'bench', 'email': 'bench@bench.local', 'password_hash': 'x',
+         'is_admin': False, 'created_at': now}])
+    rng = random.Random(1)
+    db.session.execute(Incident.__table__.insert(), [
+        {'user_id': 1, 'license_plate': f'WA{i % 99999:05d}',
+         'latitude': 52.1 + rng.random() * 0.3, 'longitude': 20.8 + rng.random() * 0.4,
+         'incident_type': TYPES[i % len(TYPES)],
+         'description': 'Zajechał drogę na skrzyżowaniu bez kierunkowskazu',
+         'severity': 1 + i % 5, 'is_verified': i % 7 == 0, 'corroborations': 1 + i % 3,
+         'created_at': now - timedelta(seconds=i)} for i in range(count)])
+    db.session.commit()
+
+
+def orm_jsonify(db, limit):
+    from flask import jsonify
+    from models import Incident
+
+    start = time.perf_counter()
+    incidents = Incident.query.order_by(Incident.created_at.desc()).limit(limit).all()
+    payload = [{
+        'id': incident.id,
+        'latitude': incident.latitude,
+        'longitude': incident.longitude,
+        'license_plate': incident.license_plate,
+        'incident_type': incident.incident_type,
+        'description': incident.description,
+        'severity': incident.severity,
+        'corroborations': incident.corroborations,
+        'is_verified': incident.is_verified,
+        'created_at': incident.created_at.isoformat()
+    } for incident in incidents]
+    queried = time.perf_counter()
+    body = jsonify({'incidents': payload}).get_data()
+    return queried - start, time.perf_counter() - queried, len(body)
+
+
+def schema_rows(db, limit, columnar):
+    from sqlalchemy import select
+    from app import INCIDENT_MAP_SCHEMA
+    from models import Incident
+    from serialization import json_response
+
+    start = time.perf_counter()
+    rows = db.session.execute(
+        select(*(getattr(Incident, name) for name in INCIDENT_MAP_SCHEMA.names))
+        .order_by(Incident.created_at.desc()).limit(limit))
+    if columnar:
+        payload = INCIDENT_MAP_SCHEMA.dump_columns(rows)
+    else:
+        payload = {'incidents': INCIDENT_MAP_SCHEMA.dump(rows)}
+    queried = time.perf_counter()
+    body = json_response(payload).get_data()
+    return queried - start, time.perf_counter() - queried, len(body)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--incidents', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    app, db = load_app()
+    import serialization
+
+    with app.app_context():
+        seed(db, args.incidents)
+
+    encoders = [('json', None)]
+    if serialization.orjson is not None:
+        encoders.append(('orjson', serialization.orjson))
+    else:
+        print("orjson is not installed, measuring the standard library encoder only")
+
+    cases = [('ORM objects + jsonify', 'json', orm_jsonify, {})]
+    for encoder, _ in encoders:
+        cases.append((f'row schema, objects ({encoder})', encoder, schema_rows, {'columnar': False}))
+        cases.append((f'row schema, columnar ({encoder})', encoder, schema_rows, {'columnar': True}))
+
+    print(f"{'approach':<32}{'total ms':>10}{'query+build':>13}{'encode':>9}{'KiB':>9}")
+    orjson_module = serialization.orjson
+    for label, encoder, run, kwargs in cases:
+        serialization.orjson = orjson_module if encoder == 'orjson' else None
+        best = None
+        for _ in range(args.repeat):
+            with app.test_request_context():
+                result = run(db, args.incidents, **kwargs)
+                db.session.remove()
+            if best is None or sum(result[:2]) < sum(best[:2]):
+                best = result
+        build, encode, size = best
+        print(f"{label:<32}{(build + encode) * 1000:>10.1f}{build * 1000:>13.1f}"
+              f"{encode * 1000:>9.1f}{size / 1024:>9.0f}")
+    serialization.orjson = orjson_module
+
+
+if __name__ == '__main__':
+    main()
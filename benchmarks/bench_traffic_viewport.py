@@ -0,0 +1,63 @@
+"""
+Benchmark: viewport traffic flow fan-out against a local fake TomTom
+
+    python benchmarks/bench_traffic_viewport.py --points 25 --latency 0.05
+
+Times one viewport request sampled point by point on a single worker
+against the pooled concurrent client, and reports how many sampled points
+collapsed into shared segments.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+from flask import Flask
+
+from fake_tomtom import start_fake_tomtom
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from traffic import TrafficFlowClient  # noqa: E402
+
+# Central Warsaw at roughly zoom 13
+VIEWPORT = (20.95, 52.20, 21.07, 52.26)
+
+
+def make_client(url, workers, points):
+    app = Flask('bench')
+    app.config.update(TOMTOM_API_KEY='bench', TOMTOM_FLOW_URL=url,
+                      TOMTOM_MAX_WORKERS=workers, TOMTOM_GRID_POINTS=points,
+                      TOMTOM_TIMEOUT=30)
+    return TrafficFlowClient(app)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--points', type=int, default=25)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='Simulated upstream latency per request (s)')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    server, url = start_fake_tomtom(latency=args.latency)
+    try:
+        for label, workers in (('sequential', 1), (f'{args.workers} workers', args.workers)):
+            client = make_client(url, workers, args.points)
+            client.fetch_viewport(VIEWPORT, 13)  # open the pooled connections
+            best = float('inf')
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                data = client.fetch_viewport(VIEWPORT, 13)
+                best = min(best, time.perf_counter() - start)
+            print(f"{label:<12} {best * 1000:8.1f} ms/viewport  "
+                  f"{data['points']} points -> {len(data['segments'])} segments, "
+                  f"{data['failed']} failed")
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+"""
+Shared setup for the benchmark scripts
+Points the application at a throwaway SQLite database (or BENCH_DATABASE_URL)
+before importing it, so benchmarks never touch the configured database
+"""
+
+import os
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_app():
+    """
+    Import the Flask app against a scratch database
+    Returns:
+        tuple: (app, db)
+    """
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+
+    url = os.environ.get('BENCH_DATABASE_URL')
+    if not url:
+        path = os.path.join(tempfile.mkdtemp(prefix='driver-bench-'), 'bench.db')
+        url = f'sqlite:///{path}'
+    os.environ['DATABASE_URL'] = url
+    os.environ.setdefault('FLASK_DEBUG', 'False')
+
+    from app import app
+    from models import db
+    return app, db
+
+
+@contextmanager
+def timed(label, count=None):
+    """Print the wall time of the block, and the rate if ``count`` is given"""
+    start = time.perf_counter()
+    yield
+    elapsed = time.perf_counter() - start
+    if count:
+        print(f"{label}: {elapsed:.3f}s ({count / elapsed:,.0f}/s)")
+    else:
+        print(f"{label}: {elapsed:.3f}s")
@@ -0,0 +1,116 @@
+"""
+Local stand-in for the TomTom flowSegmentData endpoint
+
+    python benchmarks/fake_tomtom.py --port 8765 --latency 0.05
+    TOMTOM_API_KEY=fake \\
+    TOMTOM_FLOW_URL='http://127.0.0.1:8765/traffic/services/4/flowSegmentData/absolute/{zoom}/json' \\
+    python main.py
+
+Every point snaps to a road on a fixed lattice (0.02 degrees), so nearby
+points return the same segment just like the real service. Speeds are
+derived from the segment position, so responses are deterministic.
+"""
+
+import argparse
+import json
+import re
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+LATTICE = 0.02
+PATH = re.compile(r'^/traffic/services/4/flowSegmentData/absolute/(\d+)/json$')
+
+
+def segment_for(lat, lng):
+    """Flow response for the lattice road nearest to a point"""
+    row = round(lat / LATTICE)
+    col = int(lng // LATTICE)
+    seed = zlib.crc32(f'{row},{col}'.encode())
+    free_flow = 30 + seed % 60
+    return {
+        'flowSegmentData': {
+            'frc': f'FRC{seed % 7}',
+            'currentSpeed': max(3, free_flow - (seed >> 8) % free_flow),
+            'freeFlowSpeed': free_flow,
+            'currentTravelTime': 60,
+            'freeFlowTravelTime': 45,
+            'confidence': 0.9,
+            'roadClosure': seed % 97 == 0,
+            'coordinates': {'coordinate': [
+                {'latitude': row * LATTICE, 'longitude': (col + i / 4) * LATTICE}
+                for i in range(5)
+            ]},
+        }
+    }
+
+
+class FakeTomTomHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real API
+    disable_nagle_algorithm = True
+    latency = 0.0
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        try:
+            if not PATH.match(url.path) or 'key' not in query:
+                raise ValueError('bad request')
+            lat, lng = (float(v) for v in query['point'][0].split(','))
+        except (KeyError, ValueError):
+            self._send(400, {'error': 'Invalid request'})
+            return
+        if self.latency:
+            time.sleep(self.latency)
+        self._send(200, segment_for(lat, lng))
+
+    def _send(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_fake_tomtom(port=0, latency=0.0):
+    """
+    Run the fake upstream on a background thread
+    Args:
+        port: TCP port, 0 picks a free one
+        latency: Seconds added to every response
+    Returns:
+        tuple: (server, flow URL template for TOMTOM_FLOW_URL)
+    """
+    handler = type('Handler', (FakeTomTomHandler,), {'latency': latency})
+    # Default listen backlog of 5 turns bursts of connects into SYN retries
+    server_class = type('Server', (ThreadingHTTPServer,), {'request_queue_size': 1024})
+    server = server_class(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address
+    return server, f'http://{host}:{port}/traffic/services/4/flowSegmentData/absolute/{{zoom}}/json'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.05)
+    args = parser.parse_args()
+
+    server, url = start_fake_tomtom(args.port, args.latency)
+    print(f"Fake TomTom flow API on {url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+"""
+Command line tools for the Driver Rating Application
+Registered on the Flask app, run with e.g. ``flask --app main purge-comments --user spammer``
+"""
+
+import click
+
+from models import db, User, Vehicle
+from deletion import delete_user, delete_vehicle
+from moderation import clear_reports, delete_comments, purge_user_comments, set_vehicles_blocked
+from plate_format import canonical_plate
+from plates import merge_duplicate_plates
+from incidents import dedupe_incidents
+from traffic_history import traffic_history
+from migrations import migrate
+
+
+def _read_lines(path):
+    with open(path, encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def _read_ids(path):
+    try:
+        return [int(line) for line in _read_lines(path)]
+    except ValueError as e:
+        raise click.BadParameter(f"Invalid ID in {path}: {e}")
+
+
+def _progress(label):
+    def report(done, total):
+        click.echo(f"{label}: {done}/{total}")
+    return report
+
+
+@click.command('purge-comments')
+@click.option('--ids-file', type=click.Path(exists=True, dir_okay=False),
+              help='File with one comment ID per line')
+@click.option('--user', 'username', help='Delete every comment by this user')
+@click.option('--chunk-size', default=1000, show_default=True,
+              help='Comments deleted per transaction')
+def purge_comments_command(ids_file, username, chunk_size):
+    """Delete comments in committed chunks"""
+    if bool(ids_file) == bool(username):
+        raise click.UsageError('Use exactly one of --ids-file or --user')
+
+    if username:
+        user = User.query.filter_by(username=username).first()
+        if not user:
+            raise click.BadParameter(f"Unknown user: {username}")
+        deleted = purge_user_comments(user.id, chunk_size=chunk_size,
+                                      progress=_progress('Deleted'))
+    else:
+        deleted = delete_comments(_read_ids(ids_file), chunk_size=chunk_size,
+                                  progress=_progress('Deleted'))
+        db.session.commit()
+
+    click.echo(f"Deleted {deleted} comments")
+
+
+@click.command('clear-reports')
+@click.option('--ids-file', type=click.Path(exists=True, dir_okay=False),
+              required=True, help='File with one comment ID per line')
+@click.option('--chunk-size', default=1000, show_default=True)
+def clear_reports_command(ids_file, chunk_size):
+    """Dismiss reports for many comments"""
+    cleared = clear_reports(_read_ids(ids_file), chunk_size=chunk_size,
+                            progress=_progress('Cleared'))
+    db.session.commit()
+    click.echo(f"Cleared reports on {cleared} comments")
+
+
+@click.command('block-plates')
+@click.argument('plates', nargs=-1)
+@click.option('--file', 'plates_file', type=click.Path(exists=True, dir_okay=False),
+              help='File with one license plate per line')
+@click.option('--unblock', is_flag=True, help='Unblock instead of block')
+def block_plates_command(plates, plates_file, unblock):
+    """Block or unblock vehicles by license plate"""
+    plates = list(plates)
+    if plates_file:
+        plates.extend(_read_lines(plates_file))
+    invalid = [p for p in plates if not canonical_plate(p)]
+    if invalid:
+        raise click.BadParameter(f"Invalid license plates: {', '.join(invalid)}")
+    plates = [canonical_plate(p) for p in plates]
+    if not plates:
+        raise click.UsageError('No license plates given')
+
+    updated, missing = set_vehicles_blocked(plates, blocked=not unblock)
+    db.session.commit()
+
+    click.echo(f"{'Unblocked' if unblock else 'Blocked'} {updated} vehicles")
+    if missing:
+        click.echo(f"Unknown plates: {', '.join(missing)}")
+
+
+def _table_progress(table, done, total):
+    click.echo(f"{table}: {done}/{total}")
+
+
+@click.command('delete-user')
+@click.argument('username')
+@click.option('--chunk-size', default=1000, show_default=True,
+              help='Rows deleted per transaction')
+@click.confirmation_option(prompt='Delete this account and all of its content?')
+def delete_user_command(username, chunk_size):
+    """Delete a user account with all ratings, comments and incidents"""
+    user = User.query.filter_by(username=username).first()
+    if not user:
+        raise click.BadParameter(f"Unknown user: {username}")
+
+    counts = delete_user(user.id, chunk_size=chunk_size, progress=_table_progress)
+    click.echo(f"Deleted user {username}: {counts}")
+
+
+@click.command('delete-vehicle')
+@click.argument('license_plate')
+@click.option('--chunk-size', default=1000, show_default=True,
+              help='Rows deleted per transaction')
+@click.confirmation_option(prompt='Delete this vehicle and all of its ratings and comments?')
+def delete_vehicle_command(license_plate, chunk_size):
+    """Delete a vehicle with all ratings, comments and favorites"""
+    license_plate = canonical_plate(license_plate) or license_plate
+    vehicle = Vehicle.query.filter_by(license_plate=license_plate).first()
+    if not vehicle:
+        raise click.BadParameter(f"Unknown vehicle: {license_plate}")
+
+    counts = delete_vehicle(vehicle.id, chunk_size=chunk_size, progress=_table_progress)
+    click.echo(f"Deleted vehicle {license_plate}: {counts}")
+
+
+@click.command('merge-plates')
+@click.option('--dry-run', is_flag=True, help='Only report what would be merged')
+def merge_plates_command(dry_run):
+    """Merge vehicles whose plates differ only in spelling and canonicalize plates"""
+    summary = merge_duplicate_plates(dry_run=dry_run, progress=_progress('Merged'))
+    verb = 'Would merge' if dry_run else 'Merged'
+    click.echo(f"{verb} {summary['groups']} plates, removing "
+               f"{summary['vehicles_removed']} duplicate vehicles")
+    if not dry_run:
+        click.echo(f"Canonicalized {summary['incidents_updated']} incident plates")
+    if summary['invalid_plates']:
+        click.echo(f"Invalid stored plates (left as is): {', '.join(summary['invalid_plates'])}")
+
+
+@click.command('dedupe-incidents')
+@click.option('--dry-run', is_flag=True, help='Only report how many duplicates exist')
+@click.option('--chunk-size', default=1000, show_default=True,
+              help='Changes per transaction')
+def dedupe_incidents_command(dry_run, chunk_size):
+    """Merge repeated reports of the same incident into corroborations"""
+    def report(done):
+        click.echo(f"Merged: {done}")
+
+    summary = dedupe_incidents(dry_run=dry_run, chunk_size=chunk_size, progress=report)
+    verb = 'Would merge' if dry_run else 'Merged'
+    click.echo(f"{verb} {summary['merged']} duplicate incidents "
+               f"from {len(summary['users'])} users; {summary['grid_cells']} grid cells "
+               f"{'missing' if dry_run else 'filled in'}")
+
+
+@click.command('traffic-profiles')
+@click.option('--weeks', type=int, help='History window (default TRAFFIC_PROFILE_WEEKS)')
+def traffic_profiles_command(weeks):
+    """Rebuild hour-of-week traffic profiles and drop expired samples"""
+    summary = traffic_history.build_profiles(weeks=weeks)
+    click.echo(f"Built {summary['profiles']} segment profiles from {summary['samples']} "
+               f"samples; pruned {summary['pruned']} expired samples")
+
+
+@click.command('migrate-db')
+def migrate_db_command():
+    """Create missing tables and bring existing ones up to the models"""
+    db.create_all()
+    applied = migrate()
+    click.echo(f"Applied {len(applied)} migrations: {', '.join(applied)}" if applied
+               else "Database is up to date")
+
+
+def init_cli(app):
+    """
+    Register command line tools with the Flask app
+    Args:
+        app: Flask application instance
+    """
+    app.cli.add_command(purge_comments_command)
+    app.cli.add_command(clear_reports_command)
+    app.cli.add_command(block_plates_command)
+    app.cli.add_command(delete_user_command)
+    app.cli.add_command(delete_vehicle_command)
+    app.cli.add_command(merge_plates_command)
+    app.cli.add_command(dedupe_incidents_command)
+    app.cli.add_command(traffic_profiles_command)
+    app.cli.add_command(migrate_db_command)
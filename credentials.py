@@ -0,0 +1,166 @@
+"""
+Password hashing service for the Driver Rating Application
+Runs CPU-bound hashing on a bounded process pool so login storms cannot pin
+every web worker, and upgrades stored hashes when the parameters change
+"""
+
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+# werkzeug's own default, spelled out so stored hashes compare equal
+DEFAULT_HASH_METHOD = 'scrypt:32768:8:1'
+
+
+class CredentialServiceBusy(Exception):
+    """Raised when too many hashing requests are already waiting, or one timed out"""
+
+
+def _hash(password, method):
+    return generate_password_hash(password, method=method)
+
+
+def _verify(password_hash, password):
+    return check_password_hash(password_hash, password)
+
+
+class CredentialService:
+    """
+    Bounded hashing pool.
+
+    ``CREDENTIAL_WORKERS`` processes do the hashing; at most
+    ``CREDENTIAL_MAX_PENDING`` requests may be queued or running per web
+    worker, beyond that callers get CredentialServiceBusy immediately instead
+    of piling up. A request that times out keeps its slot until the hash
+    actually finishes. With ``CREDENTIAL_WORKERS = 0`` hashing runs inline.
+    """
+
+    def __init__(self, app=None):
+        self.method = DEFAULT_HASH_METHOD
+        self.workers = 0
+        self.timeout = None
+        self._slots = None
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Configure the service for a Flask application
+        Args:
+            app: Flask application instance
+        """
+        app.config.setdefault('PASSWORD_HASH_METHOD',
+                              os.environ.get('PASSWORD_HASH_METHOD', DEFAULT_HASH_METHOD))
+        app.config.setdefault('CREDENTIAL_WORKERS', int(os.environ.get('CREDENTIAL_WORKERS', 2)))
+        app.config.setdefault('CREDENTIAL_MAX_PENDING',
+                              int(os.environ.get('CREDENTIAL_MAX_PENDING', 8)))
+        app.config.setdefault('CREDENTIAL_TIMEOUT', float(os.environ.get('CREDENTIAL_TIMEOUT', 10)))
+
+        self.method = app.config['PASSWORD_HASH_METHOD']
+        self.workers = app.config['CREDENTIAL_WORKERS']
+        self.timeout = app.config['CREDENTIAL_TIMEOUT']
+        self._slots = threading.BoundedSemaphore(app.config['CREDENTIAL_MAX_PENDING'])
+        app.extensions['credential_service'] = self
+
+    def _executor(self):
+        # A pool created before a fork is unusable in the child
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    # Never fork: the web worker has threads that may hold
+                    # locks the child would inherit in a locked state
+                    methods = multiprocessing.get_all_start_methods()
+                    context = multiprocessing.get_context(
+                        'forkserver' if 'forkserver' in methods else 'spawn')
+                    self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=context)
+                    self._pid = os.getpid()
+        return self._pool
+
+    def _run(self, fn, *args):
+        if not self.workers:
+            return fn(*args)
+
+        if not self._slots.acquire(blocking=False):
+            raise CredentialServiceBusy()
+        try:
+            future = self._executor().submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        # Released when the work is done, not when the caller gives up
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            logging.warning(f"Password hashing took longer than {self.timeout}s")
+            raise CredentialServiceBusy()
+
+    def hash_password(self, password):
+        """
+        Hash a password with the configured method
+        Args:
+            password: Plain text password
+        Returns:
+            str: werkzeug password hash
+        Raises:
+            CredentialServiceBusy: If the hashing queue is full
+        """
+        return self._run(_hash, password, self.method)
+
+    def verify_password(self, password_hash, password):
+        """
+        Check a password against a stored hash
+        Returns:
+            bool: True if the password matches
+        Raises:
+            CredentialServiceBusy: If the hashing queue is full
+        """
+        if not password_hash:
+            return False
+        return self._run(_verify, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        """
+        Check whether a stored hash was made with other parameters
+        Args:
+            password_hash: werkzeug hash string ("method$salt$hash")
+        Returns:
+            bool: True if the hash should be upgraded
+        """
+        return password_hash.split('$', 1)[0] != self.method
+
+    def upgrade_hash(self, user, password):
+        """
+        Rehash a user's password after a successful login if parameters changed
+        Args:
+            user: User object whose password was just verified
+            password: The verified plain text password
+        Returns:
+            bool: True if the stored hash was replaced (caller commits)
+        """
+        if not self.needs_rehash(user.password_hash):
+            return False
+        try:
+            user.password_hash = self.hash_password(password)
+        except CredentialServiceBusy:
+            # Not worth failing a login over, try again next time
+            logging.info(f"Skipping password rehash for user {user.id}, pool busy")
+            return False
+        return True
+
+    def shutdown(self):
+        if self._pool is not None and self._pid == os.getpid():
+            self._pool.shutdown(wait=False, cancel_futures=True)
+        self._pool = None
+        self._pid = None
+
+
+credential_service = CredentialService()
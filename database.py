@@ -0,0 +1,217 @@
+"""
+Database configuration for the Driver Rating Application
+Builds engine options from the environment, applies per-route statement
+timeouts, routes read-only routes to an optional replica, keeps post-commit
+work queued in the session in step with savepoints and, in strict loading
+mode, refuses lazy loads while templates render
+"""
+
+import os
+from functools import wraps
+
+from flask import before_render_template, template_rendered
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.exc import InvalidRequestError
+from sqlalchemy.sql.dml import UpdateBase
+
+REPLICA_BIND = 'replica'
+
+
+def _env_bool(name, default):
+    return os.environ.get(name, str(default)).lower() == 'true'
+
+
+class StrictLoadingError(InvalidRequestError):
+    """A query was issued for an attribute the view should have loaded up front"""
+
+
+def engine_options(url):
+    """
+    Engine options for a database URL, tunable through the environment
+    Args:
+        url: Database URL
+    Returns:
+        dict: Keyword arguments for create_engine
+    """
+    options = {
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 300)),
+        # Costs a round trip per checkout; pool_recycle already retires
+        # connections before typical server/proxy idle timeouts
+        'pool_pre_ping': _env_bool('DB_POOL_PRE_PING', False),
+    }
+    if url.startswith('sqlite'):
+        return options
+
+    options.update({
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': float(os.environ.get('DB_POOL_TIMEOUT', 10)),
+    })
+    if url.startswith('postgres'):
+        timeout_ms = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 15000))
+        options['connect_args'] = {'options': f'-c statement_timeout={timeout_ms}'}
+    return options
+
+
+class RoutingSession(Session):
+    """
+    Session that sends reads to the replica bind while the current route is
+    marked read-only with ``db_route(replica=True)``. Flushes and
+    INSERT/UPDATE/DELETE statements always go to the primary, and so does
+    everything after them in the same route: the replica may not have the
+    write yet.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and self.info.get('use_replica'):
+            if self._flushing or isinstance(clause, UpdateBase):
+                self.info['wrote_primary'] = True
+            elif not self.info.get('wrote_primary'):
+                engines = self._db.engines
+                if REPLICA_BIND in engines:
+                    return engines[REPLICA_BIND]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def configure_database(app, db):
+    """
+    Configure the primary database, optional replica and session hooks
+    Args:
+        app: Flask application instance
+        db: SQLAlchemy extension (not yet initialized)
+    """
+    database_url = os.environ.get("DATABASE_URL")
+    if not database_url:
+        raise ValueError(
+            "DATABASE_URL environment variable is required. Please set up PostgreSQL database in Replit."
+        )
+
+    app.config["SQLALCHEMY_DATABASE_URI"] = database_url
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(database_url)
+
+    replica_url = os.environ.get("DATABASE_REPLICA_URL")
+    if replica_url:
+        replica_options = engine_options(replica_url)
+        app.config["SQLALCHEMY_BINDS"] = {
+            REPLICA_BIND: dict(replica_options, url=replica_url)
+        }
+
+    @event.listens_for(db.session, 'after_begin')
+    def apply_statement_timeout(session, transaction, connection):
+        _set_statement_timeout(connection, session.info.get('statement_timeout_ms'))
+
+    configure_strict_loading(app, db)
+
+
+def _refuse_lazy_loads(orm_execute_state):
+    # Only lazy loads: eager loaders (selectinload) are relationship loads
+    # too, but have no lazy_loaded_from
+    if (orm_execute_state.session.info.get('strict_loading')
+            and orm_execute_state.lazy_loaded_from is not None):
+        raise StrictLoadingError(
+            f"Lazy load of {orm_execute_state.lazy_loaded_from.class_.__name__}"
+            f".{orm_execute_state.loader_strategy_path[-1].key} while rendering a "
+            f"template; load it in the view (joinedload/selectinload)")
+
+
+def configure_strict_loading(app, db):
+    """
+    Refuse lazy loads while templates render if DB_STRICT_LOADING is set:
+    a lazy load in a template is an N+1 hidden in a loop (meant for
+    development and tests)
+    Args:
+        app: Flask application instance
+        db: SQLAlchemy extension
+    """
+    app.config.setdefault('DB_STRICT_LOADING', _env_bool('DB_STRICT_LOADING', False))
+
+    # Shared by every app on the extension, so registered once
+    if not event.contains(db.session, 'do_orm_execute', _refuse_lazy_loads):
+        event.listen(db.session, 'do_orm_execute', _refuse_lazy_loads)
+
+    def strict_rendering(sender, template, context, **extra):
+        if sender.config['DB_STRICT_LOADING']:
+            db.session.info['strict_loading'] = True
+
+    def rendering_done(sender, template, context, **extra):
+        # After a failed render the flag stays set; the session is discarded
+        # at the end of the request anyway
+        db.session.info.pop('strict_loading', None)
+
+    before_render_template.connect(strict_rendering, app, weak=False)
+    template_rendered.connect(rendering_done, app, weak=False)
+
+
+def _set_statement_timeout(connection, timeout_ms):
+    if timeout_ms and connection.dialect.name == 'postgresql':
+        # SET LOCAL only lasts until the end of the current transaction
+        connection.exec_driver_sql(f"SET LOCAL statement_timeout = {int(timeout_ms)}")
+
+
+def pending_until_commit(session, key):
+    """
+    Keep a ``session.info`` list of post-commit work in step with rollbacks:
+    a full rollback drops the list, a rolled back savepoint only the entries
+    added inside it
+    Args:
+        session: Session or scoped_session to listen on
+        key: session.info key of the list
+    """
+    marks_key = f'{key}_savepoints'
+
+    @event.listens_for(session, 'after_transaction_create')
+    def mark_savepoint(session, transaction):
+        if transaction.nested:
+            marks = session.info.setdefault(marks_key, {})
+            marks[transaction] = len(session.info.get(key, ()))
+
+    @event.listens_for(session, 'after_soft_rollback')
+    def drop_rolled_back(session, previous_transaction):
+        if previous_transaction.parent is None:
+            session.info.pop(key, None)
+            return
+        # A failed flush only reports its own subtransaction; the savepoint
+        # around it is rolled back with it
+        savepoint = previous_transaction
+        while savepoint is not None and not savepoint.nested:
+            savepoint = savepoint.parent
+        mark = session.info.get(marks_key, {}).get(savepoint)
+        if mark is not None and key in session.info:
+            del session.info[key][mark:]
+
+    @event.listens_for(session, 'after_transaction_end')
+    def forget_savepoints(session, transaction):
+        # Rollback events come after the end, so marks live until the outermost one
+        if transaction.parent is None:
+            session.info.pop(marks_key, None)
+
+
+def db_route(db, replica=False, statement_timeout_ms=None):
+    """
+    Decorator setting database routing for a view
+    Args:
+        db: SQLAlchemy extension
+        replica: Serve the view's reads from the replica, if one is configured
+        statement_timeout_ms: Statement timeout for the view (PostgreSQL only)
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            info = db.session.info
+            if replica:
+                info['use_replica'] = True
+            if statement_timeout_ms:
+                info['statement_timeout_ms'] = statement_timeout_ms
+                if db.session().in_transaction():
+                    # e.g. admin_required already ran a query; after_begin
+                    # will not fire again for that connection
+                    _set_statement_timeout(db.session.connection(), statement_timeout_ms)
+            try:
+                return f(*args, **kwargs)
+            finally:
+                info.pop('use_replica', None)
+                info.pop('wrote_primary', None)
+                info.pop('statement_timeout_ms', None)
+        return decorated_function
+    return decorator
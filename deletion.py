@@ -0,0 +1,263 @@
+"""
+Account and vehicle deletion for the Driver Rating Application
+Removes users, vehicles and comments with batched set-based deletes while
+keeping denormalized counters (comment votes/reports, incident
+corroborations, user statistics) in step
+"""
+
+from sqlalchemy import case, delete, func, select, update
+
+from incidents import VERIFY_CORROBORATIONS
+from migrations import CASCADE_FOREIGN_KEYS, is_applied
+from models import (db, Comment, CommentVote, Favorite, Incident, IncidentCorroboration,
+                    Rating, Report, User, UserStatistics, Vehicle, RATING_REPUTATION,
+                    COMMENT_REPUTATION, HELPFUL_VOTE_REPUTATION)
+
+# Rows per statement/transaction; keeps lock times short
+DEFAULT_CHUNK_SIZE = 1000
+
+_NO_SYNC = {'synchronize_session': False}
+
+
+def chunked(items, size):
+    """
+    Split a list into consecutive chunks
+    Args:
+        items: List to split
+        size: Maximum chunk length
+    Yields:
+        list: Chunks of at most ``size`` items
+    """
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def release_rating_aggregates(rating_ids):
+    """Subtract ratings that are about to be deleted from their authors' statistics"""
+    count = select(func.count(Rating.id)).where(
+        Rating.id.in_(rating_ids),
+        Rating.user_id == UserStatistics.user_id).scalar_subquery()
+    db.session.execute(
+        update(UserStatistics).where(UserStatistics.user_id.in_(
+            select(Rating.user_id).where(Rating.id.in_(rating_ids)))).values(
+                total_ratings=UserStatistics.total_ratings - count,
+                reputation_score=UserStatistics.reputation_score -
+                count * RATING_REPUTATION),
+        execution_options=_NO_SYNC)
+
+
+def release_comment_aggregates(comment_ids):
+    """
+    Subtract comments that are about to be deleted from user statistics:
+    the authors lose the comments and the helpful votes they received
+    """
+    owned = (Comment.id.in_(comment_ids),
+             Comment.user_id == UserStatistics.user_id)
+    count = select(func.count(Comment.id)).where(*owned).scalar_subquery()
+    helpful = select(func.coalesce(func.sum(Comment.helpful_votes), 0)).where(
+        *owned).scalar_subquery()
+    db.session.execute(
+        update(UserStatistics).where(UserStatistics.user_id.in_(
+            select(Comment.user_id).where(Comment.id.in_(comment_ids)))).values(
+                total_comments=UserStatistics.total_comments - count,
+                helpful_votes=UserStatistics.helpful_votes - helpful,
+                reputation_score=UserStatistics.reputation_score -
+                count * COMMENT_REPUTATION - helpful * HELPFUL_VOTE_REPUTATION),
+        execution_options=_NO_SYNC)
+
+    # Their reports are removed by ON DELETE CASCADE
+    release_reporter_aggregates(comment_ids)
+
+
+def release_reporter_aggregates(comment_ids):
+    """Subtract all reports on the given comments from the reporters' statistics"""
+    reports = select(func.count(Report.id)).where(
+        Report.comment_id.in_(comment_ids),
+        Report.user_id == UserStatistics.user_id).scalar_subquery()
+    db.session.execute(
+        update(UserStatistics).where(UserStatistics.user_id.in_(
+            select(Report.user_id).where(Report.comment_id.in_(comment_ids)))).values(
+                total_reports=UserStatistics.total_reports - reports),
+        execution_options=_NO_SYNC)
+
+
+def release_vote_aggregates(vote_ids):
+    """Subtract votes that are about to be deleted from comment counters and authors' reputation"""
+    def votes_on_comment(vote_type):
+        return select(func.count(CommentVote.id)).where(
+            CommentVote.id.in_(vote_ids),
+            CommentVote.comment_id == Comment.id,
+            CommentVote.vote_type == vote_type).scalar_subquery()
+
+    db.session.execute(
+        update(Comment).where(Comment.id.in_(
+            select(CommentVote.comment_id).where(CommentVote.id.in_(vote_ids)))).values(
+                helpful_votes=Comment.helpful_votes - votes_on_comment('helpful'),
+                unhelpful_votes=Comment.unhelpful_votes - votes_on_comment('unhelpful')),
+        execution_options=_NO_SYNC)
+
+    helpful = select(func.count(CommentVote.id)).join(
+        Comment, Comment.id == CommentVote.comment_id).where(
+            CommentVote.id.in_(vote_ids),
+            CommentVote.vote_type == 'helpful',
+            Comment.user_id == UserStatistics.user_id).scalar_subquery()
+    db.session.execute(
+        update(UserStatistics).where(UserStatistics.user_id.in_(
+            select(Comment.user_id).join(
+                CommentVote, CommentVote.comment_id == Comment.id).where(
+                    CommentVote.id.in_(vote_ids)))).values(
+                        helpful_votes=UserStatistics.helpful_votes - helpful,
+                        reputation_score=UserStatistics.reputation_score -
+                        helpful * HELPFUL_VOTE_REPUTATION),
+        execution_options=_NO_SYNC)
+
+
+def release_report_aggregates(report_ids):
+    """Subtract reports that are about to be deleted from the reported comments' counters"""
+    count = select(func.count(Report.id)).where(
+        Report.id.in_(report_ids),
+        Report.comment_id == Comment.id).scalar_subquery()
+    db.session.execute(
+        update(Comment).where(Comment.id.in_(
+            select(Report.comment_id).where(Report.id.in_(report_ids)))).values(
+                reports=Comment.reports - count,
+                report_priority=case((Comment.reports - count <= 0, 0),
+                                     else_=Comment.report_priority)),
+        execution_options=_NO_SYNC)
+
+
+def release_corroboration_aggregates(corroboration_ids):
+    """
+    Subtract corroborations that are about to be deleted from their incidents'
+    counters; incidents falling below the threshold are no longer verified
+    """
+    count = select(func.count(IncidentCorroboration.id)).where(
+        IncidentCorroboration.id.in_(corroboration_ids),
+        IncidentCorroboration.incident_id == Incident.id).scalar_subquery()
+    db.session.execute(
+        update(Incident).where(Incident.id.in_(
+            select(IncidentCorroboration.incident_id).where(
+                IncidentCorroboration.id.in_(corroboration_ids)))).values(
+                    corroborations=Incident.corroborations - count,
+                    is_verified=Incident.corroborations - count >= VERIFY_CORROBORATIONS),
+        execution_options=_NO_SYNC)
+
+
+def delete_dependents(table, condition):
+    """
+    Delete the rows ON DELETE CASCADE would remove with the matching rows,
+    on databases whose foreign keys predate it (see migrations.py)
+    Args:
+        table: Table the rows are deleted from
+        condition: SQL expression selecting those rows
+    """
+    if is_applied(CASCADE_FOREIGN_KEYS):
+        return
+    for child in db.metadata.sorted_tables:
+        for fk in child.foreign_key_constraints:
+            if fk.referred_table is not table or fk.ondelete != 'CASCADE':
+                continue
+            column, = fk.columns
+            child_condition = column.in_(select(fk.elements[0].column).where(condition))
+            delete_dependents(child, child_condition)
+            db.session.execute(delete(child).where(child_condition),
+                               execution_options=_NO_SYNC)
+
+
+def delete_in_chunks(model, condition, release=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                     progress=None):
+    """
+    Delete matching rows one committed chunk at a time
+    Args:
+        model: Model class with an integer ``id`` primary key
+        condition: SQL expression selecting the rows to delete
+        release: Optional callback(ids) run before each chunk is deleted
+        chunk_size: Rows per transaction
+        progress: Optional callback(table name, done, total)
+    Returns:
+        int: Number of deleted rows
+    """
+    total = db.session.execute(
+        select(func.count(model.id)).where(condition)).scalar()
+    deleted = 0
+    while deleted < total:
+        ids = db.session.execute(
+            select(model.id).where(condition).order_by(model.id).limit(
+                chunk_size)).scalars().all()
+        if not ids:
+            break
+        if release:
+            release(ids)
+        delete_dependents(model.__table__, model.id.in_(ids))
+        deleted += db.session.execute(
+            delete(model).where(model.id.in_(ids)),
+            execution_options=_NO_SYNC).rowcount
+        db.session.commit()
+        if progress:
+            progress(model.__tablename__, deleted, total)
+    return deleted
+
+
+def delete_user(user_id, chunk_size=DEFAULT_CHUNK_SIZE, progress=None):
+    """
+    Delete a user account and everything it owns
+    Args:
+        user_id: User ID
+        chunk_size: Rows per transaction
+        progress: Optional callback(table name, done, total)
+    Returns:
+        dict of deleted row counts per table, or None if the user does not exist
+    """
+    if db.session.get(User, user_id) is None:
+        return None
+
+    options = dict(chunk_size=chunk_size, progress=progress)
+    counts = {
+        'comment_vote': delete_in_chunks(CommentVote, CommentVote.user_id == user_id,
+                                         release_vote_aggregates, **options),
+        'report': delete_in_chunks(Report, Report.user_id == user_id,
+                                   release_report_aggregates, **options),
+        'comment': delete_in_chunks(Comment, Comment.user_id == user_id,
+                                    release_comment_aggregates, **options),
+        # The user's own statistics go with the account, nothing to release
+        'rating': delete_in_chunks(Rating, Rating.user_id == user_id, **options),
+        'incident_corroboration': delete_in_chunks(
+            IncidentCorroboration, IncidentCorroboration.user_id == user_id,
+            release_corroboration_aggregates, **options),
+        'incident': delete_in_chunks(Incident, Incident.user_id == user_id, **options),
+        'favorite': delete_in_chunks(Favorite, Favorite.user_id == user_id, **options),
+    }
+
+    # Remaining children (statistics) are removed by ON DELETE CASCADE
+    delete_dependents(User.__table__, User.id == user_id)
+    db.session.execute(delete(User).where(User.id == user_id), execution_options=_NO_SYNC)
+    db.session.commit()
+    return counts
+
+
+def delete_vehicle(vehicle_id, chunk_size=DEFAULT_CHUNK_SIZE, progress=None):
+    """
+    Delete a vehicle with its ratings, comments and favorites
+    Args:
+        vehicle_id: Vehicle ID
+        chunk_size: Rows per transaction
+        progress: Optional callback(table name, done, total)
+    Returns:
+        dict of deleted row counts per table, or None if the vehicle does not exist
+    """
+    if db.session.get(Vehicle, vehicle_id) is None:
+        return None
+
+    options = dict(chunk_size=chunk_size, progress=progress)
+    counts = {
+        'rating': delete_in_chunks(Rating, Rating.vehicle_id == vehicle_id,
+                                   release_rating_aggregates, **options),
+        'comment': delete_in_chunks(Comment, Comment.vehicle_id == vehicle_id,
+                                    release_comment_aggregates, **options),
+        'favorite': delete_in_chunks(Favorite, Favorite.vehicle_id == vehicle_id, **options),
+    }
+
+    delete_dependents(Vehicle.__table__, Vehicle.id == vehicle_id)
+    db.session.execute(delete(Vehicle).where(Vehicle.id == vehicle_id), execution_options=_NO_SYNC)
+    db.session.commit()
+    return counts
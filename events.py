@@ -0,0 +1,310 @@
+"""
+Live event fan-out for the Driver Rating Application
+Publishes new ratings, comments and incidents to Server-Sent Events clients
+through an in-process pub/sub, relayed across workers by Postgres LISTEN/NOTIFY
+"""
+
+import collections
+import itertools
+import json
+import logging
+import os
+import select
+import threading
+import time
+
+from sqlalchemy import event, text
+
+from database import pending_until_commit
+from models import db
+from plate_format import canonical_plate
+
+CHANNEL = 'driver_events'
+
+# Postgres rejects NOTIFY payloads above 8000 bytes
+MAX_TEXT_LENGTH = 280
+
+
+class Subscription:
+    """
+    A single stream client with a bounded buffer.
+    When the client is too slow the oldest events are dropped, so one stalled
+    connection can never grow memory without limit.
+    """
+
+    __slots__ = ('plates', 'bbox', 'types', 'buffer', 'dropped', '_cond', 'closed')
+
+    def __init__(self, plates=None, bbox=None, types=None, buffer_size=100):
+        self.plates = frozenset(plates) if plates else None
+        self.bbox = bbox
+        self.types = frozenset(types) if types else None
+        self.buffer = collections.deque(maxlen=buffer_size)
+        self.dropped = 0
+        self._cond = threading.Condition()
+        self.closed = False
+
+    def matches(self, evt):
+        """
+        Check whether an event passes this subscription's filters
+        Args:
+            evt: Event dict
+        Returns:
+            bool: True if every configured filter matches
+        """
+        if self.types and evt['type'] not in self.types:
+            return False
+        if self.plates and evt.get('license_plate') not in self.plates:
+            return False
+        if self.bbox:
+            lat, lng = evt.get('latitude'), evt.get('longitude')
+            if lat is None or lng is None:
+                return False
+            min_lng, min_lat, max_lng, max_lat = self.bbox
+            if not (min_lat <= lat <= max_lat and min_lng <= lng <= max_lng):
+                return False
+        return True
+
+    def push(self, evt):
+        with self._cond:
+            if len(self.buffer) == self.buffer.maxlen:
+                self.dropped += 1
+            self.buffer.append(evt)
+            self._cond.notify()
+
+    def get(self, timeout):
+        """
+        Wait for buffered events
+        Args:
+            timeout: Seconds to wait before returning an empty list
+        Returns:
+            list: Events received since the last call
+        """
+        with self._cond:
+            if not self.buffer and not self.closed:
+                self._cond.wait(timeout)
+            events = list(self.buffer)
+            self.buffer.clear()
+            return events
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify()
+
+
+class EventBroker:
+    """
+    Process-wide pub/sub.
+
+    ``publish()`` attaches the event to the current database transaction, so
+    clients only ever see committed rows. On PostgreSQL the event is sent with
+    ``pg_notify`` and a single listener thread per worker process fans it out
+    to local subscribers; other databases fall back to in-process delivery.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._listener_pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Configure the broker for a Flask application
+        Args:
+            app: Flask application instance
+        """
+        app.config.setdefault('EVENTS_BUFFER_SIZE', int(os.environ.get('EVENTS_BUFFER_SIZE', 100)))
+        app.config.setdefault('EVENTS_HEARTBEAT', float(os.environ.get('EVENTS_HEARTBEAT', 15)))
+        app.config.setdefault('EVENTS_MAX_SUBSCRIBERS', int(os.environ.get('EVENTS_MAX_SUBSCRIBERS', 5000)))
+        # Set by asgi.py, where streams wait on the event loop. Under WSGI each
+        # open stream holds a request thread, so pages only subscribe under
+        # ASGI and direct clients get a quarter of the threads (none with one)
+        app.config.setdefault('EVENTS_STREAMING', False)
+        app.config.setdefault('EVENTS_WSGI_MAX_SUBSCRIBERS', int(os.environ.get(
+            'EVENTS_WSGI_MAX_SUBSCRIBERS', int(os.environ.get('GUNICORN_THREADS', 8)) // 4)))
+        self.app = app
+        app.extensions['event_broker'] = self
+
+        event.listen(db.session, 'after_commit', self._after_commit)
+        pending_until_commit(db.session, 'pending_events')
+
+    @property
+    def uses_notify(self):
+        return db.engine.dialect.name == 'postgresql'
+
+    def publish(self, event_type, **data):
+        """
+        Queue an event for delivery once the current transaction commits
+        Args:
+            event_type: 'rating', 'comment' or 'incident'
+            **data: JSON serializable event fields
+        """
+        evt = dict(data, type=event_type)
+        for key in ('content', 'description'):
+            if isinstance(evt.get(key), str):
+                evt[key] = evt[key][:MAX_TEXT_LENGTH]
+
+        if self.uses_notify:
+            # NOTIFY is transactional: delivered on commit, discarded on rollback
+            db.session.execute(text("SELECT pg_notify(:channel, :payload)"),
+                               {'channel': CHANNEL, 'payload': json.dumps(evt, default=str)})
+        else:
+            db.session.info.setdefault('pending_events', []).append(evt)
+
+    def _after_commit(self, session):
+        if session.in_nested_transaction():
+            # A released savepoint, not the real commit
+            return
+        for evt in session.info.pop('pending_events', ()):
+            self.dispatch(evt)
+
+    def dispatch(self, evt):
+        """Deliver an event to every matching local subscriber"""
+        evt.setdefault('id', next(self._ids))
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for sub in subscribers:
+            if sub.matches(evt):
+                sub.push(evt)
+
+    def subscribe(self, plates=None, bbox=None, types=None, subscription_class=None):
+        """
+        Register a new subscriber
+        Args:
+            plates, bbox, types: Optional filters
+            subscription_class: Subscription subclass, e.g. the event loop
+                variant used by asgi.py
+        Returns:
+            Subscription object, or None if the worker is at capacity
+        """
+        if self.uses_notify:
+            self._ensure_listener()
+        limit = self.app.config['EVENTS_MAX_SUBSCRIBERS']
+        if not self.app.config['EVENTS_STREAMING']:
+            limit = min(limit, self.app.config['EVENTS_WSGI_MAX_SUBSCRIBERS'])
+        with self._lock:
+            if len(self._subscribers) >= limit:
+                return None
+            sub = (subscription_class or Subscription)(
+                plates, bbox, types, buffer_size=self.app.config['EVENTS_BUFFER_SIZE'])
+            self._subscribers.add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        sub.close()
+        with self._lock:
+            self._subscribers.discard(sub)
+
+    @property
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+    def _ensure_listener(self):
+        # One LISTEN connection per worker process, started after fork
+        if self._listener_pid == os.getpid():
+            return
+        with self._lock:
+            if self._listener_pid == os.getpid():
+                return
+            self._listener_pid = os.getpid()
+            engine = db.engine
+            threading.Thread(target=self._listen, args=(engine,),
+                             name='event-listener', daemon=True).start()
+
+    def _listen(self, engine):
+        backoff = 1
+        while True:
+            try:
+                conn = engine.raw_connection()
+                # Keep the LISTEN connection out of the request pool
+                conn.detach()
+                pg = conn.driver_connection
+                pg.autocommit = True
+                pg.cursor().execute(f"LISTEN {CHANNEL}")
+                backoff = 1
+                while True:
+                    if select.select([pg], [], [], 5) == ([], [], []):
+                        continue
+                    pg.poll()
+                    while pg.notifies:
+                        notify = pg.notifies.pop(0)
+                        try:
+                            self.dispatch(json.loads(notify.payload))
+                        except ValueError:
+                            logging.warning("Discarding malformed event payload")
+            except Exception as e:
+                logging.error(f"Event listener error: {e}, reconnecting in {backoff}s")
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 60)
+
+    def stream(self, sub):
+        """
+        Generate Server-Sent Events for a subscription
+        Args:
+            sub: Subscription returned by subscribe()
+        Yields:
+            str: SSE formatted chunks
+        """
+        heartbeat = self.app.config['EVENTS_HEARTBEAT']
+        try:
+            yield "retry: 5000\n\n"
+            while not sub.closed:
+                events = sub.get(heartbeat)
+                if not events:
+                    # Comment line keeps proxies from closing idle connections
+                    yield ": keep-alive\n\n"
+                    continue
+                for evt in events:
+                    yield format_event(evt)
+        finally:
+            self.unsubscribe(sub)
+
+
+event_broker = EventBroker()
+
+
+def format_event(evt):
+    """Server-Sent Events frame for an event"""
+    return f"id: {evt['id']}\nevent: {evt['type']}\ndata: {json.dumps(evt, default=str)}\n\n"
+
+
+def parse_stream_filters(args):
+    """
+    Subscription filters of a stream request
+    Args:
+        args: Query arguments: ``plates`` (comma separated), ``bbox``
+            (minLng,minLat,maxLng,maxLat) and ``types`` (rating,comment,incident)
+    Returns:
+        tuple: (plates, bbox, types)
+    Raises:
+        ValueError: With a message for the client
+    """
+    plates = [plate for plate in map(canonical_plate, args.get('plates', '').split(',')) if plate]
+    types = [t for t in args.get('types', '').split(',') if t]
+    bbox = parse_bbox(args.get('bbox'))
+    if args.get('bbox') and not bbox:
+        raise ValueError('Nieprawidłowy obszar (bbox)')
+    return plates, bbox, types
+
+
+def parse_bbox(value):
+    """
+    Parse a "minLng,minLat,maxLng,maxLat" bounding box string
+    Args:
+        value: Bounding box string
+    Returns:
+        tuple of four floats, or None if missing or malformed
+    """
+    if not value:
+        return None
+    try:
+        parts = tuple(float(p) for p in value.split(','))
+    except ValueError:
+        return None
+    if len(parts) != 4:
+        return None
+    return parts
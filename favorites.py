@@ -0,0 +1,135 @@
+"""
+Favorites for the Driver Rating Application
+Batched favorite status lookups, a paginated favorites list with vehicle
+aggregates and a feed of activity on favorite vehicles since the last visit
+"""
+
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, select, update
+from sqlalchemy.orm import contains_eager
+
+from models import db, Comment, Favorite, Rating, User, Vehicle
+from plates import plate_directory
+
+# Plates accepted by one status lookup
+MAX_STATUS_PLATES = 100
+
+# Feed window for users who never marked their feed as seen
+DEFAULT_FEED_WINDOW = timedelta(days=7)
+
+FavoriteRow = namedtuple('FavoriteRow', 'favorite vehicle rating_count avg_rating comment_count')
+
+
+def favorite_status(user_id, plates):
+    """
+    Favorite flags for many plates in one query
+    Args:
+        user_id: User ID
+        plates: Canonical plates
+    Returns:
+        dict: plate -> bool
+    """
+    entries = plate_directory.get_many(plates)
+    favorite_ids = set()
+    if entries:
+        favorite_ids = set(db.session.execute(
+            select(Favorite.vehicle_id).where(
+                Favorite.user_id == user_id,
+                Favorite.vehicle_id.in_([e.vehicle_id for e in entries.values()]))).scalars())
+    return {
+        plate: plate in entries and entries[plate].vehicle_id in favorite_ids
+        for plate in plates
+    }
+
+
+def favorites_page(user_id, page=1, per_page=10):
+    """
+    A user's favorites, newest first, with vehicle aggregates
+    Args:
+        user_id: User ID
+        page: 1-based page number
+        per_page: Favorites per page
+    Returns:
+        Pagination whose items are FavoriteRow tuples
+    """
+    query = select(Favorite).join(Favorite.vehicle).options(
+        contains_eager(Favorite.vehicle)).where(Favorite.user_id == user_id).order_by(
+            Favorite.created_at.desc(), Favorite.id.desc())
+    pagination = db.paginate(query, page=page, per_page=per_page, max_per_page=100,
+                             error_out=False)
+
+    # Aggregates for the vehicles on this page only, one grouped query each
+    vehicle_ids = [favorite.vehicle_id for favorite in pagination.items]
+    ratings, comments = {}, {}
+    if vehicle_ids:
+        ratings = {row[0]: row[1:] for row in db.session.execute(
+            select(Rating.vehicle_id, func.count(Rating.id), func.avg(Rating.rating)).where(
+                Rating.vehicle_id.in_(vehicle_ids)).group_by(Rating.vehicle_id))}
+        comments = dict(db.session.execute(
+            select(Comment.vehicle_id, func.count(Comment.id)).where(
+                Comment.vehicle_id.in_(vehicle_ids)).group_by(Comment.vehicle_id)).all())
+
+    pagination.items = [
+        FavoriteRow(favorite, favorite.vehicle,
+                    ratings.get(favorite.vehicle_id, (0, 0))[0],
+                    float(ratings.get(favorite.vehicle_id, (0, 0))[1] or 0),
+                    comments.get(favorite.vehicle_id, 0))
+        for favorite in pagination.items
+    ]
+    return pagination
+
+
+def favorite_changes(user_id, since=None):
+    """
+    New ratings and comments by other users on a user's favorite vehicles
+    Args:
+        user_id: User ID
+        since: Start of the window; defaults to the user's last visit
+    Returns:
+        tuple: (since, list of dicts per changed vehicle, most recent first)
+    """
+    if since is None:
+        since = db.session.execute(
+            select(User.favorites_seen_at).where(User.id == user_id)).scalar()
+    if since is None:
+        since = datetime.utcnow() - DEFAULT_FEED_WINDOW
+
+    # Index range scans on (vehicle_id, created_at) per favorite vehicle
+    def activity(model):
+        return db.session.execute(
+            select(model.vehicle_id, func.count(model.id), func.max(model.created_at)).join(
+                Favorite, Favorite.vehicle_id == model.vehicle_id).where(
+                    Favorite.user_id == user_id,
+                    model.created_at > since,
+                    model.user_id != user_id).group_by(model.vehicle_id)).all()
+
+    changes = {}
+    for key, rows in (('new_ratings', activity(Rating)), ('new_comments', activity(Comment))):
+        for vehicle_id, count, latest in rows:
+            change = changes.setdefault(vehicle_id, {
+                'new_ratings': 0, 'new_comments': 0, 'latest_at': latest})
+            change[key] = count
+            change['latest_at'] = max(change['latest_at'], latest)
+
+    if changes:
+        plates = dict(db.session.execute(
+            select(Vehicle.id, Vehicle.license_plate).where(Vehicle.id.in_(changes))).all())
+        for vehicle_id, change in changes.items():
+            change['license_plate'] = plates.get(vehicle_id)
+
+    return since, sorted(changes.values(), key=lambda c: c['latest_at'], reverse=True)
+
+
+def mark_favorites_seen(user_id, seen_at=None):
+    """
+    Move the start of a user's favorites feed forward (caller commits)
+    Args:
+        user_id: User ID
+        seen_at: New feed start, defaults to now
+    """
+    db.session.execute(
+        update(User).where(User.id == user_id).values(
+            favorites_seen_at=seen_at or datetime.utcnow()),
+        execution_options={'synchronize_session': False})
@@ -1,75 +1,292 @@
+"""
+Icon generator for the Driver Rating Application
+Draws the app icon once at high resolution and downsamples it to every PWA
+size in a process pool, writing PNG plus WebP/AVIF variants, and updates
+static/manifest.json. Icons are mapped back onto the artwork's few colours,
+and variants no smaller than their PNG are not kept. Outputs whose inputs did
+not change since the last run are skipped, so a rebuild without changes does
+no image work.
 
-from PIL import Image, ImageDraw
+    python generate_icons.py            # only what changed
+    python generate_icons.py --force    # everything
+"""
+
+import argparse
+import hashlib
+import inspect
+import json
 import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import PIL
+from PIL import Image, ImageDraw, features
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+ICON_DIR = os.path.join(ROOT, 'static', 'icons')
+MANIFEST = os.path.join(ROOT, 'static', 'manifest.json')
+# Input hash and file sizes per output group, see plan()
+CACHE_FILE = os.path.join(ROOT, '.icon-cache.json')
+
+# Drawn once at this size; every icon is a downsample of it
+MASTER_SIZE = 1024
+
+ICON_SIZES = [16, 32, 72, 96, 128, 144, 152, 180, 192, 384, 512]
+# The rest are favicons and the apple-touch-icon, which stay PNG only
+MANIFEST_SIZES = [72, 96, 128, 144, 152, 192, 384, 512]
+# Only legacy browsers ask for favicon.ico; base.html links the PNGs
+FAVICON_SIZES = [32]
+SCREENSHOTS = {'wide': (1280, 720), 'narrow': (640, 1136)}
+
+# Format -> (MIME type, Pillow save options). Flat artwork compresses best
+# lossless in WebP (method 6 is ~100x slower for the same size); AVIF has
+# no practical lossless mode, so it is lossy
+FORMATS = {
+    'png': ('image/png', {'optimize': True}),
+    'webp': ('image/webp', {'lossless': True, 'quality': 100, 'method': 4}),
+    'avif': ('image/avif', {'quality': 80, 'speed': 4}),
+}
+
+# Opaque screenshot PNGs are stored with a palette of this many colours:
+# the anti-aliased text needs a few hundred at most, half the truecolor size
+PNG_COLORS = 256
 
-def create_app_icon(size, filename):
-    # Create a new image with the specified size
-    img = Image.new('RGBA', (size, size), (13, 110, 253, 255))  # Bootstrap primary blue
+# Manifest order: browsers take the first entry of a size they can decode
+MANIFEST_FORMATS = ('avif', 'webp', 'png')
+
+BLUE = (13, 110, 253, 255)  # Bootstrap primary
+WHITE = (255, 255, 255, 255)
+WHEEL = (50, 50, 50, 255)
+BACKGROUND = (33, 37, 41)
+
+# Every icon pixel is mapped to one of these: anti-aliased edge shades cost
+# several times the bytes of the flat artwork at icon sizes
+ICON_PALETTE = (BLUE, WHITE, WHEEL)
+
+
+def draw_app_icon(size):
+    """Car on a blue square, all geometry relative to ``size``"""
+    img = Image.new('RGBA', (size, size), BLUE)
     draw = ImageDraw.Draw(img)
-    
-    # Draw a simple car icon
+
     # Car body
     car_width = int(size * 0.7)
     car_height = int(size * 0.4)
     car_x = (size - car_width) // 2
     car_y = (size - car_height) // 2
-    
-    # Main car body
-    draw.rounded_rectangle([car_x, car_y, car_x + car_width, car_y + car_height], 
-                          radius=int(size * 0.05), fill=(255, 255, 255, 255))
-    
+    draw.rounded_rectangle([car_x, car_y, car_x + car_width, car_y + car_height],
+                           radius=int(size * 0.05), fill=WHITE)
+
     # Windshield
     windshield_height = int(car_height * 0.6)
     windshield_y = car_y + int(car_height * 0.1)
-    draw.rounded_rectangle([car_x + int(car_width * 0.1), windshield_y, 
-                           car_x + car_width - int(car_width * 0.1), 
-                           windshield_y + windshield_height], 
-                          radius=int(size * 0.02), fill=(13, 110, 253, 255))
-    
+    draw.rounded_rectangle([car_x + int(car_width * 0.1), windshield_y,
+                            car_x + car_width - int(car_width * 0.1),
+                            windshield_y + windshield_height],
+                           radius=int(size * 0.02), fill=BLUE)
+
     # Wheels
     wheel_radius = int(size * 0.08)
     wheel_y = car_y + car_height - wheel_radius // 2
-    # Left wheel
-    draw.ellipse([car_x + int(car_width * 0.15) - wheel_radius, wheel_y - wheel_radius,
-                  car_x + int(car_width * 0.15) + wheel_radius, wheel_y + wheel_radius],
-                 fill=(50, 50, 50, 255))
-    # Right wheel
-    draw.ellipse([car_x + int(car_width * 0.85) - wheel_radius, wheel_y - wheel_radius,
-                  car_x + int(car_width * 0.85) + wheel_radius, wheel_y + wheel_radius],
-                 fill=(50, 50, 50, 255))
-    
-    # Save the image
-    img.save(filename, 'PNG')
-    print(f"Created icon: {filename}")
+    for wheel_x in (car_x + int(car_width * 0.15), car_x + int(car_width * 0.85)):
+        draw.ellipse([wheel_x - wheel_radius, wheel_y - wheel_radius,
+                      wheel_x + wheel_radius, wheel_y + wheel_radius], fill=WHEEL)
+    return img
+
+
+def draw_screenshot(width, height):
+    """Placeholder store screenshot"""
+    img = Image.new('RGB', (width, height), BACKGROUND)
+    ImageDraw.Draw(img).text((width // 2, height // 2), "Oceny Kierowców",
+                             fill=(255, 255, 255), anchor="mm")
+    return img
+
+
+# Rendered once per worker process, on its first icon
+_master = None
+
+
+def _master_icon():
+    global _master
+    if _master is None:
+        _master = draw_app_icon(MASTER_SIZE)
+    return _master
+
+
+def _downsample(size):
+    # reducing_gap: a cheap box reduction first, then Lanczos over the
+    # last ~3x, visually the same as a full Lanczos pass from the master
+    return _master_icon().resize((size, size), Image.Resampling.LANCZOS, reducing_gap=3.0)
+
+
+def _flatten(img):
+    palette = Image.new('P', (1, 1))
+    palette.putpalette([channel for colour in ICON_PALETTE for channel in colour[:3]])
+    return img.convert('RGB').quantize(palette=palette, dither=Image.Dither.NONE)
+
+
+def _for_png(img):
+    if img.mode == 'RGBA' and img.getextrema()[3][0] < 255:
+        return img
+    return img.convert('RGB').quantize(PNG_COLORS, method=Image.Quantize.MEDIANCUT)
+
+
+def available_formats():
+    return [name for name in FORMATS if name == 'png' or features.check(name)]
+
+
+def plan(formats):
+    """
+    Output groups; each is rendered once and saved in all its formats
+    Returns:
+        list: dicts with name, kind, size and formats
+    """
+    variants = [name for name in formats if name != 'png']
+    tasks = [{'name': f'icon-{size}x{size}', 'kind': 'icon', 'size': [size, size],
+              'formats': ['png'] + (variants if size in MANIFEST_SIZES else [])}
+             for size in ICON_SIZES]
+    tasks.append({'name': 'favicon', 'kind': 'favicon', 'size': FAVICON_SIZES,
+                  'formats': ['ico']})
+    tasks.extend({'name': f'screenshot-{name}', 'kind': 'screenshot', 'size': list(size),
+                  'formats': ['png'] + [name for name in variants if name == 'webp']}
+                 for name, size in SCREENSHOTS.items())
+    return tasks
+
+
+def input_hash(task):
+    """Hash of everything an output group depends on"""
+    renderer = draw_screenshot if task['kind'] == 'screenshot' else draw_app_icon
+    digest = hashlib.sha256()
+    digest.update(json.dumps(task, sort_keys=True).encode())
+    digest.update(json.dumps({name: FORMATS[name][1] for name in task['formats']
+                              if name in FORMATS}, sort_keys=True).encode())
+    digest.update(inspect.getsource(renderer).encode())
+    digest.update(f'{MASTER_SIZE} {PNG_COLORS} {ICON_PALETTE} {PIL.__version__}'.encode())
+    return digest.hexdigest()
+
+
+def render(task):
+    """
+    Render one output group and write its files (runs in a worker process)
+    Returns:
+        dict: Format -> bytes written, without variants dropped for being no
+        smaller than the PNG
+    """
+    written = {}
+    if task['kind'] == 'favicon':
+        frames = [_flatten(_downsample(size)) for size in sorted(task['size'], reverse=True)]
+        path = os.path.join(ICON_DIR, 'favicon.ico')
+        frames[0].save(path, format='ICO', sizes=[frame.size for frame in frames],
+                       append_images=frames[1:])
+        return {'ico': os.path.getsize(path)}
+
+    if task['kind'] == 'screenshot':
+        img = draw_screenshot(*task['size'])
+        png = _for_png(img)
+    else:
+        png = _flatten(_downsample(task['size'][0]))
+        img = png.convert('RGB')
+    for name in task['formats']:
+        path = os.path.join(ICON_DIR, f"{task['name']}.{name}")
+        output = png if name == 'png' else img
+        output.save(path, format=name.upper(), **FORMATS[name][1])
+        if name != 'png' and os.path.getsize(path) >= written['png']:
+            os.remove(path)
+            continue
+        written[name] = os.path.getsize(path)
+    return written
+
+
+def _outputs_exist(task, sizes):
+    return all(os.path.exists(os.path.join(
+        ICON_DIR, 'favicon.ico' if name == 'ico' else f"{task['name']}.{name}"))
+        for name in sizes)
+
+
+def manifest_entries(task, sizes, extra=None):
+    """PWA manifest entries of one output group: variants smaller than its PNG, then the PNG"""
+    entries = []
+    for name in MANIFEST_FORMATS:
+        if name not in sizes or (name != 'png' and sizes[name] >= sizes.get('png', 0)):
+            continue
+        width, height = task['size']
+        entries.append(dict({'src': f"/static/icons/{task['name']}.{name}",
+                             'sizes': f'{width}x{height}',
+                             'type': FORMATS[name][0]}, **(extra or {})))
+    return entries
+
+
+def update_manifest(tasks, cache):
+    """
+    Point the PWA manifest's icons and screenshots at the generated files
+    Returns:
+        bool: True if the manifest changed
+    """
+    with open(MANIFEST, encoding='utf-8') as f:
+        manifest = json.load(f)
+
+    by_name = {task['name']: task for task in tasks}
+    icons = []
+    for size in MANIFEST_SIZES:
+        name = f'icon-{size}x{size}'
+        icons.extend(manifest_entries(by_name[name], cache[name]['sizes'],
+                                      {'purpose': 'maskable any'}))
+    screenshots = []
+    for form_factor in SCREENSHOTS:
+        name = f'screenshot-{form_factor}'
+        screenshots.extend(manifest_entries(by_name[name], cache[name]['sizes'],
+                                            {'form_factor': form_factor}))
+
+    updated = dict(manifest, icons=icons, screenshots=screenshots)
+    if updated == manifest:
+        return False
+    with open(MANIFEST, 'w', encoding='utf-8') as f:
+        json.dump(updated, f, indent=2, ensure_ascii=False)
+        f.write('\n')
+    return True
+
 
 def main():
-    # Create icons directory if it doesn't exist
-    os.makedirs('static/icons', exist_ok=True)
-    
-    # Icon sizes for PWA
-    sizes = [16, 32, 72, 96, 128, 144, 152, 180, 192, 384, 512]
-    
-    for size in sizes:
-        filename = f'static/icons/icon-{size}x{size}.png'
-        create_app_icon(size, filename)
-    
-    # Create favicon
-    create_app_icon(32, 'static/icons/favicon.ico')
-    
-    # Create screenshots (placeholder)
-    # Wide screenshot
-    img_wide = Image.new('RGB', (1280, 720), (33, 37, 41))
-    draw_wide = ImageDraw.Draw(img_wide)
-    draw_wide.text((640, 360), "Oceny Kierowców", fill=(255, 255, 255), anchor="mm")
-    img_wide.save('static/icons/screenshot-wide.png', 'PNG')
-    
-    # Narrow screenshot
-    img_narrow = Image.new('RGB', (640, 1136), (33, 37, 41))
-    draw_narrow = ImageDraw.Draw(img_narrow)
-    draw_narrow.text((320, 568), "Oceny Kierowców", fill=(255, 255, 255), anchor="mm")
-    img_narrow.save('static/icons/screenshot-narrow.png', 'PNG')
-    
-    print("All PWA icons generated successfully!")
+    parser = argparse.ArgumentParser(description='Generate PWA icons and screenshots')
+    parser.add_argument('--force', action='store_true', help='Ignore the cache, render everything')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='Rendering processes')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    formats = available_formats()
+    for name in FORMATS:
+        if name not in formats:
+            print(f"Pillow was built without {name.upper()} support, skipping it", file=sys.stderr)
+
+    os.makedirs(ICON_DIR, exist_ok=True)
+    try:
+        with open(CACHE_FILE, encoding='utf-8') as f:
+            cache = json.load(f)
+    except (FileNotFoundError, ValueError):
+        cache = {}
+
+    tasks = plan(formats)
+    stale = []
+    for task in tasks:
+        key = input_hash(task)
+        entry = cache.get(task['name'])
+        if args.force or entry is None or entry['key'] != key or not _outputs_exist(task, entry['sizes']):
+            stale.append((task, key))
+
+    if stale:
+        with ProcessPoolExecutor(max_workers=max(1, min(args.workers, len(stale)))) as pool:
+            for (task, key), sizes in zip(stale, pool.map(render, [task for task, _ in stale])):
+                cache[task['name']] = {'key': key, 'sizes': sizes}
+        with open(CACHE_FILE, 'w', encoding='utf-8') as f:
+            json.dump(cache, f, indent=2, sort_keys=True)
+
+    changed = update_manifest(tasks, cache)
+    print(f"Rendered {len(stale)} of {len(tasks)} outputs"
+          f"{', updated manifest.json' if changed else ''} "
+          f"in {time.perf_counter() - start:.2f}s")
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,96 @@
+"""
+Gunicorn production profile for the Driver Rating Application
+
+    gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker asgi:application
+
+The app is imported once in the master (``preload_app``) and the workers
+are forked from it, sharing its code and data copy-on-write. Production runs
+the async mode (asgi.py, the ``asgi`` extra): live event streams wait on the
+event loop instead of each holding a thread for as long as a tab is open.
+The plain WSGI app still runs on a few processes with threads each
+(``gthread``), the default worker class, but serves only a handful of event
+streams per worker (EVENTS_WSGI_MAX_SUBSCRIBERS) and pages do not subscribe:
+
+    gunicorn -c gunicorn.conf.py main:app
+
+Every setting can be overridden from the environment (below) or the command
+line. ``--reload`` does not see code changes with a preloaded app, so
+development runs set ``GUNICORN_PRELOAD=false``.
+"""
+
+import gc
+import multiprocessing
+import os
+import sys
+
+
+def _env_bool(name, default):
+    return os.environ.get(name, str(default)).lower() == 'true'
+
+
+bind = os.environ.get('GUNICORN_BIND', f"0.0.0.0:{os.environ.get('PORT', 5000)}")
+preload_app = _env_bool('GUNICORN_PRELOAD', True)
+
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+# Gunicorn reads WEB_CONCURRENCY itself, but only when no config sets workers
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() + 1))
+# Keep at or below DB_POOL_SIZE + DB_MAX_OVERFLOW, see on_starting()
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+# Recycle workers to bound slow leaks; the jitter keeps them from all
+# restarting (and dropping their warm caches) at the same moment
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 2000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 200))
+
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+# Long enough for the job queue to drain (JOB_DRAIN_TIMEOUT, 10 s by default)
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+
+# Heartbeat files on tmpfs; a slow disk would otherwise stall workers
+if os.path.isdir('/dev/shm'):
+    worker_tmp_dir = '/dev/shm'
+
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG') or None
+errorlog = '-'
+loglevel = os.environ.get('GUNICORN_LOG_LEVEL', 'info')
+
+
+def on_starting(server):
+    if not server.cfg.worker_class_str.startswith('uvicorn'):
+        server.log.warning(f"{server.cfg.worker_class_str} workers hold a thread per event "
+                           f"stream; live updates are off, run asgi:application with "
+                           f"uvicorn.workers.UvicornWorker to enable them")
+    pool = int(os.environ.get('DB_POOL_SIZE', 5)) + int(os.environ.get('DB_MAX_OVERFLOW', 10))
+    if server.cfg.worker_class_str == 'gthread' and server.cfg.threads > pool:
+        server.log.warning(f"{server.cfg.threads} threads per worker but only {pool} "
+                           f"database connections, requests will queue for the pool")
+
+
+def when_ready(server):
+    if server.cfg.preload_app:
+        # Everything imported so far lives as long as the process; moving it
+        # out of the collector's reach keeps collections in the workers from
+        # writing to (and so un-sharing) the inherited pages
+        gc.freeze()
+
+
+def post_fork(server, worker):
+    if 'app' not in sys.modules:
+        return
+    # The master connected while preloading (db.create_all); a pooled
+    # connection must never be used by two processes
+    from app import app
+    from models import db
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+
+
+def worker_exit(server, worker):
+    if 'app' not in sys.modules:
+        return
+    from credentials import credential_service
+    from jobs import job_queue
+    job_queue.shutdown()
+    credential_service.shutdown()
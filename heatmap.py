@@ -0,0 +1,241 @@
+"""
+Incident heatmap tiles for the Driver Rating Application
+Renders z/x/y density tiles from incident positions and severities with
+NumPy (binning + separable Gaussian blur), caches them as PNG files on disk
+and drops the affected tiles when new incidents arrive
+"""
+
+import math
+import os
+import struct
+import tempfile
+import time
+import zlib
+
+try:
+    import numpy as np
+except ImportError:
+    # NumPy is optional; without it the heatmap layer is disabled
+    np = None
+
+from sqlalchemy import func, select
+
+from models import db, Incident
+
+TILE_SIZE = 256
+
+# Gaussian kernel width in pixels; tiles are rendered with this much margin
+# so blobs near an edge continue seamlessly into the next tile
+BLUR_SIGMA = 8
+MARGIN = 3 * BLUR_SIGMA
+
+# Severity-weighted density that maps to about 63% opacity at DETAIL_ZOOM;
+# lower zooms pack more incidents per pixel and get a higher saturation point
+HEAT_SCALE = 0.05
+DETAIL_ZOOM = 14
+
+# Colour ramp: density 0..1 -> RGBA
+_RAMP_STOPS = (0.0, 0.25, 0.5, 0.75, 1.0)
+_RAMP_COLOURS = (
+    (0, 0, 255, 0),
+    (0, 128, 255, 140),
+    (0, 200, 0, 180),
+    (255, 220, 0, 210),
+    (220, 0, 0, 235),
+)
+
+
+def _png(rgba):
+    """Encode an (h, w, 4) uint8 array as PNG with the standard library only"""
+    height, width = rgba.shape[:2]
+    raw = np.zeros((height, width * 4 + 1), dtype=np.uint8)
+    raw[:, 1:] = rgba.reshape(height, width * 4)  # filter byte 0 per row
+
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data +
+                struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+    return (b'\x89PNG\r\n\x1a\n' +
+            chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)) +
+            chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)) +
+            chunk(b'IEND', b''))
+
+
+def _kernel():
+    offsets = np.arange(-MARGIN, MARGIN + 1, dtype=np.float64)
+    kernel = np.exp(-offsets ** 2 / (2 * BLUR_SIGMA ** 2))
+    return kernel / kernel.sum()
+
+
+def tile_bounds(z, x, y):
+    """
+    Geographic bounds of a tile, widened by the blur margin
+    Returns:
+        tuple: (min_lng, min_lat, max_lng, max_lat)
+    """
+    world = TILE_SIZE * 2 ** z
+
+    def lng(px):
+        return px / world * 360 - 180
+
+    def lat(py):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * py / world))))
+
+    x0, y0 = x * TILE_SIZE - MARGIN, y * TILE_SIZE - MARGIN
+    x1, y1 = (x + 1) * TILE_SIZE + MARGIN, (y + 1) * TILE_SIZE + MARGIN
+    return lng(x0), lat(min(y1, world)), lng(x1), lat(max(y0, 0))
+
+
+def project(latitudes, longitudes, z):
+    """Web Mercator pixel coordinates of points at zoom z (vectorized)"""
+    world = TILE_SIZE * 2 ** z
+    lat = np.radians(np.clip(latitudes, -85.05112878, 85.05112878))
+    px = (np.asarray(longitudes) + 180) / 360 * world
+    py = (1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / np.pi) / 2 * world
+    return px, py
+
+
+def render_tile(z, x, y, latitudes, longitudes, weights):
+    """
+    Render one heatmap tile
+    Args:
+        z, x, y: Tile coordinates
+        latitudes, longitudes, weights: Incident arrays (incidents outside the
+            tile and its margin are ignored)
+    Returns:
+        bytes: PNG image
+    """
+    size = TILE_SIZE + 2 * MARGIN
+    px, py = project(latitudes, longitudes, z)
+    col = np.floor(px - (x * TILE_SIZE - MARGIN)).astype(np.int64)
+    row = np.floor(py - (y * TILE_SIZE - MARGIN)).astype(np.int64)
+    inside = (col >= 0) & (col < size) & (row >= 0) & (row < size)
+
+    # Binning: one weighted bincount over flattened pixel indices
+    density = np.bincount(row[inside] * size + col[inside],
+                          weights=np.asarray(weights, dtype=np.float64)[inside],
+                          minlength=size * size).reshape(size, size)
+
+    # Separable Gaussian blur, each pass a sum of shifted slices
+    kernel = _kernel()
+    blurred = np.zeros((size, TILE_SIZE))
+    for i, k in enumerate(kernel):
+        blurred += k * density[:, i:i + TILE_SIZE]
+    heat = np.zeros((TILE_SIZE, TILE_SIZE))
+    for i, k in enumerate(kernel):
+        heat += k * blurred[i:i + TILE_SIZE, :]
+
+    scale = HEAT_SCALE * 2 ** (max(DETAIL_ZOOM - z, 0) / 2)
+    level = 1 - np.exp(-heat / scale)
+
+    rgba = np.empty((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8)
+    for channel in range(4):
+        rgba[..., channel] = np.interp(level, _RAMP_STOPS,
+                                       [colour[channel] for colour in _RAMP_COLOURS])
+    rgba[..., 3][heat <= 1e-9] = 0
+    return _png(rgba)
+
+
+class HeatmapTiles:
+    """
+    Disk cache of heatmap tiles under ``HEATMAP_CACHE_DIR/z/x/y.png``.
+
+    Tiles are rendered on first request and rewritten atomically. A new
+    incident deletes the tiles it touches at every zoom level, so the next
+    request re-renders them; anything else (deleted or merged incidents)
+    is picked up when a tile is older than ``HEATMAP_TILE_TTL`` seconds.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.cache_dir = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Configure the tile cache for a Flask application
+        Args:
+            app: Flask application instance
+        """
+        app.config.setdefault('HEATMAP_CACHE_DIR', os.environ.get(
+            'HEATMAP_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'driver-heatmap-tiles')))
+        app.config.setdefault('HEATMAP_TILE_TTL', int(os.environ.get('HEATMAP_TILE_TTL', 3600)))
+        app.config.setdefault('HEATMAP_MIN_ZOOM', 5)
+        app.config.setdefault('HEATMAP_MAX_ZOOM', 16)
+        self.app = app
+        self.cache_dir = app.config['HEATMAP_CACHE_DIR']
+        app.extensions['heatmap_tiles'] = self
+
+    @property
+    def available(self):
+        return np is not None
+
+    def valid_tile(self, z, x, y):
+        return (self.app.config['HEATMAP_MIN_ZOOM'] <= z <= self.app.config['HEATMAP_MAX_ZOOM']
+                and 0 <= x < 2 ** z and 0 <= y < 2 ** z)
+
+    def tile_path(self, z, x, y):
+        return os.path.join(self.cache_dir, str(z), str(x), f'{y}.png')
+
+    def get_tile(self, z, x, y):
+        """
+        Path of a cached tile, rendering it first if missing or expired
+        Returns:
+            str: Path to the PNG file
+        """
+        path = self.tile_path(z, x, y)
+        try:
+            if time.time() - os.path.getmtime(path) < self.app.config['HEATMAP_TILE_TTL']:
+                return path
+        except OSError:
+            pass
+
+        min_lng, min_lat, max_lng, max_lat = tile_bounds(z, x, y)
+        rows = db.session.execute(
+            select(Incident.latitude, Incident.longitude,
+                   func.coalesce(Incident.severity, 1)).where(
+                Incident.latitude.between(min_lat, max_lat),
+                Incident.longitude.between(min_lng, max_lng))).all()
+        if rows:
+            latitudes, longitudes, weights = np.array(rows, dtype=np.float64).T
+        else:
+            latitudes = longitudes = weights = np.empty(0)
+        png = render_tile(z, x, y, latitudes, longitudes, weights)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(png)
+        os.replace(tmp_path, path)
+        return path
+
+    def tiles_touching(self, latitude, longitude):
+        """
+        Tiles whose image (including blur) is affected by a point
+        Yields:
+            tuple: (z, x, y)
+        """
+        for z in range(self.app.config['HEATMAP_MIN_ZOOM'],
+                       self.app.config['HEATMAP_MAX_ZOOM'] + 1):
+            px, py = project(np.array([latitude]), np.array([longitude]), z)
+            px, py = float(px[0]), float(py[0])
+            limit = 2 ** z - 1
+            for tx in range(max(int((px - MARGIN) // TILE_SIZE), 0),
+                            min(int((px + MARGIN) // TILE_SIZE), limit) + 1):
+                for ty in range(max(int((py - MARGIN) // TILE_SIZE), 0),
+                                min(int((py + MARGIN) // TILE_SIZE), limit) + 1):
+                    yield z, tx, ty
+
+    def invalidate_point(self, latitude, longitude):
+        """Drop cached tiles affected by an incident at the given position"""
+        if not self.available:
+            return
+        for z, x, y in self.tiles_touching(latitude, longitude):
+            try:
+                os.remove(self.tile_path(z, x, y))
+            except FileNotFoundError:
+                pass
+
+
+heatmap_tiles = HeatmapTiles()
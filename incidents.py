@@ -0,0 +1,232 @@
+"""
+Incident ingestion for the Driver Rating Application
+Folds repeated reports of the same event (same plate, nearby, shortly after)
+into one incident with a corroboration counter that drives is_verified, and
+deduplicates existing incidents with a sort-and-sweep pass
+"""
+
+import math
+from collections import deque
+from datetime import datetime, timedelta
+
+from sqlalchemy import case, delete, select, update
+from sqlalchemy.exc import IntegrityError
+
+from models import db, Incident, IncidentCorroboration
+from jobs import job_queue
+
+# Reports of the same plate this close in space and time are one event
+DEDUP_RADIUS_M = 150
+DEDUP_WINDOW = timedelta(minutes=30)
+
+# Distinct reporters (author included) that make an incident verified
+VERIFY_CORROBORATIONS = 3
+
+EARTH_RADIUS_M = 6371000
+
+# Grid cells are at least DEDUP_RADIUS_M wide up to this latitude, so the
+# 3x3 neighbourhood of a cell covers the whole search radius
+MAX_GRID_LATITUDE = 70
+_CELL_LAT = DEDUP_RADIUS_M / 111320
+_CELL_LNG = _CELL_LAT / math.cos(math.radians(MAX_GRID_LATITUDE))
+_CELL_ROW = 10_000_000
+
+
+def grid_cell(latitude, longitude):
+    """
+    Spatial grid cell of a point
+    Returns:
+        int: Cell number (row * 10^7 + column)
+    """
+    row = int((latitude + 90) // _CELL_LAT)
+    column = int((longitude + 180) // _CELL_LNG)
+    return row * _CELL_ROW + column
+
+
+def neighbour_cells(cell):
+    """The cell and its 8 neighbours"""
+    return [cell + dy * _CELL_ROW + dx for dy in (-1, 0, 1) for dx in (-1, 0, 1)]
+
+
+def distance_m(lat1, lng1, lat2, lng2):
+    """Haversine distance in meters"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = (math.sin((phi2 - phi1) / 2) ** 2 +
+         math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+
+def find_duplicate(license_plate, latitude, longitude, now=None):
+    """
+    Closest recent incident of the same plate within the dedup radius
+    Returns:
+        Incident or None
+    """
+    now = now or datetime.utcnow()
+    candidates = db.session.execute(
+        select(Incident).where(
+            Incident.license_plate == license_plate,
+            Incident.grid_cell.in_(neighbour_cells(grid_cell(latitude, longitude))),
+            Incident.created_at >= now - DEDUP_WINDOW)).scalars().all()
+
+    best, best_distance = None, DEDUP_RADIUS_M
+    for incident in candidates:
+        distance = distance_m(latitude, longitude, incident.latitude, incident.longitude)
+        if distance <= best_distance:
+            best, best_distance = incident, distance
+    return best
+
+
+def corroborate(incident_id, user_id, severity=None):
+    """
+    Count another user's report of an existing incident (caller commits)
+    Args:
+        incident_id: Incident ID
+        user_id: Reporting user's ID
+        severity: Reported severity, the incident keeps the highest
+    Returns:
+        bool: False if this user already reported the incident
+    """
+    corroboration = IncidentCorroboration()
+    corroboration.incident_id = incident_id
+    corroboration.user_id = user_id
+    try:
+        with db.session.begin_nested():
+            db.session.add(corroboration)
+    except IntegrityError:
+        return False
+
+    values = {
+        'corroborations': Incident.corroborations + 1,
+        'is_verified': case((Incident.corroborations + 1 >= VERIFY_CORROBORATIONS, True),
+                            else_=Incident.is_verified),
+    }
+    if severity is not None:
+        values['severity'] = case((Incident.severity < severity, severity),
+                                  else_=Incident.severity)
+    db.session.execute(update(Incident).where(Incident.id == incident_id).values(**values),
+                       execution_options={'synchronize_session': 'fetch'})
+    return True
+
+
+def ingest_incident(user_id, license_plate, latitude, longitude, incident_type,
+                    description, severity=1):
+    """
+    Store a reported incident, or fold it into a matching recent one (caller commits)
+    Returns:
+        tuple: (Incident, created, corroborated) where created is False for a
+        report of an existing incident, and corroborated tells whether that
+        report was counted (False when this user had already reported it)
+    """
+    duplicate = find_duplicate(license_plate, latitude, longitude)
+    if duplicate is not None:
+        # The original author re-reporting changes nothing
+        corroborated = (duplicate.user_id != user_id and
+                        corroborate(duplicate.id, user_id, severity))
+        return duplicate, False, corroborated
+
+    incident = Incident()
+    incident.user_id = user_id
+    incident.license_plate = license_plate
+    incident.latitude = latitude
+    incident.longitude = longitude
+    incident.grid_cell = grid_cell(latitude, longitude)
+    incident.incident_type = incident_type
+    incident.description = description
+    incident.severity = severity
+    db.session.add(incident)
+    db.session.flush()
+    return incident, True, False
+
+
+def _sweep(rows):
+    """
+    Sort-and-sweep over incidents ordered by (plate, created_at)
+    Yields:
+        tuple: (representative row, duplicate row) pairs; representatives are
+        the first report of each event
+    """
+    plate = None
+    active = deque()
+    for row in rows:
+        if row.license_plate != plate:
+            plate = row.license_plate
+            active.clear()
+        # Representatives older than the window can't match anything later
+        while active and active[0].created_at < row.created_at - DEDUP_WINDOW:
+            active.popleft()
+
+        match = None
+        for candidate in active:
+            if distance_m(row.latitude, row.longitude,
+                          candidate.latitude, candidate.longitude) <= DEDUP_RADIUS_M:
+                match = candidate
+                break
+        if match is None:
+            active.append(row)
+            yield row, None
+        else:
+            yield match, row
+
+
+def dedupe_incidents(dry_run=False, chunk_size=1000, progress=None):
+    """
+    Merge existing duplicate incidents and fill in missing grid cells.
+    Rows arrive sorted by (plate, created_at) from the database, so every
+    incident is only compared with the few events of the same plate still
+    inside the time window.
+    Args:
+        dry_run: Only count duplicates
+        chunk_size: Changes per transaction
+        progress: Optional callback(merged so far)
+    Returns:
+        dict: Counts of merged incidents and filled grid cells, and the IDs of
+        users whose duplicate reports were removed
+    """
+    rows = db.session.execute(
+        select(Incident.id, Incident.user_id, Incident.license_plate, Incident.latitude,
+               Incident.longitude, Incident.grid_cell, Incident.created_at).order_by(
+                   Incident.license_plate, Incident.created_at, Incident.id).execution_options(
+                       yield_per=chunk_size))
+
+    merges = []
+    cells = []
+    for representative, duplicate in _sweep(rows):
+        if duplicate is not None:
+            merges.append((representative, duplicate))
+        elif representative.grid_cell is None:
+            cells.append({'id': representative.id,
+                          'grid_cell': grid_cell(representative.latitude,
+                                                 representative.longitude)})
+
+    summary = {
+        'merged': len(merges),
+        'users': sorted({duplicate.user_id for _, duplicate in merges}),
+        'grid_cells': len(cells),
+    }
+    if dry_run:
+        return summary
+
+    for i in range(0, len(cells), chunk_size):
+        db.session.execute(update(Incident), cells[i:i + chunk_size])
+        db.session.commit()
+
+    done = 0
+    for i in range(0, len(merges), chunk_size):
+        chunk = merges[i:i + chunk_size]
+        for representative, duplicate in chunk:
+            if duplicate.user_id != representative.user_id:
+                corroborate(representative.id, duplicate.user_id)
+        db.session.execute(
+            delete(Incident).where(Incident.id.in_([d.id for _, d in chunk])),
+            execution_options={'synchronize_session': False})
+        db.session.commit()
+        done += len(chunk)
+        if progress:
+            progress(done)
+
+    # Authors of removed duplicates have fewer incidents now
+    for user_id in summary['users']:
+        job_queue.enqueue('refresh_user_statistics', user_id=user_id)
+    db.session.commit()
+    return summary
@@ -0,0 +1,311 @@
+"""
+Write-behind job queue for the Driver Rating Application
+Defers non-critical side effects (statistics, heatmap tile invalidation, traffic
+history) out of the request thread using a durable outbox table and a small
+thread pool
+"""
+
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, update
+
+from database import pending_until_commit
+from models import db, OutboxJob
+
+
+class JobQueue:
+    """
+    In-process worker pool backed by the ``outbox_job`` table.
+
+    ``enqueue()`` adds an outbox row to the current session, so the job is
+    committed atomically with the primary row. After the commit the job id is
+    offered to a bounded in-memory queue; when that queue is full the row simply
+    stays in the outbox and is picked up by the periodic sweep (backpressure
+    never blocks or fails the request). The sweep runs on its own thread every
+    JOB_POLL_INTERVAL seconds, so overflowed jobs and backed-off retries are
+    picked up even while the workers never go idle.
+
+    ``enqueue_transient()`` hands a job straight to the workers without an
+    outbox row, for best-effort work that must not cost the request a commit.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.handlers = {}
+        self._queue = None
+        self._threads = []
+        self._sweeper = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Configure the queue for a Flask application
+        Args:
+            app: Flask application instance
+        """
+        app.config.setdefault('JOB_WORKERS', int(os.environ.get('JOB_WORKERS', 2)))
+        app.config.setdefault('JOB_QUEUE_SIZE', int(os.environ.get('JOB_QUEUE_SIZE', 1000)))
+        app.config.setdefault('JOB_MAX_ATTEMPTS', int(os.environ.get('JOB_MAX_ATTEMPTS', 5)))
+        app.config.setdefault('JOB_POLL_INTERVAL', float(os.environ.get('JOB_POLL_INTERVAL', 5)))
+        app.config.setdefault('JOB_LEASE_SECONDS', int(os.environ.get('JOB_LEASE_SECONDS', 60)))
+        app.config.setdefault('JOB_DRAIN_TIMEOUT', float(os.environ.get('JOB_DRAIN_TIMEOUT', 10)))
+        app.config.setdefault('JOB_EAGER', os.environ.get('JOB_EAGER', 'False').lower() == 'true')
+        self.app = app
+        app.extensions['job_queue'] = self
+
+        event.listen(db.session, 'after_commit', self._after_commit)
+        pending_until_commit(db.session, 'pending_jobs')
+        atexit.register(self.shutdown)
+
+    def handler(self, kind):
+        """
+        Decorator registering a function as the handler for a job kind
+        Args:
+            kind: Job kind string
+        """
+        def decorator(f):
+            self.handlers[kind] = f
+            return f
+        return decorator
+
+    def enqueue(self, kind, **payload):
+        """
+        Add a job to the current database session
+        Args:
+            kind: Registered job kind
+            **payload: JSON serializable keyword arguments for the handler
+        Returns:
+            OutboxJob object (flushed, not yet committed)
+        """
+        if kind not in self.handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+
+        job = OutboxJob()
+        job.kind = kind
+        job.payload = json.dumps(payload, sort_keys=True)
+        db.session.add(job)
+        db.session.flush()
+
+        db.session.info.setdefault('pending_jobs', []).append(job.id)
+        return job
+
+    def enqueue_transient(self, kind, **payload):
+        """
+        Run a job on a worker thread of this process, without an outbox row.
+        Nothing is committed; the job is lost if the queue is full or the
+        process exits first.
+        Args:
+            kind: Registered job kind
+            **payload: Keyword arguments for the handler
+        Returns:
+            bool: False if the queue was full and the job was dropped
+        """
+        if kind not in self.handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+
+        if self.app.config['JOB_EAGER']:
+            self._run_transient(kind, payload)
+            return True
+
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((kind, payload))
+        except queue.Full:
+            logging.warning("Job queue full, dropped transient job %s", kind)
+            return False
+        return True
+
+    def _after_commit(self, session):
+        if session.in_nested_transaction():
+            # A released savepoint; the rows are not committed yet
+            return
+        job_ids = session.info.pop('pending_jobs', None)
+        if not job_ids or self.app is None:
+            return
+
+        if self.app.config['JOB_EAGER']:
+            # Run inline once the outer transaction is finished (tests, CLI);
+            # _run_many pushes its own app context and therefore its own session
+            self._run_many(job_ids)
+            return
+
+        self._ensure_started()
+        for job_id in job_ids:
+            try:
+                self._queue.put_nowait(job_id)
+            except queue.Full:
+                logging.warning("Job queue full, job %s left for outbox sweep", job_id)
+                break
+
+    def _ensure_started(self):
+        # Threads do not survive a fork, so (re)start them lazily per process
+        if self._pid == os.getpid() and self._threads:
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._threads:
+                return
+            self._pid = os.getpid()
+            self._stopping.clear()
+            self._queue = queue.Queue(maxsize=self.app.config['JOB_QUEUE_SIZE'])
+            self._threads = []
+            for i in range(self.app.config['JOB_WORKERS']):
+                thread = threading.Thread(target=self._worker,
+                                          name=f'job-worker-{i}',
+                                          daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            self._sweeper = threading.Thread(target=self._sweep_periodically,
+                                             name='job-sweeper', daemon=True)
+            self._sweeper.start()
+
+    def _worker(self):
+        poll_interval = self.app.config['JOB_POLL_INTERVAL']
+        while True:
+            try:
+                job_id = self._queue.get(timeout=poll_interval)
+            except queue.Empty:
+                if self._stopping.is_set():
+                    return
+                continue
+
+            if job_id is None:
+                self._queue.task_done()
+                return
+
+            try:
+                if isinstance(job_id, tuple):
+                    self._run_transient(*job_id)
+                else:
+                    self._run_many([job_id])
+            finally:
+                self._queue.task_done()
+
+    def _sweep_periodically(self):
+        # Independent of the workers: under sustained load they never idle
+        while not self._stopping.wait(self.app.config['JOB_POLL_INTERVAL']):
+            self._sweep()
+
+    def _sweep(self, limit=100):
+        """Pick up due jobs that never made it into the in-memory queue"""
+        with self.app.app_context():
+            try:
+                job_ids = [row.id for row in db.session.query(OutboxJob.id).filter(
+                    OutboxJob.status == 'pending',
+                    OutboxJob.available_at <= datetime.utcnow()).order_by(
+                        OutboxJob.available_at).limit(limit)]
+            except Exception as e:
+                logging.error(f"Outbox sweep failed: {e}")
+                db.session.rollback()
+                return
+        self._run_many(job_ids)
+
+    def _run_many(self, job_ids):
+        with self.app.app_context():
+            for job_id in job_ids:
+                self._run(job_id)
+
+    def _claim(self, job_id):
+        """Atomically lease a job so only one worker process runs it"""
+        now = datetime.utcnow()
+        result = db.session.execute(
+            update(OutboxJob).where(
+                OutboxJob.id == job_id,
+                OutboxJob.status == 'pending',
+                OutboxJob.available_at <= now,
+                (OutboxJob.locked_until.is_(None)) | (OutboxJob.locked_until < now)
+            ).values(
+                locked_until=now + timedelta(seconds=self.app.config['JOB_LEASE_SECONDS']),
+                attempts=OutboxJob.attempts + 1))
+        db.session.commit()
+        return result.rowcount == 1
+
+    def _run(self, job_id):
+        try:
+            if not self._claim(job_id):
+                return
+        except Exception as e:
+            logging.error(f"Could not claim job {job_id}: {e}")
+            db.session.rollback()
+            return
+
+        job = db.session.get(OutboxJob, job_id)
+        try:
+            handler = self.handlers[job.kind]
+            handler(**json.loads(job.payload))
+            db.session.delete(job)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            self._retry_later(job_id, e)
+
+    def _run_transient(self, kind, payload):
+        with self.app.app_context():
+            try:
+                self.handlers[kind](**payload)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                logging.error(f"Transient job {kind} failed: {e}")
+
+    def _retry_later(self, job_id, error):
+        job = db.session.get(OutboxJob, job_id)
+        if not job:
+            return
+        logging.error(f"Job {job.kind}#{job_id} failed (attempt {job.attempts}): {error}")
+        job.last_error = str(error)
+        job.locked_until = None
+        if job.attempts >= self.app.config['JOB_MAX_ATTEMPTS']:
+            job.status = 'failed'
+        else:
+            # Exponential backoff: 2, 4, 8, ... seconds
+            job.available_at = datetime.utcnow() + timedelta(seconds=2 ** job.attempts)
+        try:
+            db.session.commit()
+        except Exception as e:
+            logging.error(f"Could not reschedule job {job_id}: {e}")
+            db.session.rollback()
+
+    def shutdown(self, timeout=None):
+        """
+        Stop accepting work and drain the in-memory queue
+        Args:
+            timeout: Seconds to wait for queued jobs (defaults to JOB_DRAIN_TIMEOUT)
+        Returns:
+            bool: True if every worker finished within the timeout
+        """
+        if self._pid != os.getpid() or not self._threads:
+            return True
+        if timeout is None:
+            timeout = self.app.config['JOB_DRAIN_TIMEOUT']
+
+        self._stopping.set()
+        deadline = datetime.utcnow() + timedelta(seconds=timeout)
+        for _ in self._threads:
+            try:
+                self._queue.put(None, timeout=timeout)
+            except queue.Full:
+                break
+        threads = self._threads + ([self._sweeper] if self._sweeper else [])
+        for thread in threads:
+            remaining = (deadline - datetime.utcnow()).total_seconds()
+            thread.join(max(remaining, 0))
+
+        drained = not any(thread.is_alive() for thread in threads)
+        if not drained:
+            logging.warning("Job queue drain timed out, unfinished jobs stay in the outbox")
+        self._threads = []
+        self._sweeper = None
+        return drained
+
+
+job_queue = JobQueue()
@@ -0,0 +1,244 @@
+"""
+Schema migrations for the Driver Rating Application
+db.create_all() creates missing tables but never changes existing ones. The
+steps below bring a database created by an earlier version up to the models.
+Every step inspects the live schema or touches only rows still missing data,
+so on a database create_all() has just built it changes nothing and is only
+recorded. Applied steps are kept
+in the schema_migration table; the app runs pending ones at startup.
+
+    flask --app main migrate-db
+"""
+
+import logging
+from contextlib import contextmanager
+
+from sqlalchemy import inspect, literal, select, update
+
+from models import db, Comment, Incident, Report, SchemaMigration, Vehicle
+from incidents import grid_cell
+
+# Any constant shared by all processes; serializes concurrent startups
+MIGRATION_LOCK_ID = 727465
+
+CASCADE_FOREIGN_KEYS = '0001_cascade_foreign_keys'
+
+# Rows per backfill statement
+BACKFILL_CHUNK_SIZE = 1000
+
+# Names of steps known to be applied; a step never becomes unapplied
+_applied = set()
+
+
+def _quote(name):
+    return db.engine.dialect.identifier_preparer.quote(name)
+
+
+def cascade_foreign_keys(connection):
+    """
+    Recreate foreign keys that the models declare with ON DELETE but the
+    database created without it
+    Returns:
+        bool: False if the database cannot alter foreign keys (SQLite)
+    """
+    inspector = inspect(connection)
+    changes = []
+    for table in db.metadata.sorted_tables:
+        if table.info.get('bind_key') or not inspector.has_table(table.name):
+            continue
+        reflected = inspector.get_foreign_keys(table.name)
+        for fk in table.foreign_key_constraints:
+            if fk.ondelete is None:
+                continue
+            columns = [column.name for column in fk.columns]
+            for existing in reflected:
+                if (existing['constrained_columns'] == columns
+                        and existing['referred_table'] == fk.referred_table.name
+                        and (existing['options'].get('ondelete') or '').upper()
+                        != fk.ondelete.upper()):
+                    changes.append((table, fk, existing['name']))
+    if not changes:
+        return True
+
+    if connection.dialect.name == 'sqlite':
+        # Only a table rebuild changes a foreign key here; deletion.py deletes
+        # the dependent rows itself until the database is recreated
+        logging.warning(f"SQLite cannot add ON DELETE CASCADE to {len(changes)} existing "
+                        f"foreign keys; recreate the database to get them")
+        return False
+
+    for table, fk, name in changes:
+        columns = ', '.join(_quote(column.name) for column in fk.columns)
+        referred = ', '.join(_quote(element.column.name) for element in fk.elements)
+        # One statement, so the table is never without the constraint
+        connection.exec_driver_sql(
+            f"ALTER TABLE {_quote(table.name)} DROP CONSTRAINT {_quote(name)}, "
+            f"ADD CONSTRAINT {_quote(name)} FOREIGN KEY ({columns}) "
+            f"REFERENCES {_quote(fk.referred_table.name)} ({referred}) ON DELETE {fk.ondelete}")
+    logging.info(f"Recreated {len(changes)} foreign keys with ON DELETE CASCADE")
+    return True
+
+
+def _default_clause(column, dialect):
+    default = column.default
+    if default is None or not default.is_scalar:
+        return ''
+    value = literal(default.arg, column.type).compile(
+        dialect=dialect, compile_kwargs={'literal_binds': True})
+    return f" DEFAULT {value}"
+
+
+def add_missing_columns(connection):
+    """
+    Add model columns missing from existing tables; NOT NULL columns get
+    their scalar default as the value of existing rows, the others NULL
+    until a backfill step fills them in
+    """
+    inspector = inspect(connection)
+    dialect = connection.dialect
+    added = 0
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            default = _default_clause(column, dialect)
+            if not column.nullable and not default:
+                raise RuntimeError(f"{table.name}.{column.name} is NOT NULL without "
+                                   f"a scalar default; add it with its own migration")
+            connection.exec_driver_sql(
+                f"ALTER TABLE {_quote(table.name)} ADD COLUMN {_quote(column.name)} "
+                f"{column.type.compile(dialect=dialect)}{default}"
+                f"{'' if column.nullable else ' NOT NULL'}")
+            added += 1
+    if added:
+        logging.info(f"Added {added} columns")
+    return True
+
+
+def backfill_columns(connection):
+    """
+    Fill in the columns added by add_missing_columns() for existing rows:
+    vehicle modification times, incident grid cells and comment report
+    priorities
+    """
+    # Imported here: moderation -> deletion -> migrations
+    from moderation import priority_increment, reporter_weight
+
+    session = db.session
+    session.execute(update(Vehicle).where(Vehicle.updated_at.is_(None)).values(
+        updated_at=Vehicle.created_at), execution_options={'synchronize_session': False})
+
+    last_id = 0
+    while True:
+        rows = session.execute(
+            select(Incident.id, Incident.latitude, Incident.longitude).where(
+                Incident.grid_cell.is_(None), Incident.id > last_id).order_by(
+                    Incident.id).limit(BACKFILL_CHUNK_SIZE)).all()
+        if not rows:
+            break
+        session.execute(update(Incident), [
+            {'id': row.id, 'grid_cell': grid_cell(row.latitude, row.longitude)}
+            for row in rows])
+        last_id = rows[-1].id
+
+    # Same sum file_report() keeps: each report adds its reporter's weight,
+    # scaled by when it was filed
+    weights = {}
+    priorities = {}
+    for report in session.execute(
+            select(Report.comment_id, Report.user_id, Report.created_at).join(
+                Comment, Comment.id == Report.comment_id).where(
+                    Comment.report_priority == 0)):
+        if report.user_id not in weights:
+            weights[report.user_id] = reporter_weight(report.user_id)
+        priorities[report.comment_id] = priorities.get(report.comment_id, 0) + \
+            priority_increment(weights[report.user_id], report.created_at)
+    values = [{'id': comment_id, 'report_priority': priority}
+              for comment_id, priority in priorities.items()]
+    for i in range(0, len(values), BACKFILL_CHUNK_SIZE):
+        session.execute(update(Comment), values[i:i + BACKFILL_CHUNK_SIZE])
+    return True
+
+
+def create_missing_indexes(connection):
+    """
+    Create model indexes missing from existing tables; runs after the
+    backfills so the new indexes are built once. Plain CREATE INDEX blocks
+    writes to the table while it runs
+    """
+    inspector = inspect(connection)
+    created = 0
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(connection)
+                created += 1
+    if created:
+        logging.info(f"Created {created} indexes")
+    return True
+
+
+# Applied in this order, each in its own transaction
+MIGRATIONS = [
+    (CASCADE_FOREIGN_KEYS, cascade_foreign_keys),
+    ('0002_add_columns', add_missing_columns),
+    ('0003_backfill_columns', backfill_columns),
+    ('0004_create_indexes', create_missing_indexes),
+    ('0005_add_token_cutoff', add_missing_columns),
+]
+
+
+@contextmanager
+def _migration_lock():
+    if db.engine.dialect.name != 'postgresql':
+        yield
+        return
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        connection.exec_driver_sql(f"SELECT pg_advisory_lock({MIGRATION_LOCK_ID})")
+        try:
+            yield
+        finally:
+            connection.exec_driver_sql(f"SELECT pg_advisory_unlock({MIGRATION_LOCK_ID})")
+
+
+def migrate():
+    """
+    Apply pending migrations (call after db.create_all())
+    Returns:
+        list: Names of the steps applied now
+    """
+    done = []
+    with _migration_lock():
+        applied = set(db.session.scalars(select(SchemaMigration.name)))
+        for name, step in MIGRATIONS:
+            if name in applied:
+                continue
+            if step(db.session.connection()) is False:
+                db.session.rollback()
+                continue
+            migration = SchemaMigration()
+            migration.name = name
+            db.session.add(migration)
+            db.session.commit()
+            done.append(name)
+    _applied.clear()
+    return done
+
+
+def is_applied(name):
+    """
+    Whether a migration step has been applied to the database
+    Args:
+        name: Step name, e.g. CASCADE_FOREIGN_KEYS
+    Returns:
+        bool
+    """
+    if name not in _applied and db.session.get(SchemaMigration, name) is not None:
+        _applied.add(name)
+    return name in _applied
@@ -1,11 +1,30 @@
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy import event, func, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import DeclarativeBase, query_expression, with_expression
+from sqlalchemy.orm.attributes import set_committed_value
 from datetime import datetime
 
+from database import RoutingSession, StrictLoadingError
+
 class Base(DeclarativeBase):
     pass
 
-db = SQLAlchemy(model_class=Base)
+db = SQLAlchemy(model_class=Base, session_options={'class_': RoutingSession})
+
+@event.listens_for(Engine, 'connect')
+def _enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    # SQLite ignores ON DELETE CASCADE unless foreign keys are switched on
+    if type(dbapi_connection).__module__.startswith('sqlite3'):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+# Reputation points per unit of activity, see UserStatistics.update_statistics
+RATING_REPUTATION = 1
+COMMENT_REPUTATION = 2
+INCIDENT_REPUTATION = 3
+HELPFUL_VOTE_REPUTATION = 5
 
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -14,68 +33,117 @@ class User(db.Model):
     password_hash = db.Column(db.String(256), nullable=False)
     is_admin = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    favorites_seen_at = db.Column(db.DateTime)  # start of the favorites feed, see favorites.py
+    tokens_valid_after = db.Column(db.DateTime)  # API tokens issued earlier are refused, see tokens.py
     
     # Relationships
-    ratings = db.relationship('Rating', backref='user', lazy='dynamic', cascade='all, delete-orphan')
-    comments = db.relationship('Comment', backref='user', lazy='dynamic', cascade='all, delete-orphan')
-    reports = db.relationship('Report', backref='user', lazy='dynamic', cascade='all, delete-orphan')
+    # Children are removed by ON DELETE CASCADE; passive_deletes stops the ORM
+    # from loading them first (see deletion.py for batched deletes). The
+    # collections are write-only: reading one means writing its query, e.g.
+    # db.session.scalars(user.ratings.select().limit(10))
+    ratings = db.relationship('Rating', backref='user', lazy='write_only', cascade='all, delete-orphan', passive_deletes=True)
+    comments = db.relationship('Comment', backref='user', lazy='write_only', cascade='all, delete-orphan', passive_deletes=True)
+    reports = db.relationship('Report', backref='user', lazy='write_only', cascade='all, delete-orphan', passive_deletes=True)
 
 class Vehicle(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     license_plate = db.Column(db.String(20), unique=True, nullable=False)
     is_blocked = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
     
     # Relationships
-    ratings = db.relationship('Rating', backref='vehicle', lazy='dynamic', cascade='all, delete-orphan')
-    comments = db.relationship('Comment', backref='vehicle', lazy='dynamic', cascade='all, delete-orphan')
+    ratings = db.relationship('Rating', backref='vehicle', lazy='write_only', cascade='all, delete-orphan', passive_deletes=True)
+    comments = db.relationship('Comment', backref='vehicle', lazy='write_only', cascade='all, delete-orphan', passive_deletes=True)
+    
+    # Filled in by queries using with_rating_stats(), None otherwise
+    average_rating = query_expression()
+    rating_count = query_expression()
+    
+    @classmethod
+    def with_rating_stats(cls, grouped=False):
+        """
+        Loader options filling average_rating and rating_count in the same query
+        Args:
+            grouped: The query joins Rating and groups by Vehicle.id, so plain
+                aggregates can be used instead of a subquery per vehicle
+        Returns:
+            tuple: Options for select(Vehicle).options(...)
+        """
+        if grouped:
+            average, count = func.avg(Rating.rating), func.count(Rating.id)
+        else:
+            ratings = select(Rating.rating).where(Rating.vehicle_id == cls.id).correlate(cls)
+            average = ratings.with_only_columns(func.avg(Rating.rating)).scalar_subquery()
+            count = ratings.with_only_columns(func.count()).scalar_subquery()
+        return (with_expression(cls.average_rating, func.coalesce(average, 0)),
+                with_expression(cls.rating_count, count))
+    
+    def _load_rating_stats(self):
+        if self.rating_count is not None:
+            return
+        if db.session.info.get('strict_loading'):
+            raise StrictLoadingError(
+                f"Rating stats of {self!r} were not loaded; query it with Vehicle.with_rating_stats()")
+        average, count = db.session.execute(
+            select(func.coalesce(func.avg(Rating.rating), 0), func.count())
+            .where(Rating.vehicle_id == self.id)).one()
+        # Kept until the instance is expired, like a loaded expression
+        set_committed_value(self, 'average_rating', average)
+        set_committed_value(self, 'rating_count', count)
     
     def get_average_rating(self):
-        ratings = self.ratings.all()
-        if not ratings:
-            return 0
-        return sum(r.rating for r in ratings) / len(ratings)
+        self._load_rating_stats()
+        return float(self.average_rating)
     
     def get_rating_count(self):
-        return self.ratings.count()
+        self._load_rating_stats()
+        return self.rating_count
 
 class Rating(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    vehicle_id = db.Column(db.Integer, db.ForeignKey('vehicle.id'), nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    vehicle_id = db.Column(db.Integer, db.ForeignKey('vehicle.id', ondelete='CASCADE'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
     rating = db.Column(db.Integer, nullable=False)  # 1-5 stars
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     
-    __table_args__ = (db.UniqueConstraint('vehicle_id', 'user_id', name='unique_user_vehicle_rating'),)
+    __table_args__ = (db.UniqueConstraint('vehicle_id', 'user_id', name='unique_user_vehicle_rating'),
+                      db.Index('ix_rating_vehicle_created', 'vehicle_id', 'created_at'),
+                      db.Index('ix_rating_user_created', 'user_id', 'created_at'))
 
 class Comment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    vehicle_id = db.Column(db.Integer, db.ForeignKey('vehicle.id'), nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    vehicle_id = db.Column(db.Integer, db.ForeignKey('vehicle.id', ondelete='CASCADE'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
     content = db.Column(db.Text, nullable=False)
-    reports = db.Column(db.Integer, default=0)
+    reports = db.Column(db.Integer, default=0, index=True)
+    report_priority = db.Column(db.Float, default=0, nullable=False, index=True)  # see moderation.py
     helpful_votes = db.Column(db.Integer, default=0)
     unhelpful_votes = db.Column(db.Integer, default=0)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     # Relationships
-    report_entries = db.relationship('Report', backref='comment', lazy='dynamic', cascade='all, delete-orphan')
-    votes = db.relationship('CommentVote', backref='comment', lazy='dynamic', cascade='all, delete-orphan')
+    report_entries = db.relationship('Report', backref='comment', lazy='write_only', cascade='all, delete-orphan', passive_deletes=True)
+    votes = db.relationship('CommentVote', backref='comment', lazy='write_only', cascade='all, delete-orphan', passive_deletes=True)
     
     def get_vote_score(self):
         return self.helpful_votes - self.unhelpful_votes
+    
+    # Also serve lookups by vehicle_id / user_id alone
+    __table_args__ = (db.Index('ix_comment_vehicle_created', 'vehicle_id', 'created_at'),
+                      db.Index('ix_comment_user_created', 'user_id', 'created_at'))
 
 class Report(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    comment_id = db.Column(db.Integer, db.ForeignKey('comment.id'), nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    comment_id = db.Column(db.Integer, db.ForeignKey('comment.id', ondelete='CASCADE'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False, index=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     __table_args__ = (db.UniqueConstraint('comment_id', 'user_id', name='unique_user_comment_report'),)
 
 class Incident(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
     license_plate = db.Column(db.String(20), nullable=False)
     latitude = db.Column(db.Float, nullable=False)
     longitude = db.Column(db.Float, nullable=False)
@@ -83,14 +151,54 @@ class Incident(db.Model):
     description = db.Column(db.Text, nullable=False)
     severity = db.Column(db.Integer, default=1)  # 1-5 scale
     is_verified = db.Column(db.Boolean, default=False)
+    corroborations = db.Column(db.Integer, default=1, nullable=False)  # distinct reporters, see incidents.py
+    grid_cell = db.Column(db.BigInteger)  # spatial grid cell for duplicate detection
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     # Relationships
-    user = db.relationship('User', backref=db.backref('incidents', lazy='dynamic'))
+    user = db.relationship('User', backref=db.backref('incidents', lazy='write_only', passive_deletes=True))
+    
+    __table_args__ = (db.Index('ix_incident_user_created', 'user_id', 'created_at'),
+                      db.Index('ix_incident_plate_cell_created', 'license_plate', 'grid_cell', 'created_at'),
+                      db.Index('ix_incident_lat_lng', 'latitude', 'longitude'))
+
+class IncidentCorroboration(db.Model):
+    """Another user's report of an existing incident"""
+    id = db.Column(db.Integer, primary_key=True)
+    incident_id = db.Column(db.Integer, db.ForeignKey('incident.id', ondelete='CASCADE'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False, index=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (db.UniqueConstraint('incident_id', 'user_id', name='unique_user_incident_corroboration'),)
+
+class TrafficSegment(db.Model):
+    """Road segment seen in TomTom flow data, with its hour-of-week speed profile"""
+    id = db.Column(db.BigInteger, primary_key=True, autoincrement=False)  # geometry hash, see traffic_history.py
+    coords = db.Column(db.Text, nullable=False)  # JSON [[lat, lng], ...]
+    frc = db.Column(db.String(8))  # TomTom functional road class
+    latitude = db.Column(db.Float, nullable=False)  # midpoint, for viewport queries
+    longitude = db.Column(db.Float, nullable=False)
+    free_flow_speed = db.Column(db.Float)
+    profile = db.Column(db.LargeBinary)  # 168 little-endian float32 speeds (km/h), Monday 00:00 first
+    profile_samples = db.Column(db.Integer, nullable=False, default=0)
+    profile_built_at = db.Column(db.DateTime, index=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (db.Index('ix_traffic_segment_lat_lng', 'latitude', 'longitude'),)
+
+class TrafficSample(db.Model):
+    """One observed speed of a segment; ``day`` is the retention (partition) key"""
+    id = db.Column(db.Integer, primary_key=True)
+    segment_id = db.Column(db.BigInteger, db.ForeignKey('traffic_segment.id', ondelete='CASCADE'), nullable=False)
+    day = db.Column(db.Date, nullable=False, index=True)  # local date
+    hour_of_week = db.Column(db.SmallInteger, nullable=False)  # local time, 0 = Monday 00:00
+    speed = db.Column(db.SmallInteger, nullable=False)  # km/h
+    free_flow_speed = db.Column(db.SmallInteger)
+    confidence = db.Column(db.SmallInteger)  # percent
 
 class UserStatistics(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), unique=True, nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), unique=True, nullable=False)
     total_ratings = db.Column(db.Integer, default=0)
     total_comments = db.Column(db.Integer, default=0)
     total_reports = db.Column(db.Integer, default=0)
@@ -100,22 +208,24 @@ class UserStatistics(db.Model):
     last_updated = db.Column(db.DateTime, default=datetime.utcnow)
     
     # Relationships
-    user = db.relationship('User', backref=db.backref('statistics', uselist=False))
+    user = db.relationship('User', backref=db.backref('statistics', uselist=False, passive_deletes=True))
     
     def update_statistics(self):
         """Update user statistics based on their activity"""
-        user = self.user
-        self.total_ratings = user.ratings.count()
-        self.total_comments = user.comments.count()
-        self.total_reports = user.reports.count()
-        self.total_incidents = user.incidents.count()
+        def count(model):
+            return select(func.count(model.id)).where(model.user_id == self.user_id).scalar_subquery()
+        
+        # One round trip for all four counts
+        (self.total_ratings, self.total_comments,
+         self.total_reports, self.total_incidents) = db.session.execute(
+            select(count(Rating), count(Comment), count(Report), count(Incident))).one()
         
         # Calculate reputation score
         self.reputation_score = (
-            self.total_ratings * 1 +
-            self.total_comments * 2 +
-            self.total_incidents * 3 +
-            self.helpful_votes * 5
+            self.total_ratings * RATING_REPUTATION +
+            self.total_comments * COMMENT_REPUTATION +
+            self.total_incidents * INCIDENT_REPUTATION +
+            self.helpful_votes * HELPFUL_VOTE_REPUTATION
         )
         
         self.last_updated = datetime.utcnow()
@@ -123,8 +233,8 @@ class UserStatistics(db.Model):
 
 class CommentVote(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    comment_id = db.Column(db.Integer, db.ForeignKey('comment.id'), nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    comment_id = db.Column(db.Integer, db.ForeignKey('comment.id', ondelete='CASCADE'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False, index=True)
     vote_type = db.Column(db.String(10), nullable=False)  # 'helpful' or 'unhelpful'
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
@@ -132,13 +242,40 @@ class CommentVote(db.Model):
 
 class Favorite(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    vehicle_id = db.Column(db.Integer, db.ForeignKey('vehicle.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
+    vehicle_id = db.Column(db.Integer, db.ForeignKey('vehicle.id', ondelete='CASCADE'), nullable=False, index=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     notes = db.Column(db.Text)  # User's personal notes about this vehicle
     
     # Relationships
-    user = db.relationship('User', backref=db.backref('favorites', lazy='dynamic'))
-    vehicle = db.relationship('Vehicle', backref=db.backref('favorited_by', lazy='dynamic'))
+    user = db.relationship('User', backref=db.backref('favorites', lazy='write_only', passive_deletes=True))
+    vehicle = db.relationship('Vehicle', backref=db.backref('favorited_by', lazy='write_only', passive_deletes=True))
     
-    __table_args__ = (db.UniqueConstraint('user_id', 'vehicle_id', name='unique_user_vehicle_favorite'),)
+    __table_args__ = (db.UniqueConstraint('user_id', 'vehicle_id', name='unique_user_vehicle_favorite'),
+                      db.Index('ix_favorite_user_created', 'user_id', 'created_at'))
+
+class OutboxJob(db.Model):
+    """Durable write-behind job, committed in the same transaction as the row that caused it"""
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(64), nullable=False)
+    payload = db.Column(db.Text, nullable=False, default='{}')  # JSON encoded kwargs
+    status = db.Column(db.String(16), nullable=False, default='pending')  # 'pending' or 'failed'
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.Text)
+    available_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    locked_until = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (db.Index('ix_outbox_job_status_available', 'status', 'available_at'),)
+
+class RevokedToken(db.Model):
+    """API token revoked before its expiry, see tokens.py"""
+    jti = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False, index=True)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class SchemaMigration(db.Model):
+    """Schema change applied to an existing database, see migrations.py"""
+    name = db.Column(db.String(64), primary_key=True)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -0,0 +1,197 @@
+"""
+Moderation queue for the Driver Rating Application
+Keeps comment report counters and priorities up to date with atomic SQL and
+serves flagged comments to /admin as a paginated priority queue
+"""
+
+import math
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
+
+from models import db, Comment, Report, UserStatistics, Vehicle
+from deletion import (chunked, delete_dependents, delete_in_chunks, release_comment_aggregates,
+                      release_reporter_aggregates, DEFAULT_CHUNK_SIZE)
+
+# Report priority decays with this half-life. Instead of decaying every stored
+# score, each new report adds weight * 2^(age of epoch / half-life), so newer
+# reports count for more and ORDER BY report_priority stays a plain index scan.
+REPORT_HALF_LIFE = timedelta(days=7)
+PRIORITY_EPOCH = datetime(2025, 1, 1)
+
+# Reporter reputation above this adds no further weight
+MAX_REPUTATION_BONUS = 100
+
+
+def reporter_weight(user_id):
+    """
+    Weight of a single report, between 1.0 and 2.0 depending on reputation
+    Args:
+        user_id: Reporting user's ID
+    Returns:
+        float: Report weight
+    """
+    reputation = db.session.execute(
+        select(UserStatistics.reputation_score).where(
+            UserStatistics.user_id == user_id)).scalar() or 0
+    reputation = min(max(reputation, 0), MAX_REPUTATION_BONUS)
+    return 1.0 + reputation / MAX_REPUTATION_BONUS
+
+
+def priority_increment(weight, now=None):
+    """
+    Time-scaled priority contribution of one report
+    Args:
+        weight: Report weight from reporter_weight()
+        now: Report time (defaults to the current UTC time)
+    Returns:
+        float: Amount to add to Comment.report_priority
+    """
+    now = now or datetime.utcnow()
+    age = (now - PRIORITY_EPOCH) / REPORT_HALF_LIFE
+    return weight * math.pow(2.0, age)
+
+
+def file_report(comment_id, user_id):
+    """
+    Report a comment and bump its counters in a single UPDATE
+    Args:
+        comment_id: Comment ID
+        user_id: Reporting user's ID
+    Returns:
+        bool: False if the comment does not exist
+    Raises:
+        ValueError: If the user already reported this comment
+    """
+    exists = db.session.execute(
+        select(Comment.id).where(Comment.id == comment_id)).scalar()
+    if exists is None:
+        return False
+
+    report = Report()
+    report.comment_id = comment_id
+    report.user_id = user_id
+    try:
+        with db.session.begin_nested():
+            db.session.add(report)
+    except IntegrityError:
+        raise ValueError("Już zgłosiłeś ten komentarz")
+
+    db.session.execute(
+        update(Comment).where(Comment.id == comment_id).values(
+            reports=Comment.reports + 1,
+            report_priority=Comment.report_priority +
+            priority_increment(reporter_weight(user_id))))
+    return True
+
+
+def moderation_queue(page=1, per_page=20):
+    """
+    Flagged comments ordered by report priority
+    Args:
+        page: 1-based page number
+        per_page: Comments per page
+    Returns:
+        Pagination object with users and vehicles eager-loaded
+    """
+    query = select(Comment).where(Comment.reports > 0).options(
+        joinedload(Comment.user), joinedload(Comment.vehicle)).order_by(
+            Comment.report_priority.desc(), Comment.id.desc())
+    return db.paginate(query, page=page, per_page=per_page,
+                       max_per_page=100, error_out=False)
+
+
+def clear_reports(comment_ids, chunk_size=DEFAULT_CHUNK_SIZE, progress=None):
+    """
+    Dismiss all reports for the given comments
+    Args:
+        comment_ids: Iterable of comment IDs
+        chunk_size: IDs per transaction
+        progress: Optional callback(done, total) called after each chunk
+    Returns:
+        int: Number of comments whose counters were reset
+    """
+    comment_ids = list(comment_ids)
+    cleared = 0
+    for i, chunk in enumerate(chunked(comment_ids, chunk_size)):
+        if i:
+            # Commit between chunks so locks are held for one chunk only
+            db.session.commit()
+        release_reporter_aggregates(chunk)
+        db.session.execute(delete(Report).where(Report.comment_id.in_(chunk)),
+                           execution_options={'synchronize_session': False})
+        cleared += db.session.execute(
+            update(Comment).where(Comment.id.in_(chunk)).values(
+                reports=0, report_priority=0),
+            execution_options={'synchronize_session': False}).rowcount
+        if progress:
+            progress(min((i + 1) * chunk_size, len(comment_ids)), len(comment_ids))
+    return cleared
+
+
+def delete_comments(comment_ids, chunk_size=DEFAULT_CHUNK_SIZE, progress=None):
+    """
+    Delete comments; their reports and votes go with them via ON DELETE CASCADE
+    Args:
+        comment_ids: Iterable of comment IDs
+        chunk_size: IDs per transaction
+        progress: Optional callback(done, total) called after each chunk
+    Returns:
+        int: Number of deleted comments
+    """
+    comment_ids = list(comment_ids)
+    deleted = 0
+    for i, chunk in enumerate(chunked(comment_ids, chunk_size)):
+        if i:
+            db.session.commit()
+        release_comment_aggregates(chunk)
+        delete_dependents(Comment.__table__, Comment.id.in_(chunk))
+        deleted += db.session.execute(
+            delete(Comment).where(Comment.id.in_(chunk)),
+            execution_options={'synchronize_session': False}).rowcount
+        if progress:
+            progress(min((i + 1) * chunk_size, len(comment_ids)), len(comment_ids))
+    return deleted
+
+
+def purge_user_comments(user_id, chunk_size=DEFAULT_CHUNK_SIZE, progress=None):
+    """
+    Delete every comment written by a user, one committed chunk at a time
+    Args:
+        user_id: Author's user ID
+        chunk_size: Comments per transaction
+        progress: Optional callback(done, total) called after each chunk
+    Returns:
+        int: Number of deleted comments
+    """
+    return delete_in_chunks(
+        Comment, Comment.user_id == user_id, release_comment_aggregates,
+        chunk_size=chunk_size,
+        progress=progress and (lambda table, done, total: progress(done, total)))
+
+
+def set_vehicles_blocked(license_plates, blocked=True, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Block or unblock many vehicles with one UPDATE per chunk
+    Args:
+        license_plates: Iterable of normalized license plates
+        blocked: New blocked flag
+        chunk_size: Plates per statement
+    Returns:
+        tuple: (number of updated vehicles, list of unknown plates)
+    """
+    license_plates = list(dict.fromkeys(license_plates))
+    updated = 0
+    missing = []
+    for chunk in chunked(license_plates, chunk_size):
+        found = set(db.session.execute(
+            select(Vehicle.license_plate).where(
+                Vehicle.license_plate.in_(chunk))).scalars())
+        missing.extend(p for p in chunk if p not in found)
+        updated += db.session.execute(
+            update(Vehicle).where(Vehicle.license_plate.in_(chunk)).values(
+                is_blocked=blocked),
+            execution_options={'synchronize_session': False}).rowcount
+    return updated, missing
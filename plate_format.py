@@ -0,0 +1,85 @@
+"""
+License plate canonicalization for the Driver Rating Application
+Single place that decides what a plate looks like in the database: upper case,
+no spaces or separators, letters and digits only. Also classifies Polish plates
+by format and voivodeship.
+"""
+
+import re
+from collections import namedtuple
+
+MIN_PLATE_LENGTH = 2
+MAX_PLATE_LENGTH = 10
+
+# Already canonical input (the common case for API clients) skips the rewrite
+_CANONICAL = re.compile(r'[A-Z0-9]{%d,%d}' % (MIN_PLATE_LENGTH, MAX_PLATE_LENGTH))
+_SEPARATORS = re.compile(r'[\s\-.]+')
+
+# 2-3 letter district code followed by 4-5 characters, 7-8 in total
+_STANDARD = re.compile(r'(?=.{7,8}$)[A-Z]{2,3}[A-Z0-9]{4,5}')
+# Voivodeship letter, digit 1-9, then 3-5 characters starting with a letter
+_CUSTOM = re.compile(r'[A-Z][1-9][A-Z][A-Z0-9]{2,4}')
+
+VOIVODESHIPS = {
+    'B': 'podlaskie',
+    'C': 'kujawsko-pomorskie',
+    'D': 'dolnośląskie',
+    'E': 'łódzkie',
+    'F': 'lubuskie',
+    'G': 'pomorskie',
+    'K': 'małopolskie',
+    'L': 'lubelskie',
+    'N': 'warmińsko-mazurskie',
+    'O': 'opolskie',
+    'P': 'wielkopolskie',
+    'R': 'podkarpackie',
+    'S': 'śląskie',
+    'T': 'świętokrzyskie',
+    'W': 'mazowieckie',
+    'Z': 'zachodniopomorskie',
+}
+
+PlateInfo = namedtuple('PlateInfo', 'plate kind voivodeship')
+
+
+def canonical_plate(plate):
+    """
+    Canonical form of a license plate
+    Args:
+        plate: Plate as typed by the user, e.g. "wa 123-45"
+    Returns:
+        str: Canonical plate ("WA12345"), or None if the input is not a valid plate
+    """
+    if not isinstance(plate, str):
+        return None
+    if _CANONICAL.fullmatch(plate):
+        return plate
+    plate = _SEPARATORS.sub('', plate.upper())
+    return plate if _CANONICAL.fullmatch(plate) else None
+
+
+def is_valid_plate(plate):
+    """Check whether a plate canonicalizes to a valid plate"""
+    return canonical_plate(plate) is not None
+
+
+def classify_plate(plate):
+    """
+    Classify a canonical plate by Polish registration format
+    Args:
+        plate: Canonical plate
+    Returns:
+        PlateInfo: kind is 'custom', 'standard', 'service', 'military' or
+        'other' (foreign, temporary, vintage...); voivodeship is None unless known
+    """
+    if _CUSTOM.fullmatch(plate) and plate[0] in VOIVODESHIPS:
+        return PlateInfo(plate, 'custom', VOIVODESHIPS[plate[0]])
+    if _STANDARD.fullmatch(plate):
+        prefix = plate[0]
+        if prefix in VOIVODESHIPS:
+            return PlateInfo(plate, 'standard', VOIVODESHIPS[prefix])
+        if prefix == 'H':
+            return PlateInfo(plate, 'service', None)
+        if prefix == 'U':
+            return PlateInfo(plate, 'military', None)
+    return PlateInfo(plate, 'other', None)
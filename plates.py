@@ -0,0 +1,389 @@
+"""
+In-memory plate directory for the Driver Rating Application
+Maps license plates to vehicle id, blocked flag and rating aggregates so that
+existence checks and autocomplete don't need a database round trip, and merges
+vehicles whose plates only differ in spelling
+"""
+
+import bisect
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from collections import defaultdict
+
+from sqlalchemy import Integer, cast, delete, event, func, select, union, update
+from sqlalchemy.orm import object_session
+
+from models import db, Comment, Favorite, Incident, Rating, Vehicle
+from deletion import release_rating_aggregates
+from plate_format import canonical_plate
+
+_NO_SYNC = {'synchronize_session': False}
+
+
+class PlateEntry:
+    """Directory record for one vehicle"""
+
+    __slots__ = ('vehicle_id', 'is_blocked', 'rating_count', 'rating_sum')
+
+    def __init__(self, vehicle_id, is_blocked, rating_count, rating_sum):
+        self.vehicle_id = vehicle_id
+        self.is_blocked = bool(is_blocked)
+        self.rating_count = rating_count or 0
+        self.rating_sum = rating_sum or 0
+
+    @property
+    def avg_rating(self):
+        return self.rating_sum / self.rating_count if self.rating_count else 0
+
+
+class PlateDirectory:
+    """
+    Process-local plate index.
+
+    Plates are kept in a sorted list for prefix search (bisect) next to a
+    dict of ``PlateEntry`` objects for exact lookups. ORM writes to vehicles
+    and ratings mark the affected vehicles dirty and they are reloaded on the
+    next lookup after commit; set-based writes and other workers' changes are
+    picked up by a delta reload every ``PLATE_DIRECTORY_REFRESH`` seconds, and
+    a full reload every ``PLATE_DIRECTORY_FULL_RELOAD`` seconds drops deleted
+    plates. Exact lookups that miss fall back to the database, so a vehicle
+    created by another worker is found immediately.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._entries = {}
+        self._plates = []
+        self._by_id = {}
+        self._dirty = set()
+        self._lock = threading.RLock()
+        self._loaded_at = None
+        self._refreshed_at = None
+        self._synced_until = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Configure the directory for a Flask application
+        Args:
+            app: Flask application instance
+        """
+        app.config.setdefault('PLATE_DIRECTORY_REFRESH',
+                              float(os.environ.get('PLATE_DIRECTORY_REFRESH', 30)))
+        app.config.setdefault('PLATE_DIRECTORY_FULL_RELOAD',
+                              float(os.environ.get('PLATE_DIRECTORY_FULL_RELOAD', 3600)))
+        self.app = app
+        app.extensions['plate_directory'] = self
+
+        for model in (Vehicle, Rating):
+            for name in ('after_insert', 'after_update', 'after_delete'):
+                event.listen(model, name, self._mark_dirty)
+        event.listen(db.session, 'after_commit', self._after_commit)
+        event.listen(db.session, 'after_soft_rollback', self._after_rollback)
+
+    def _mark_dirty(self, mapper, connection, target):
+        vehicle_id = target.id if isinstance(target, Vehicle) else target.vehicle_id
+        object_session(target).info.setdefault('dirty_vehicles', set()).add(vehicle_id)
+
+    def _after_commit(self, session):
+        if session.in_nested_transaction():
+            # A released savepoint, not the real commit
+            return
+        # No SQL can be emitted here, the reload happens on the next lookup
+        vehicle_ids = session.info.pop('dirty_vehicles', None)
+        if vehicle_ids and self._loaded_at is not None:
+            with self._lock:
+                self._dirty |= vehicle_ids
+
+    def _after_rollback(self, session, previous_transaction):
+        # Only a full rollback; a rolled back savepoint may leave extra
+        # marks, they only cost a reload
+        if previous_transaction.parent is None:
+            session.info.pop('dirty_vehicles', None)
+
+    def _aggregate_query(self):
+        return select(
+            Vehicle.id, Vehicle.license_plate, Vehicle.is_blocked,
+            func.count(Rating.id), func.sum(Rating.rating)).outerjoin(
+                Rating, Rating.vehicle_id == Vehicle.id).group_by(Vehicle.id)
+
+    def load(self):
+        """Build the directory from scratch"""
+        started = datetime.utcnow()
+        entries = {}
+        by_id = {}
+        for vehicle_id, plate, blocked, count, total in db.session.execute(
+                self._aggregate_query()):
+            entries[plate] = PlateEntry(vehicle_id, blocked, count, total)
+            by_id[vehicle_id] = plate
+        plates = sorted(entries)
+
+        with self._lock:
+            self._entries, self._plates, self._by_id = entries, plates, by_id
+            self._loaded_at = self._refreshed_at = time.monotonic()
+            self._synced_until = started
+
+    def reload_vehicles(self, vehicle_ids):
+        """
+        Reload the given vehicles (or rows selected by a subquery)
+        Args:
+            vehicle_ids: Iterable of vehicle IDs or a SELECT of IDs
+        """
+        rows = db.session.execute(
+            self._aggregate_query().where(Vehicle.id.in_(vehicle_ids))).all()
+        with self._lock:
+            for vehicle_id, plate, blocked, count, total in rows:
+                old_plate = self._by_id.get(vehicle_id)
+                if old_plate is not None and old_plate != plate:
+                    self._remove_plate(old_plate)
+                if plate not in self._entries:
+                    bisect.insort(self._plates, plate)
+                self._entries[plate] = PlateEntry(vehicle_id, blocked, count, total)
+                self._by_id[vehicle_id] = plate
+
+    def discard(self, plate):
+        """Drop a plate, e.g. after finding its vehicle was deleted"""
+        with self._lock:
+            self._remove_plate(plate)
+
+    def _remove_plate(self, plate):
+        entry = self._entries.pop(plate, None)
+        if entry is None:
+            return
+        self._by_id.pop(entry.vehicle_id, None)
+        i = bisect.bisect_left(self._plates, plate)
+        if i < len(self._plates) and self._plates[i] == plate:
+            del self._plates[i]
+
+    def refresh(self):
+        """Delta reload of vehicles changed or rated since the last sync"""
+        started = datetime.utcnow()
+        # Small overlap covers transactions that committed during the last sync
+        since = self._synced_until - timedelta(seconds=5)
+        changed = union(
+            select(Vehicle.id).where(Vehicle.updated_at > since),
+            select(Rating.vehicle_id).where(Rating.created_at > since)).subquery()
+        self.reload_vehicles(select(changed.c[0]))
+        with self._lock:
+            self._refreshed_at = time.monotonic()
+            self._synced_until = started
+
+    def _ensure_fresh(self):
+        now = time.monotonic()
+        if self._loaded_at is None or now - self._loaded_at > self.app.config['PLATE_DIRECTORY_FULL_RELOAD']:
+            with self._lock:
+                if self._loaded_at is None or now - self._loaded_at > self.app.config['PLATE_DIRECTORY_FULL_RELOAD']:
+                    self._dirty = set()
+                    self.load()
+                    return
+        if self._dirty:
+            with self._lock:
+                pending, self._dirty = self._dirty, set()
+            self.reload_vehicles(pending)
+        if now - self._refreshed_at > self.app.config['PLATE_DIRECTORY_REFRESH']:
+            with self._lock:
+                if now - self._refreshed_at > self.app.config['PLATE_DIRECTORY_REFRESH']:
+                    self.refresh()
+
+    def get(self, plate):
+        """
+        Look up a normalized plate
+        Args:
+            plate: Normalized license plate
+        Returns:
+            PlateEntry or None
+        """
+        self._ensure_fresh()
+        entry = self._entries.get(plate)
+        if entry is None:
+            self.reload_vehicles(
+                select(Vehicle.id).where(Vehicle.license_plate == plate))
+            entry = self._entries.get(plate)
+        return entry
+
+    def get_many(self, plates):
+        """
+        Look up several plates at once
+        Returns:
+            dict: plate -> PlateEntry for the plates that exist
+        """
+        self._ensure_fresh()
+        missing = [plate for plate in plates if plate not in self._entries]
+        if missing:
+            self.reload_vehicles(
+                select(Vehicle.id).where(Vehicle.license_plate.in_(missing)))
+        entries = self._entries
+        return {plate: entries[plate] for plate in plates if plate in entries}
+
+    def complete(self, prefix, limit=10, include_blocked=False):
+        """
+        Plates starting with a prefix, in sorted order
+        Args:
+            prefix: Normalized plate prefix
+            limit: Maximum number of results
+            include_blocked: Whether blocked vehicles are returned
+        Returns:
+            list of (plate, PlateEntry) tuples
+        """
+        self._ensure_fresh()
+        plates, entries = self._plates, self._entries
+        results = []
+        i = bisect.bisect_left(plates, prefix)
+        while i < len(plates) and len(results) < limit:
+            plate = plates[i]
+            if not plate.startswith(prefix):
+                break
+            entry = entries.get(plate)
+            if entry is not None and (include_blocked or not entry.is_blocked):
+                results.append((plate, entry))
+            i += 1
+        return results
+
+    def __len__(self):
+        return len(self._entries)
+
+
+plate_directory = PlateDirectory()
+
+
+def find_duplicate_plates():
+    """
+    Group vehicles by canonical plate
+    Returns:
+        tuple: (dict canonical plate -> list of (vehicle id, stored plate) for
+        groups that need merging or renaming, list of invalid stored plates)
+    """
+    groups = defaultdict(list)
+    invalid = []
+    rows = db.session.execute(
+        select(Vehicle.id, Vehicle.license_plate).order_by(Vehicle.id).execution_options(
+            yield_per=5000))
+    for vehicle_id, plate in rows:
+        canonical = canonical_plate(plate)
+        if canonical is None:
+            invalid.append(plate)
+        else:
+            groups[canonical].append((vehicle_id, plate))
+
+    return {canonical: vehicles for canonical, vehicles in groups.items()
+            if len(vehicles) > 1 or vehicles[0][1] != canonical}, invalid
+
+
+def _losers(rows):
+    """IDs of all but the first row per user, rows being (id, user_id) in preference order"""
+    seen = set()
+    losers = []
+    for row_id, user_id in rows:
+        if user_id in seen:
+            losers.append(row_id)
+        else:
+            seen.add(user_id)
+    return losers
+
+
+def merge_vehicles(canonical, vehicles):
+    """
+    Merge vehicles sharing a canonical plate into one row (caller commits)
+    Args:
+        canonical: Canonical plate
+        vehicles: List of (vehicle id, stored plate)
+    Returns:
+        int: ID of the surviving vehicle
+    """
+    # Keep the row already stored canonically, else the oldest
+    survivor = next((vid for vid, plate in vehicles if plate == canonical), vehicles[0][0])
+    duplicates = [vid for vid, _ in vehicles if vid != survivor]
+    group = [survivor] + duplicates
+
+    if duplicates:
+        # One rating per user and vehicle: keep each user's latest
+        stale_ratings = _losers(db.session.execute(
+            select(Rating.id, Rating.user_id).where(Rating.vehicle_id.in_(group)).order_by(
+                Rating.user_id, Rating.created_at.desc(), Rating.id.desc())))
+        if stale_ratings:
+            release_rating_aggregates(stale_ratings)
+            db.session.execute(delete(Rating).where(Rating.id.in_(stale_ratings)),
+                               execution_options=_NO_SYNC)
+
+        # One favorite per user and vehicle: keep each user's first
+        stale_favorites = _losers(db.session.execute(
+            select(Favorite.id, Favorite.user_id).where(Favorite.vehicle_id.in_(group)).order_by(
+                Favorite.user_id, Favorite.created_at, Favorite.id)))
+        if stale_favorites:
+            db.session.execute(delete(Favorite).where(Favorite.id.in_(stale_favorites)),
+                               execution_options=_NO_SYNC)
+
+        for model in (Rating, Comment, Favorite):
+            db.session.execute(
+                update(model).where(model.vehicle_id.in_(duplicates)).values(
+                    vehicle_id=survivor), execution_options=_NO_SYNC)
+
+        blocked, created_at = db.session.execute(
+            select(func.max(cast(Vehicle.is_blocked, Integer)),
+                   func.min(Vehicle.created_at)).where(Vehicle.id.in_(group))).one()
+        db.session.execute(delete(Vehicle).where(Vehicle.id.in_(duplicates)),
+                           execution_options=_NO_SYNC)
+        db.session.execute(
+            update(Vehicle).where(Vehicle.id == survivor).values(
+                is_blocked=bool(blocked), created_at=created_at),
+            execution_options=_NO_SYNC)
+
+    db.session.execute(
+        update(Vehicle).where(Vehicle.id == survivor).values(license_plate=canonical),
+        execution_options=_NO_SYNC)
+    return survivor
+
+
+def canonicalize_incident_plates():
+    """
+    Rewrite incident plates to canonical form (caller commits)
+    Returns:
+        int: Number of updated incidents
+    """
+    updated = 0
+    stored = db.session.execute(select(Incident.license_plate).distinct()).scalars().all()
+    for plate in stored:
+        canonical = canonical_plate(plate)
+        if canonical and canonical != plate:
+            updated += db.session.execute(
+                update(Incident).where(Incident.license_plate == plate).values(
+                    license_plate=canonical), execution_options=_NO_SYNC).rowcount
+    return updated
+
+
+def merge_duplicate_plates(dry_run=False, progress=None):
+    """
+    Consolidate vehicles whose plates only differ in spelling ("WA 12345" and
+    "WA12345"), moving their ratings, comments and favorites to one row and
+    storing every plate in canonical form. Each vehicle group is committed
+    separately.
+    Args:
+        dry_run: Only report what would be merged
+        progress: Optional callback(done, total)
+    Returns:
+        dict: Counts of merged groups, removed vehicles, renamed incidents and
+        the list of stored plates that are not valid
+    """
+    groups, invalid = find_duplicate_plates()
+    summary = {
+        'groups': len(groups),
+        'vehicles_removed': sum(len(vehicles) - 1 for vehicles in groups.values()),
+        'incidents_updated': 0,
+        'invalid_plates': invalid,
+    }
+    if dry_run:
+        return summary
+
+    for done, (canonical, vehicles) in enumerate(groups.items(), 1):
+        merge_vehicles(canonical, vehicles)
+        db.session.commit()
+        if progress:
+            progress(done, len(groups))
+
+    summary['incidents_updated'] = canonicalize_incident_plates()
+    db.session.commit()
+    return summary
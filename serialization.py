@@ -0,0 +1,143 @@
+"""
+Serialization of JSON API responses for the Driver Rating Application
+Builds payloads straight from SQLAlchemy result rows (column queries, no ORM
+objects), either one object per row or columnar ``{"fields": [...], "rows":
+[[...], ...]}`` for large lists such as map data, and encodes them with
+orjson when it is installed.
+
+    TOP_VEHICLES = Schema('license_plate', ('avg_rating', float), 'rating_count')
+
+    rows = db.session.execute(select(Vehicle.license_plate,
+                                     func.avg(Rating.rating).label('avg_rating'), ...))
+    return json_response({'top_vehicles': TOP_VEHICLES.dump(rows)})
+"""
+
+import json
+from datetime import date, datetime
+from decimal import Decimal
+
+from flask import Response
+
+try:
+    import orjson
+except ImportError:
+    # Optional; the standard library encoder writes the same documents
+    orjson = None
+
+
+def _default(value):
+    # Types column queries return that JSON has no type for
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(payload):
+    """
+    Compact JSON encoding of a payload
+    Args:
+        payload: JSON-compatible data; Decimals, dates and datetimes are
+            written as numbers and ISO 8601 strings
+    Returns:
+        bytes: UTF-8 encoded JSON
+    """
+    if orjson is not None:
+        return orjson.dumps(payload, default=_default)
+    return json.dumps(payload, default=_default, ensure_ascii=False,
+                      separators=(',', ':')).encode('utf-8')
+
+
+def json_response(payload, status=200):
+    """JSON response for a payload, see dumps()"""
+    return Response(dumps(payload), status=status, mimetype='application/json')
+
+
+class Schema:
+    """
+    Fields of a payload, each a column label of the query, optionally with a
+    converter applied to non-null values (e.g. ``float`` for averages, which
+    PostgreSQL returns as Decimal).
+
+    For each column layout it is used with, the schema compiles one list
+    comprehension that unpacks the rows and builds the output, so no
+    per-row or per-field Python calls are made beyond the converters.
+    """
+
+    def __init__(self, *fields):
+        """
+        Args:
+            fields: Column labels, or (label, converter) pairs
+        """
+        self.fields = tuple((field, None) if isinstance(field, str) else tuple(field)
+                            for field in fields)
+        self.names = [name for name, _ in self.fields]
+        # Column labels -> (objects, columns) functions
+        self._compiled = {}
+
+    def _compile(self, keys):
+        keys = tuple(keys)
+        compiled = self._compiled.get(keys)
+        if compiled is not None:
+            return compiled
+
+        namespace = {}
+        values = []
+        for name, convert in self.fields:
+            if name not in keys:
+                raise KeyError(f"Query has no column '{name}' (columns: {', '.join(keys)})")
+            column = f'c{keys.index(name)}'
+            if convert is None:
+                values.append(column)
+            else:
+                namespace[f'convert_{column}'] = convert
+                values.append(f'(None if {column} is None else convert_{column}({column}))')
+
+        # Labels only appear as repr() string literals, values by position
+        unpack = ', '.join(f'c{i}' for i in range(len(keys))) + ','
+        obj = ', '.join(f'{name!r}: {value}' for name, value in zip(self.names, values))
+        source = (f"def objects(rows):\n"
+                  f"    return [{{{obj}}} for {unpack} in rows]\n"
+                  f"def columns(rows):\n"
+                  f"    return [[{', '.join(values)}] for {unpack} in rows]\n")
+        exec(compile(source, f'<schema {", ".join(self.names)}>', 'exec'), namespace)
+        compiled = (namespace['objects'], namespace['columns'])
+        # Racing threads compile the same functions, either copy will do
+        self._compiled[keys] = compiled
+        return compiled
+
+    @staticmethod
+    def _rows(rows):
+        """(column labels, rows) of a Result or a list of Rows"""
+        if hasattr(rows, 'keys'):
+            return list(rows.keys()), rows
+        rows = list(rows)
+        return (list(rows[0]._fields) if rows else None), rows
+
+    def dump(self, rows):
+        """
+        One object per row
+        Args:
+            rows: Result of a column query, or a list of its Rows
+        Returns:
+            list: Dicts with the schema's fields
+        """
+        keys, rows = self._rows(rows)
+        if keys is None:
+            return []
+        return self._compile(keys)[0](rows)
+
+    def dump_columns(self, rows):
+        """
+        Columnar payload: the field names once, then one array per row.
+        Much smaller than objects for long lists, clients zip them back.
+        Args:
+            rows: Result of a column query, or a list of its Rows
+        Returns:
+            dict: {'fields': [...], 'rows': [[...], ...]}
+        """
+        keys, rows = self._rows(rows)
+        if keys is None:
+            return {'fields': self.names, 'rows': []}
+        return {'fields': self.names, 'rows': self._compile(keys)[1](rows)}
@@ -15,8 +15,24 @@ class PWAManager {
     async registerServiceWorker() {
         if ('serviceWorker' in navigator) {
             try {
-                const registration = await navigator.serviceWorker.register('/static/sw.js');
+                // Earlier versions registered /static/sw.js, which only controlled /static/
+                const registrations = await navigator.serviceWorker.getRegistrations();
+                for (const old of registrations) {
+                    if (new URL(old.scope).pathname === '/static/') {
+                        await old.unregister();
+                    }
+                }
+
+                const registration = await navigator.serviceWorker.register('/sw.js', {scope: '/'});
                 console.log('Service Worker registered successfully:', registration.scope);
+
+                navigator.serviceWorker.addEventListener('message', (event) => {
+                    if (event.data && event.data.type === 'writes-replayed') {
+                        this.showReplayStatus(event.data.applied, event.data.rejected);
+                    }
+                });
+                // Browsers without background sync replay when a page opens or comes online
+                this.replayQueuedWrites();
                 
                 // Handle updates
                 registration.addEventListener('updatefound', () => {
@@ -98,6 +114,7 @@ class PWAManager {
         window.addEventListener('online', () => {
             console.log('Back online');
             this.showNetworkStatus('Połączenie przywrócone', 'success');
+            this.replayQueuedWrites();
         });
 
         window.addEventListener('offline', () => {
@@ -106,6 +123,25 @@ class PWAManager {
         });
     }
 
+    replayQueuedWrites() {
+        if ('serviceWorker' in navigator && navigator.serviceWorker.controller) {
+            // Offline writes are kept per user (see sw.js). A page served
+            // from the offline cache may show an old session, so only say
+            // who is logged in when online
+            const userId = navigator.onLine ? Number(document.body.dataset.userId) || null : undefined;
+            navigator.serviceWorker.controller.postMessage({type: 'replay-writes', userId: userId});
+        }
+    }
+
+    showReplayStatus(applied, rejected) {
+        // One alert at a time, see showNetworkStatus()
+        if (rejected) {
+            this.showNetworkStatus(`Wysłano zmiany zapisane offline: ${applied}, odrzucono: ${rejected}`, 'warning');
+        } else {
+            this.showNetworkStatus(`Wysłano zmiany zapisane offline: ${applied}`, 'success');
+        }
+    }
+
     showNetworkStatus(message, type) {
         // Remove existing network status
         const existing = document.querySelector('.network-status');
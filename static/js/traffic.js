@@ -347,46 +347,38 @@ class TrafficMap {
     processTomTomTrafficData(data) {
         const trafficSegments = [];
         
-        if (data && data.flowSegmentData) {
-            data.flowSegmentData.forEach(segment => {
-                if (segment.coordinates && segment.coordinates.coordinate) {
-                    const coords = segment.coordinates.coordinate.map(coord => [coord.latitude, coord.longitude]);
-                    
-                    // Get speed data
-                    const currentSpeed = segment.currentSpeed || 0; // m/s
-                    const freeFlowSpeed = segment.freeFlowSpeed || currentSpeed; // m/s
-                    const confidence = segment.confidence || 0.7;
-                    
-                    // Convert speeds from m/s to km/h
-                    const currentSpeedKmh = Math.round(currentSpeed * 3.6);
-                    const freeFlowSpeedKmh = Math.round(freeFlowSpeed * 3.6);
-                    
-                    // Calculate traffic level based on speed ratio
-                    const speedRatio = freeFlowSpeed > 0 ? currentSpeed / freeFlowSpeed : 1;
-                    let level = 'light';
-                    
-                    if (speedRatio < 0.3) {
-                        level = 'jam';
-                    } else if (speedRatio < 0.5) {
-                        level = 'heavy';
-                    } else if (speedRatio < 0.7) {
-                        level = 'moderate';
-                    }
-                    
-                    // Get road information
-                    const roadName = segment.roadClosure ? 'Zamknięta droga' : 
-                                   (segment.functionalRoadClass ? `Droga klasy ${segment.functionalRoadClass}` : 'Droga');
-                    
-                    trafficSegments.push({
-                        coords: coords,
-                        level: level,
-                        speed: currentSpeedKmh,
-                        name: roadName,
-                        freeFlowSpeed: freeFlowSpeedKmh,
-                        confidence: Math.round(confidence * 100),
-                        speedRatio: Math.round(speedRatio * 100)
-                    });
+        if (data && data.segments) {
+            // Compact viewport payload: speeds already in km/h, coords as [lat, lng]
+            data.segments.forEach(segment => {
+                const currentSpeedKmh = Math.round(segment.speed || 0);
+                const freeFlowSpeedKmh = Math.round(segment.freeFlowSpeed || currentSpeedKmh);
+                const confidence = segment.confidence || 0.7;
+                
+                // Calculate traffic level based on speed ratio
+                const speedRatio = freeFlowSpeedKmh > 0 ? currentSpeedKmh / freeFlowSpeedKmh : 1;
+                let level = 'light';
+                
+                if (segment.closed || speedRatio < 0.3) {
+                    level = 'jam';
+                } else if (speedRatio < 0.5) {
+                    level = 'heavy';
+                } else if (speedRatio < 0.7) {
+                    level = 'moderate';
                 }
+                
+                // Get road information
+                const roadName = segment.closed ? 'Zamknięta droga' : 
+                               (segment.frc ? `Droga klasy ${segment.frc}` : 'Droga');
+                
+                trafficSegments.push({
+                    coords: segment.coords,
+                    level: level,
+                    speed: currentSpeedKmh,
+                    name: roadName,
+                    freeFlowSpeed: freeFlowSpeedKmh,
+                    confidence: Math.round(confidence * 100),
+                    speedRatio: Math.round(speedRatio * 100)
+                });
             });
         }
         
@@ -396,11 +388,10 @@ class TrafficMap {
 
     async fetchTomTomTrafficData(bounds) {
         try {
-            const center = bounds.getCenter();
-            const zoom = Math.max(10, Math.min(18, this.map.getZoom()));
+            const zoom = Math.max(10, Math.min(18, Math.round(this.map.getZoom())));
             
-            // TomTom Traffic Flow API
-            const trafficFlowUrl = `/api/tomtom-traffic?lat=${center.lat}&lng=${center.lng}&zoom=${zoom}&bbox=${bounds.getWest()},${bounds.getSouth()},${bounds.getEast()},${bounds.getNorth()}`;
+            // TomTom Traffic Flow API, sampled by the server across the whole viewport
+            const trafficFlowUrl = `/api/tomtom-traffic?zoom=${zoom}&bbox=${bounds.getWest()},${bounds.getSouth()},${bounds.getEast()},${bounds.getNorth()}`;
             
             const response = await fetch(trafficFlowUrl);
             
@@ -1,5 +1,6 @@
-
-const CACHE_NAME = 'oceny-kierowcow-v1';
+// Served at /sw.js (scope: the whole site). `python assets.py` writes a copy
+// with the precache URLs pointed at the hashed files and CACHE_NAME versioned.
+const CACHE_NAME = 'oceny-kierowcow-v2';
 const urlsToCache = [
   '/',
   '/static/css/style.css',
@@ -15,68 +16,335 @@ const urlsToCache = [
   'https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/js/bootstrap.bundle.min.js'
 ];
 
+// Runtime caches outlive app versions; entries are evicted least recently
+// used first. `revalidateAfter`: younger hits are served without a
+// background refresh. `maxAge`: older entries are only used offline.
+const RUNTIME_CACHES = {
+  api: {name: 'oceny-api-v1', maxEntries: 60, revalidateAfter: 30, maxAge: 600},
+  tiles: {name: 'oceny-tiles-v1', maxEntries: 300, revalidateAfter: 60, maxAge: 3600},
+  styles: {name: 'oceny-styles-v1', maxEntries: 10, revalidateAfter: 86400, maxAge: 30 * 86400}
+};
+
+// Public read APIs only: cached responses must not depend on who is logged in
+const ROUTES = [
+  {prefix: '/api/tomtom-traffic', cache: RUNTIME_CACHES.api},
+  {prefix: '/api/plates/autocomplete', cache: RUNTIME_CACHES.api},
+  {prefix: '/api/heatmap/', cache: RUNTIME_CACHES.tiles},
+  {prefix: '/static/', suffix: '.json', cache: RUNTIME_CACHES.styles}
+];
+
+// Writes queued while offline, replayed through /api/batch
+const QUEUED_WRITES = {'/api/rate': 'rate', '/api/add_incident': 'incident'};
+const MAX_QUEUED_WRITES = 100;
+const BATCH_SIZE = 50;
+const SYNC_TAG = 'replay-writes';
+const CACHED_AT = 'sw-cached-at';
+
+const precached = new Set(urlsToCache.map(url => new URL(url, self.location).href));
+
 // Install event
 self.addEventListener('install', event => {
-  console.log('[SW] Install');
   event.waitUntil(
     caches.open(CACHE_NAME)
-      .then(cache => {
-        console.log('[SW] Caching app shell');
-        return cache.addAll(urlsToCache);
-      })
+      .then(cache => cache.addAll(urlsToCache))
       .catch(error => {
         console.error('[SW] Failed to cache:', error);
       })
   );
 });
 
-// Fetch event
-self.addEventListener('fetch', event => {
-  event.respondWith(
-    caches.match(event.request)
-      .then(response => {
-        // Return cached version or fetch from network
-        if (response) {
-          console.log('[SW] Serving from cache:', event.request.url);
-          return response;
-        }
-        console.log('[SW] Fetching from network:', event.request.url);
-        return fetch(event.request).catch(error => {
-          console.error('[SW] Network fetch failed:', error);
-          // Return offline page or default response if needed
-        });
-      })
-  );
-});
-
-// Activate event
+// Activate event: drop app shells of older versions, keep runtime caches
 self.addEventListener('activate', event => {
-  console.log('[SW] Activate');
+  const keep = new Set([CACHE_NAME, ...Object.values(RUNTIME_CACHES).map(cache => cache.name)]);
   event.waitUntil(
-    caches.keys().then(cacheNames => {
-      return Promise.all(
-        cacheNames.map(cacheName => {
-          if (cacheName !== CACHE_NAME) {
-            console.log('[SW] Deleting old cache:', cacheName);
-            return caches.delete(cacheName);
-          }
+    caches.keys()
+      .then(cacheNames => Promise.all(
+        cacheNames.filter(cacheName => !keep.has(cacheName)).map(cacheName => {
+          console.log('[SW] Deleting old cache:', cacheName);
+          return caches.delete(cacheName);
         })
-      );
-    })
+      ))
+      .then(() => replayWrites())
+      .catch(() => {})
   );
 });
 
-// Background sync for offline functionality
+// Fetch event
+self.addEventListener('fetch', event => {
+  const request = event.request;
+  const url = new URL(request.url);
+  const sameOrigin = url.origin === self.location.origin;
+
+  if (request.method === 'POST' && sameOrigin && QUEUED_WRITES[url.pathname]) {
+    event.respondWith(networkOrQueue(request, QUEUED_WRITES[url.pathname]));
+    return;
+  }
+  if (request.method !== 'GET') {
+    return;
+  }
+  if (request.mode === 'navigate') {
+    if (sameOrigin && url.pathname === '/logout') {
+      event.waitUntil(setSessionUser(null).catch(() => {}));
+    }
+    event.respondWith(networkFirst(request));
+    return;
+  }
+  if (precached.has(url.href)) {
+    event.respondWith(caches.match(request).then(response => response || fetch(request)));
+    return;
+  }
+  if (!sameOrigin) {
+    return;
+  }
+  const route = ROUTES.find(route => url.pathname.startsWith(route.prefix) &&
+    (!route.suffix || url.pathname.endsWith(route.suffix)) &&
+    url.pathname !== '/static/manifest.json');
+  if (route) {
+    event.respondWith(staleWhileRevalidate(event, request, route.cache));
+  }
+  // Everything else (including the event stream) goes straight to the network
+});
+
+// Background sync (where supported) and the page's "online" hint
 self.addEventListener('sync', event => {
-  if (event.tag === 'background-sync') {
-    console.log('[SW] Background sync');
-    event.waitUntil(doBackgroundSync());
+  if (event.tag === SYNC_TAG) {
+    event.waitUntil(replayWrites());
+  }
+});
+
+self.addEventListener('message', event => {
+  if (event.data && event.data.type === 'replay-writes') {
+    // Pages say who is logged in (null: nobody) unless they may be stale
+    const session = event.data.userId === undefined ? Promise.resolve() : setSessionUser(event.data.userId);
+    event.waitUntil(session.then(() => replayWrites()).catch(() => {}));
   }
 });
 
-function doBackgroundSync() {
-  return new Promise((resolve) => {
-    console.log('[SW] Performing background sync');
-    resolve();
+// Pages: network first, the cached page (or the start page) when offline
+async function networkFirst(request) {
+  try {
+    return await fetch(request);
+  } catch (error) {
+    return (await caches.match(request)) || (await caches.match('/')) || Response.error();
+  }
+}
+
+function ageOf(response) {
+  const cachedAt = Number(response.headers.get(CACHED_AT));
+  return cachedAt ? (Date.now() - cachedAt) / 1000 : Infinity;
+}
+
+async function staleWhileRevalidate(event, request, config) {
+  const cache = await caches.open(config.name);
+  const cached = await cache.match(request);
+  const age = cached ? ageOf(cached) : Infinity;
+
+  if (cached && age < config.revalidateAfter) {
+    // Re-inserting moves the entry to the end of the LRU order
+    event.waitUntil(cache.put(request, cached.clone()));
+    return cached;
+  }
+
+  const refresh = fetchAndCache(cache, request, config);
+  if (cached && age < config.maxAge) {
+    event.waitUntil(refresh.catch(() => {}));
+    return cached;
+  }
+  try {
+    return await refresh;
+  } catch (error) {
+    // Offline: anything cached beats an error
+    if (cached) {
+      return cached;
+    }
+    throw error;
+  }
+}
+
+async function fetchAndCache(cache, request, config) {
+  const response = await fetch(request);
+  if (response.ok && response.type === 'basic') {
+    const headers = new Headers(response.headers);
+    headers.set(CACHED_AT, String(Date.now()));
+    const copy = new Response(await response.clone().blob(), {
+      status: response.status,
+      statusText: response.statusText,
+      headers: headers
+    });
+    await cache.put(request, copy);
+    await trimCache(cache, config.maxEntries);
+  }
+  return response;
+}
+
+async function trimCache(cache, maxEntries) {
+  // keys() is in insertion order, least recently used first
+  const keys = await cache.keys();
+  await Promise.all(keys.slice(0, Math.max(0, keys.length - maxEntries))
+    .map(key => cache.delete(key)));
+}
+
+// ---- Offline write queue ----
+
+// Every write carries the ID of the user who made it; only that user's
+// session may send it, and a change of user (or logout) drops the rest
+
+function openQueue() {
+  return new Promise((resolve, reject) => {
+    const open = indexedDB.open('oceny-offline', 2);
+    open.onupgradeneeded = () => {
+      const names = open.result.objectStoreNames;
+      if (!names.contains('writes')) {
+        open.result.createObjectStore('writes', {autoIncrement: true});
+      }
+      if (!names.contains('session')) {
+        open.result.createObjectStore('session');
+      }
+    };
+    open.onsuccess = () => resolve(open.result);
+    open.onerror = () => reject(open.error);
+  });
+}
+
+async function queueStore(mode, work, storeName = 'writes') {
+  const db = await openQueue();
+  try {
+    return await new Promise((resolve, reject) => {
+      const tx = db.transaction(storeName, mode);
+      // work() returns a request, or a function reading several of them
+      const result = work(tx.objectStore(storeName));
+      tx.oncomplete = () => resolve(typeof result === 'function' ? result() : result && result.result);
+      tx.onerror = () => reject(tx.error);
+    });
+  } finally {
+    db.close();
+  }
+}
+
+async function sessionUser() {
+  const userId = await queueStore('readonly', store => store.get('user'), 'session');
+  return userId === undefined ? null : userId;
+}
+
+async function setSessionUser(userId) {
+  if ((await sessionUser()) === userId) {
+    return;
+  }
+  await queueStore('readwrite', store => store.put(userId, 'user'), 'session');
+  await dropForeignWrites(userId);
+}
+
+function dropForeignWrites(userId) {
+  return queueStore('readwrite', store => {
+    const cursor = store.openCursor();
+    cursor.onsuccess = () => {
+      if (cursor.result) {
+        if (cursor.result.value.userId !== userId) {
+          cursor.result.delete();
+        }
+        cursor.result.continue();
+      }
+    };
+  });
+}
+
+function jsonResponse(payload, status) {
+  return new Response(JSON.stringify(payload), {
+    status: status,
+    headers: {'Content-Type': 'application/json'}
+  });
+}
+
+async function networkOrQueue(request, type) {
+  const body = await request.clone().text();
+  try {
+    return await fetch(request);
+  } catch (error) {
+    // Offline: keep the write and answer for the server
+  }
+
+  let data;
+  try {
+    data = JSON.parse(body);
+  } catch (error) {
+    return jsonResponse({error: 'Brak połączenia internetowego'}, 503);
+  }
+  const userId = await sessionUser();
+  if (userId === null) {
+    // Nobody to send it as later
+    return jsonResponse({error: 'Brak połączenia internetowego'}, 503);
+  }
+  const queued = await queueStore('readonly', store => store.count());
+  if (queued >= MAX_QUEUED_WRITES) {
+    return jsonResponse({error: 'Brak połączenia internetowego, spróbuj później'}, 503);
+  }
+  await queueStore('readwrite', store => store.add({type: type, data: data, userId: userId, queuedAt: Date.now()}));
+  if (self.registration.sync) {
+    await self.registration.sync.register(SYNC_TAG).catch(() => {});
+  }
+  return jsonResponse({
+    success: true,
+    queued: true,
+    message: 'Brak połączenia. Zapisano i wyślemy automatycznie po przywróceniu sieci.'
+  }, 202);
+}
+
+let replaying = null;
+
+function replayWrites() {
+  // One replay at a time, so no write is sent twice
+  if (!replaying) {
+    replaying = sendQueuedWrites().finally(() => {
+      replaying = null;
+    });
+  }
+  return replaying;
+}
+
+async function sendQueuedWrites() {
+  const userId = await sessionUser();
+  await dropForeignWrites(userId);
+  const writes = await queueStore('readonly', store => {
+    const keys = store.getAllKeys();
+    const values = store.getAll();
+    return () => keys.result.map((key, i) => ({id: key, type: values.result[i].type, data: values.result[i].data}));
   });
+  let applied = 0;
+  let rejected = 0;
+
+  for (let start = 0; start < writes.length; start += BATCH_SIZE) {
+    const operations = writes.slice(start, start + BATCH_SIZE);
+    // Throws when still offline; background sync then retries later
+    const response = await fetch('/api/batch', {
+      method: 'POST',
+      headers: {'Content-Type': 'application/json'},
+      credentials: 'same-origin',
+      body: JSON.stringify({user_id: userId, operations: operations})
+    });
+    if (response.status === 409) {
+      // The server session belongs to another account: none of these
+      // writes may be sent as that user
+      await queueStore('readwrite', store => store.clear());
+      break;
+    }
+    if (!response.ok || response.redirected) {
+      // Server trouble or logged out (redirected to the login page): keep
+      // everything for the next attempt
+      break;
+    }
+    const results = (await response.json()).results || [];
+    const done = results.filter(result => result.status < 500);
+    applied += done.filter(result => result.status < 300).length;
+    rejected += done.filter(result => result.status >= 300).length;
+    await queueStore('readwrite', store => {
+      done.forEach(result => store.delete(result.id));
+    });
+  }
+
+  if (applied || rejected) {
+    const clients = await self.clients.matchAll({type: 'window'});
+    clients.forEach(client => client.postMessage({
+      type: 'writes-replayed', applied: applied, rejected: rejected
+    }));
+  }
 }
@@ -0,0 +1,109 @@
+"""
+Shared fixtures for the test suite
+Tests build small Flask apps around the shared ``db`` extension instead of
+importing app.py, so they never touch the configured database. SQLite runs
+always; the PostgreSQL variants run when TEST_DATABASE_URL points at a
+database the tests may drop tables in.
+"""
+
+import os
+import sys
+import threading
+
+import pytest
+from flask import Flask
+from sqlalchemy import event
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from models import db  # noqa: E402
+from migrations import migrate  # noqa: E402
+from database import configure_strict_loading  # noqa: E402
+
+POSTGRES_URL = os.environ.get('TEST_DATABASE_URL')
+
+
+def serialize_sqlite_writers(engine):
+    """
+    Start SQLite transactions with BEGIN IMMEDIATE. SQLite has one writer;
+    a deferred transaction that read first cannot wait for the write lock
+    and fails with "database is locked", an immediate one waits its turn
+    """
+    @event.listens_for(engine, 'connect')
+    def disable_pysqlite_begin(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def begin_immediate(connection):
+        connection.exec_driver_sql('BEGIN IMMEDIATE')
+
+
+def make_app(url, **config):
+    """
+    Flask app bound to ``url`` with fresh tables
+    Args:
+        url: Database URL
+        **config: Extra configuration
+    Returns:
+        Flask application
+    """
+    app = Flask('tests')
+    # Templates rendered in tests must not lazy load
+    app.config.update(SQLALCHEMY_DATABASE_URI=url, DB_STRICT_LOADING=True, **config)
+    db.init_app(app)
+    configure_strict_loading(app, db)
+    with app.app_context():
+        if db.engine.dialect.name == 'sqlite':
+            serialize_sqlite_writers(db.engine)
+        db.drop_all()
+        db.create_all()
+        migrate()
+    return app
+
+
+@pytest.fixture(params=['sqlite', 'postgresql'])
+def app(request, tmp_path):
+    """App on each supported database (PostgreSQL only with TEST_DATABASE_URL)"""
+    if request.param == 'postgresql':
+        if not POSTGRES_URL:
+            pytest.skip('TEST_DATABASE_URL is not set')
+        url = POSTGRES_URL
+    else:
+        url = f"sqlite:///{tmp_path / 'test.db'}"
+    # Enough connections for every thread of the concurrency tests
+    app = make_app(url, SQLALCHEMY_ENGINE_OPTIONS={
+        'pool_size': 20, 'max_overflow': 40, 'pool_timeout': 60})
+    yield app
+    with app.app_context():
+        db.session.remove()
+        db.drop_all()
+        db.engine.dispose()
+
+
+def run_concurrently(app, target, count):
+    """
+    Run ``target(i)`` for i in range(count), each in its own thread and app
+    context, all released at the same moment
+    Returns:
+        list: Exceptions raised by the threads
+    """
+    barrier = threading.Barrier(count)
+    errors = []
+
+    def worker(i):
+        with app.app_context():
+            barrier.wait()
+            try:
+                target(i)
+            except Exception as e:
+                db.session.rollback()
+                errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
@@ -0,0 +1,105 @@
+"""
+Activity timeline: one newest-first list across ratings, comments, incidents
+and favorites, paged by a (created_at, kind, id) cursor that neither skips
+nor repeats items sharing a timestamp
+"""
+
+from datetime import datetime, timedelta
+
+import pytest
+
+from activity import activity_timeline, decode_cursor, encode_cursor, statistics_snapshot
+from models import db, Comment, Favorite, Incident, Rating, User, Vehicle
+
+NOON = datetime(2025, 6, 1, 12)
+
+
+@pytest.fixture
+def active_user(app):
+    """A user with three items of each kind, many of them at the same moment"""
+    with app.app_context():
+        user = User(username='driver', email='driver@example.com', password_hash='x')
+        other = User(username='other', email='other@example.com', password_hash='x')
+        vehicles = [Vehicle(license_plate=f'WA1000{i}') for i in range(3)]
+        db.session.add_all([user, other] + vehicles)
+        db.session.flush()
+        # Minutes after noon per item: ties within and across kinds
+        times = [0, 0, 1]
+        for vehicle, minutes in zip(vehicles, times):
+            at = NOON + timedelta(minutes=minutes)
+            db.session.add_all([
+                Rating(user_id=user.id, vehicle_id=vehicle.id, rating=4, created_at=at),
+                Comment(user_id=user.id, vehicle_id=vehicle.id, content='Zajechał drogę',
+                        created_at=at),
+                Incident(user_id=user.id, license_plate=vehicle.license_plate, latitude=52.23,
+                         longitude=21.01, incident_type='other', description='x', created_at=at),
+                Favorite(user_id=user.id, vehicle_id=vehicle.id, created_at=at),
+                # Someone else's activity never shows up
+                Rating(user_id=other.id, vehicle_id=vehicle.id, rating=1, created_at=at),
+            ])
+        user_id = user.id
+        db.session.commit()
+    return user_id
+
+
+def keys(items):
+    return [(item['created_at'], item['kind'], item['id']) for item in items]
+
+
+def test_first_page_is_newest_first(app, active_user):
+    with app.app_context():
+        items, cursor = activity_timeline(active_user, limit=100)
+        assert cursor is None
+        assert len(items) == 12
+        assert keys(items) == sorted(keys(items), reverse=True)
+        assert {item['kind'] for item in items[:4]} == {'rating', 'comment', 'incident', 'favorite'}
+        assert {item['license_plate'] for item in items} == {'WA10000', 'WA10001', 'WA10002'}
+
+
+@pytest.mark.parametrize('limit', [1, 2, 3, 5, 11, 12])
+def test_paging_neither_skips_nor_repeats(app, active_user, limit):
+    with app.app_context():
+        everything, _ = activity_timeline(active_user, limit=100)
+        pages, cursor = [], None
+        while True:
+            items, cursor = activity_timeline(
+                active_user, before=cursor and decode_cursor(cursor), limit=limit)
+            assert 0 < len(items) <= limit
+            pages.append(items)
+            if cursor is None:
+                break
+        assert keys(item for page in pages for item in page) == keys(everything)
+        assert len(pages) == -(-12 // limit)
+
+
+def test_cursor_inside_a_group_of_equal_timestamps(app, active_user):
+    with app.app_context():
+        everything, _ = activity_timeline(active_user, limit=100)
+        # Items 4..11 all share NOON; resume after each of them in turn
+        for position in range(4, 11):
+            cursor = decode_cursor(encode_cursor(everything[position]))
+            assert cursor[0] == NOON
+            items, _ = activity_timeline(active_user, before=cursor, limit=100)
+            assert keys(items) == keys(everything[position + 1:])
+
+
+def test_cursor_round_trip():
+    item = {'created_at': NOON, 'kind': 'comment', 'id': 7}
+    assert decode_cursor(encode_cursor(item)) == (NOON, 'comment', 7)
+    for cursor in ('', 'x', '2025-06-01T12:00:00,comment', 'yesterday,comment,1',
+                   '2025-06-01T12:00:00,comment,x'):
+        with pytest.raises(ValueError):
+            decode_cursor(cursor)
+
+
+def test_limit_is_clamped(app, active_user):
+    with app.app_context():
+        items, cursor = activity_timeline(active_user, limit=0)
+        assert len(items) == 1 and cursor is not None
+
+
+def test_statistics_without_a_stored_row(app, active_user):
+    with app.app_context():
+        stats = statistics_snapshot(active_user)
+        assert (stats.total_ratings, stats.total_comments, stats.total_incidents) == (3, 3, 3)
+        assert stats not in db.session
@@ -0,0 +1,47 @@
+"""
+Login lookup: users sign in with their username or their email, and a
+username wins over another user's identical email
+"""
+
+import pytest
+from werkzeug.security import generate_password_hash
+
+from auth import authenticate_user
+from models import db, User
+
+FAST_METHOD = 'pbkdf2:sha256:1000'
+
+
+@pytest.fixture
+def users(app):
+    with app.app_context():
+        db.session.add_all([
+            User(username='driver', email='driver@example.com',
+                 password_hash=generate_password_hash('driver-secret', method=FAST_METHOD)),
+            # Someone whose username is the first user's email
+            User(username='driver@example.com', email='other@example.com',
+                 password_hash=generate_password_hash('other-secret', method=FAST_METHOD)),
+        ])
+        db.session.commit()
+    return app
+
+
+@pytest.mark.parametrize('login, password, username', [
+    ('driver', 'driver-secret', 'driver'),
+    ('other@example.com', 'other-secret', 'driver@example.com'),
+    ('driver@example.com', 'other-secret', 'driver@example.com'),
+])
+def test_username_or_email(users, login, password, username):
+    with users.app_context():
+        assert authenticate_user(login, password).username == username
+
+
+@pytest.mark.parametrize('login, password', [
+    ('driver', 'other-secret'),
+    # The username match is checked, not the email match behind it
+    ('driver@example.com', 'driver-secret'),
+    ('nobody', 'driver-secret'),
+])
+def test_refused(users, login, password):
+    with users.app_context():
+        assert authenticate_user(login, password) is None
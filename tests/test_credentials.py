@@ -0,0 +1,46 @@
+"""
+Credential service: timeouts surface as CredentialServiceBusy and a
+timed-out hash keeps its slot until it really finishes
+"""
+
+import time
+
+import pytest
+from flask import Flask
+
+from credentials import CredentialService, CredentialServiceBusy
+
+FAST_METHOD = 'pbkdf2:sha256:1000'
+
+
+@pytest.fixture
+def service():
+    app = Flask('tests')
+    app.config.update(PASSWORD_HASH_METHOD=FAST_METHOD, CREDENTIAL_WORKERS=1,
+                      CREDENTIAL_MAX_PENDING=1, CREDENTIAL_TIMEOUT=0.2)
+    service = CredentialService(app)
+    yield service
+    service.shutdown()
+
+
+def test_timeout_is_busy_and_keeps_the_slot(service):
+    # A warm pool, so the timings below are about the work itself
+    assert service.verify_password(service.hash_password('secret'), 'secret')
+
+    with pytest.raises(CredentialServiceBusy):
+        service._run(time.sleep, 1)
+    # Still hashing: the only slot is taken
+    with pytest.raises(CredentialServiceBusy):
+        service.hash_password('secret')
+
+    time.sleep(1.5)
+    assert service.hash_password('secret').startswith(FAST_METHOD)
+
+
+def test_inline_without_workers():
+    app = Flask('tests')
+    app.config.update(PASSWORD_HASH_METHOD=FAST_METHOD, CREDENTIAL_WORKERS=0)
+    service = CredentialService(app)
+    password_hash = service.hash_password('secret')
+    assert service.verify_password(password_hash, 'secret')
+    assert not service.verify_password(password_hash, 'other')
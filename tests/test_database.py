@@ -0,0 +1,177 @@
+"""
+Replica routing: views marked ``db_route(replica=True)`` read from the
+replica until they write, writes and everything after them go to the
+primary, and the routing flags do not outlive the request
+"""
+
+import pytest
+from flask import Flask
+from sqlalchemy import event, select
+from sqlalchemy.exc import IntegrityError
+
+from database import REPLICA_BIND, configure_database, db_route
+from models import db, Vehicle
+
+ROUTING_FLAGS = ('use_replica', 'wrote_primary', 'statement_timeout_ms')
+
+
+@pytest.fixture(scope='module')
+def app(tmp_path_factory):
+    """App on two SQLite files, each seeded with a vehicle naming its database"""
+    path = tmp_path_factory.mktemp('routing')
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setenv('DATABASE_URL', f"sqlite:///{path / 'primary.db'}")
+        mp.setenv('DATABASE_REPLICA_URL', f"sqlite:///{path / 'replica.db'}")
+        app = Flask('tests')
+        configure_database(app, db)
+    db.init_app(app)
+
+    with app.app_context():
+        for bind, plate in ((None, 'PRIMARY'), (REPLICA_BIND, 'REPLICA')):
+            engine = db.engines[bind]
+            db.metadata.create_all(engine, tables=[Vehicle.__table__])
+            with engine.begin() as connection:
+                connection.execute(Vehicle.__table__.insert(), {'license_plate': plate})
+    app.statements = {None: [], REPLICA_BIND: []}
+    with app.app_context():
+        for bind, statements in app.statements.items():
+            event.listen(db.engines[bind], 'before_cursor_execute',
+                         lambda conn, cursor, statement, *args, statements=statements:
+                         statements.append(statement.split()[0].upper()))
+    yield app
+    with app.app_context():
+        db.session.remove()
+        for engine in db.engines.values():
+            engine.dispose()
+    # init_app registered the bind's metadata on the shared extension; other
+    # tests' apps have no replica for create_all/drop_all to use
+    db.metadatas.pop(REPLICA_BIND, None)
+
+
+@pytest.fixture
+def statements(app):
+    """First keyword of each statement, per engine, issued during the test"""
+    for recorded in app.statements.values():
+        recorded.clear()
+    yield app.statements
+    with app.app_context():
+        # Keep the primary as seeded for the next test
+        db.session.execute(Vehicle.__table__.delete().where(
+            Vehicle.license_plate.notin_(['PRIMARY'])))
+        db.session.commit()
+
+
+def plates():
+    return sorted(db.session.scalars(select(Vehicle.license_plate)))
+
+
+def test_reads_go_to_the_replica(app, statements):
+    @db_route(db, replica=True)
+    def view():
+        return plates()
+
+    with app.test_request_context():
+        assert view() == ['REPLICA']
+        assert statements[None] == []
+
+
+def test_primary_without_replica_flag(app, statements):
+    @db_route(db)
+    def view():
+        return plates()
+
+    with app.test_request_context():
+        assert view() == ['PRIMARY']
+        assert statements[REPLICA_BIND] == []
+
+
+def test_flush_and_everything_after_it_go_to_the_primary(app, statements):
+    @db_route(db, replica=True)
+    def view():
+        before = plates()
+        db.session.add(Vehicle(license_plate='NEW1'))
+        db.session.flush()
+        # Read your own write: the replica has not seen it
+        after_flush = plates()
+        db.session.commit()
+        return before, after_flush, plates()
+
+    with app.test_request_context():
+        assert view() == (['REPLICA'], ['NEW1', 'PRIMARY'], ['NEW1', 'PRIMARY'])
+    assert 'INSERT' in statements[None]
+    assert 'INSERT' not in statements[REPLICA_BIND]
+    with app.app_context():
+        assert db.session.execute(select(Vehicle.license_plate).where(
+            Vehicle.license_plate == 'NEW1'), bind_arguments={
+                'bind': db.engines[REPLICA_BIND]}).all() == []
+
+
+def test_dml_statements_go_to_the_primary(app, statements):
+    @db_route(db, replica=True)
+    def view():
+        db.session.execute(Vehicle.__table__.update().where(
+            Vehicle.license_plate == 'PRIMARY').values(is_blocked=True))
+        return db.session.scalar(select(Vehicle.is_blocked).where(
+            Vehicle.license_plate == 'PRIMARY'))
+
+    with app.test_request_context():
+        assert view() is True
+        db.session.rollback()
+    assert statements[None][-2:] == ['UPDATE', 'SELECT']
+    assert statements[REPLICA_BIND] == []
+
+
+@pytest.mark.parametrize('fail', [False, True])
+def test_flags_are_cleared_after_the_request(app, statements, fail):
+    @db_route(db, replica=True, statement_timeout_ms=1000)
+    def view():
+        db.session.add(Vehicle(license_plate='NEW2'))
+        db.session.flush()
+        assert all(db.session.info.get(flag) for flag in ROUTING_FLAGS)
+        if fail:
+            raise RuntimeError('view failed')
+
+    with app.test_request_context():
+        if fail:
+            with pytest.raises(RuntimeError):
+                view()
+        else:
+            view()
+        assert not any(flag in db.session.info for flag in ROUTING_FLAGS)
+        db.session.rollback()
+        # The next view in this session reads the primary again
+        assert plates() == ['PRIMARY']
+
+
+def test_pending_work_follows_savepoints(app):
+    from sqlalchemy.orm import Session
+
+    from database import pending_until_commit
+
+    with app.app_context():
+        session = Session(db.engine)
+    pending_until_commit(session, 'pending')
+
+    def add(value):
+        session.info.setdefault('pending', []).append(value)
+
+    add('outer')
+    with session.begin_nested():
+        add('kept')
+    savepoint = session.begin_nested()
+    add('dropped')
+    with session.begin_nested():
+        add('dropped too')
+    savepoint.rollback()
+    assert session.info['pending'] == ['outer', 'kept']
+
+    # A failed flush rolls back its savepoint only
+    with pytest.raises(IntegrityError):
+        with session.begin_nested():
+            add('duplicate')
+            session.add(Vehicle(license_plate='PRIMARY'))
+            session.flush()
+    assert session.info['pending'] == ['outer', 'kept']
+    session.rollback()
+    assert 'pending' not in session.info
+    session.close()
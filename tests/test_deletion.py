@@ -0,0 +1,29 @@
+"""
+Account deletion keeps the counters of other users' rows in step
+"""
+
+from models import db, Incident, IncidentCorroboration, User
+from deletion import delete_user
+from incidents import VERIFY_CORROBORATIONS, ingest_incident
+
+
+def test_deleting_a_corroborator_releases_the_corroboration(app):
+    with app.app_context():
+        users = [User(username=f'user{i}', email=f'user{i}@example.com', password_hash='x')
+                 for i in range(VERIFY_CORROBORATIONS)]
+        db.session.add_all(users)
+        db.session.flush()
+        for user in users:
+            incident, *_ = ingest_incident(user.id, 'WA12345', 52.23, 21.01,
+                                          'aggressive_driving', 'Zajechał drogę')
+        db.session.commit()
+        incident_id, corroborator_id = incident.id, users[-1].id
+        assert (incident.corroborations, incident.is_verified) == (VERIFY_CORROBORATIONS, True)
+
+        counts = delete_user(corroborator_id, chunk_size=1)
+        assert counts['incident_corroboration'] == 1
+        db.session.expire_all()
+        incident = db.session.get(Incident, incident_id)
+        assert (incident.corroborations, incident.is_verified) == (VERIFY_CORROBORATIONS - 1, False)
+        assert db.session.query(IncidentCorroboration).filter_by(
+            user_id=corroborator_id).count() == 0
@@ -0,0 +1,128 @@
+"""
+Heatmap tiles: incidents are binned onto the pixel they project to, weighted
+by severity and blurred across tile edges; cached tiles are dropped when an
+incident lands on them
+"""
+
+import os
+import struct
+import zlib
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from heatmap import MARGIN, TILE_SIZE, HeatmapTiles, project, render_tile, tile_bounds  # noqa: E402
+from models import db, Incident, User  # noqa: E402
+
+WARSAW = (52.2297, 21.0122)
+ZOOM = 14
+
+
+def alpha(png):
+    """Alpha channel of a PNG written by heatmap._png"""
+    assert png.startswith(b'\x89PNG\r\n\x1a\n')
+    width, height = struct.unpack('>II', png[16:24])
+    idat_length = struct.unpack('>I', png[33:37])[0]
+    assert png[37:41] == b'IDAT'
+    raw = np.frombuffer(zlib.decompress(png[41:41 + idat_length]), dtype=np.uint8)
+    return raw.reshape(height, width * 4 + 1)[:, 1:].reshape(height, width, 4)[..., 3]
+
+
+def pixel(latitude, longitude, z=ZOOM):
+    """(tile x, tile y, column, row) of a point"""
+    px, py = project(np.array([latitude]), np.array([longitude]), z)
+    px, py = float(px[0]), float(py[0])
+    return int(px // TILE_SIZE), int(py // TILE_SIZE), int(px % TILE_SIZE), int(py % TILE_SIZE)
+
+
+def render(x, y, points, z=ZOOM):
+    latitudes, longitudes, weights = (np.array(column, dtype=np.float64)
+                                      for column in zip(*points)) if points else (np.empty(0),) * 3
+    return alpha(render_tile(z, x, y, latitudes, longitudes, weights))
+
+
+def test_projection():
+    px, py = project(np.array([0.0, 85.06]), np.array([0.0, -180.0]), 0)
+    assert px.tolist() == pytest.approx([TILE_SIZE / 2, 0])
+    assert py.tolist() == pytest.approx([TILE_SIZE / 2, 0], abs=1e-6)
+
+    x, y, _, _ = pixel(*WARSAW)
+    min_lng, min_lat, max_lng, max_lat = tile_bounds(ZOOM, x, y)
+    assert min_lat < WARSAW[0] < max_lat and min_lng < WARSAW[1] < max_lng
+
+
+def test_incident_is_binned_on_its_pixel():
+    x, y, col, row = pixel(*WARSAW)
+    heat = render(x, y, [(*WARSAW, 1)])
+    assert heat.shape == (TILE_SIZE, TILE_SIZE)
+    # Peak on the incident's own pixel (the alpha ramp may tie its neighbours)
+    assert heat[row, col] == heat.max() > 0
+    # Blurred into a blob a few sigma wide, not beyond
+    assert heat[row, max(col - MARGIN - 1, 0)] <= heat[row, col]
+    assert render(x + 2, y, [(*WARSAW, 1)]).max() == 0
+
+
+def test_empty_tile_is_transparent():
+    assert render(0, 0, []).max() == 0
+
+
+def test_severity_weights_the_density():
+    x, y, col, row = pixel(*WARSAW)
+    light = render(x, y, [(*WARSAW, 1)])[row, col]
+    heavy = render(x, y, [(*WARSAW, 5)])[row, col]
+    stacked = render(x, y, [(*WARSAW, 1)] * 5)[row, col]
+    assert light < heavy == stacked
+
+
+def test_blob_continues_into_the_neighbouring_tile():
+    x, y, _, row = pixel(*WARSAW)
+    # A point two pixels left of the tile's right edge
+    world = TILE_SIZE * 2 ** ZOOM
+    longitude = ((x + 1) * TILE_SIZE - 2) / world * 360 - 180
+    latitude = WARSAW[0]
+    here = render(x, y, [(latitude, longitude, 1)])
+    there = render(x + 1, y, [(latitude, longitude, 1)])
+    assert here[row, -1] > 0 and there[row, 0] > 0
+    assert abs(int(here[row, -1]) - int(there[row, 0])) <= 1
+
+
+@pytest.fixture
+def tiles(app, tmp_path):
+    app.config.update(HEATMAP_CACHE_DIR=str(tmp_path / 'tiles'), HEATMAP_MIN_ZOOM=12,
+                      HEATMAP_MAX_ZOOM=ZOOM)
+    return HeatmapTiles(app)
+
+
+def test_tiles_are_cached_and_invalidated(app, tiles):
+    x, y, col, row = pixel(*WARSAW)
+    with app.app_context():
+        path = tiles.get_tile(ZOOM, x, y)
+        with open(path, 'rb') as f:
+            assert alpha(f.read()).max() == 0
+
+        user = User(username='driver', email='driver@example.com', password_hash='x')
+        db.session.add(user)
+        db.session.flush()
+        db.session.add(Incident(user_id=user.id, license_plate='WA12345', latitude=WARSAW[0],
+                                longitude=WARSAW[1], incident_type='other', description='x',
+                                severity=3))
+        db.session.commit()
+        # Still the cached empty tile until the incident invalidates it
+        assert tiles.get_tile(ZOOM, x, y) == path
+        with open(path, 'rb') as f:
+            assert alpha(f.read()).max() == 0
+
+        touched = set(tiles.tiles_touching(*WARSAW))
+        assert (ZOOM, x, y) in touched
+        assert {z for z, _, _ in touched} == {12, 13, 14}
+        tiles.invalidate_point(*WARSAW)
+        assert not os.path.exists(path)
+        with open(tiles.get_tile(ZOOM, x, y), 'rb') as f:
+            assert alpha(f.read())[row, col] > 0
+
+
+def test_valid_tile(tiles):
+    assert tiles.valid_tile(ZOOM, 0, 2 ** ZOOM - 1)
+    assert not tiles.valid_tile(ZOOM, 2 ** ZOOM, 0)
+    assert not tiles.valid_tile(11, 0, 0)
@@ -0,0 +1,29 @@
+"""
+Incident ingestion: repeated reports of one event become corroborations,
+counted once per reporter
+"""
+
+from models import db, User
+from incidents import ingest_incident
+
+
+def test_only_new_reporters_corroborate(app):
+    with app.app_context():
+        author, other = (User(username=name, email=f'{name}@example.com', password_hash='x')
+                         for name in ('author', 'other'))
+        db.session.add_all([author, other])
+        db.session.flush()
+
+        def report(user):
+            return ingest_incident(user.id, 'WA12345', 52.23, 21.01,
+                                   'aggressive_driving', 'Zajechał drogę')
+
+        incident, created, corroborated = report(author)
+        assert (created, corroborated) == (True, False)
+        # The author again, then another user twice
+        assert report(author)[1:] == (False, False)
+        assert report(other)[1:] == (False, True)
+        assert report(other)[1:] == (False, False)
+        db.session.commit()
+        db.session.refresh(incident)
+        assert incident.corroborations == 2
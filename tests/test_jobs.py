@@ -0,0 +1,58 @@
+"""
+Job queue: transient jobs run on the worker threads without an outbox row
+"""
+
+import threading
+
+import pytest
+from sqlalchemy import event, func, select
+
+from jobs import JobQueue
+from models import db, OutboxJob
+
+
+@pytest.fixture
+def jobs(app):
+    app.config.update(JOB_WORKERS=1, JOB_QUEUE_SIZE=1)
+    jobs = JobQueue(app)
+    yield jobs
+    jobs.shutdown()
+    event.remove(db.session, 'after_commit', jobs._after_commit)
+
+
+def test_transient_job_runs_on_a_worker(app, jobs):
+    started, release = threading.Event(), threading.Event()
+    ran = []
+
+    @jobs.handler('record')
+    def record(value):
+        started.set()
+        release.wait(5)
+        ran.append((value, threading.current_thread().name))
+
+    with app.app_context():
+        assert jobs.enqueue_transient('record', value=1)
+        assert started.wait(5)
+        # The worker holds the first job, the second fills the queue
+        assert jobs.enqueue_transient('record', value=2)
+        assert not jobs.enqueue_transient('record', value=3)
+        release.set()
+        assert jobs.shutdown()
+        assert ran == [(1, 'job-worker-0'), (2, 'job-worker-0')]
+        assert db.session.scalar(select(func.count()).select_from(OutboxJob)) == 0
+        with pytest.raises(ValueError):
+            jobs.enqueue_transient('unknown')
+
+
+def test_released_savepoint_does_not_dispatch(app, jobs):
+    ran = []
+    jobs.handlers['record'] = lambda value: ran.append(value)
+    app.config['JOB_EAGER'] = True
+
+    with app.app_context():
+        with db.session.begin_nested():
+            jobs.enqueue('record', value=1)
+        # Not committed yet, so nothing may run
+        assert ran == [] and db.session.info['pending_jobs']
+        db.session.commit()
+        assert ran == [1]
@@ -0,0 +1,204 @@
+"""
+Migrations bring a database created by the first release up to the models:
+foreign keys gain ON DELETE CASCADE where the database supports it (deletes
+remove dependent rows by hand where it does not), new columns are added and
+filled in for existing rows, and missing indexes are created
+"""
+
+import sqlalchemy as sa
+import pytest
+from datetime import datetime
+
+from conftest import POSTGRES_URL, make_app
+from models import db, Comment, CommentVote, Incident, Report, User, Vehicle
+from migrations import CASCADE_FOREIGN_KEYS, MIGRATIONS, is_applied, migrate
+from deletion import delete_dependents, delete_user
+from incidents import grid_cell
+from moderation import priority_increment
+
+# Schema of the first release: no indexes, no ON DELETE on foreign keys
+BASELINE = sa.MetaData()
+sa.Table('user', BASELINE,
+         sa.Column('id', sa.Integer, primary_key=True),
+         sa.Column('username', sa.String(64), unique=True, nullable=False),
+         sa.Column('email', sa.String(120), unique=True, nullable=False),
+         sa.Column('password_hash', sa.String(256), nullable=False),
+         sa.Column('is_admin', sa.Boolean),
+         sa.Column('created_at', sa.DateTime))
+sa.Table('vehicle', BASELINE,
+         sa.Column('id', sa.Integer, primary_key=True),
+         sa.Column('license_plate', sa.String(20), unique=True, nullable=False),
+         sa.Column('is_blocked', sa.Boolean),
+         sa.Column('created_at', sa.DateTime))
+sa.Table('rating', BASELINE,
+         sa.Column('id', sa.Integer, primary_key=True),
+         sa.Column('vehicle_id', sa.Integer, sa.ForeignKey('vehicle.id'), nullable=False),
+         sa.Column('user_id', sa.Integer, sa.ForeignKey('user.id'), nullable=False),
+         sa.Column('rating', sa.Integer, nullable=False),
+         sa.Column('created_at', sa.DateTime),
+         sa.UniqueConstraint('vehicle_id', 'user_id', name='unique_user_vehicle_rating'))
+sa.Table('comment', BASELINE,
+         sa.Column('id', sa.Integer, primary_key=True),
+         sa.Column('vehicle_id', sa.Integer, sa.ForeignKey('vehicle.id'), nullable=False),
+         sa.Column('user_id', sa.Integer, sa.ForeignKey('user.id'), nullable=False),
+         sa.Column('content', sa.Text, nullable=False),
+         sa.Column('reports', sa.Integer),
+         sa.Column('helpful_votes', sa.Integer),
+         sa.Column('unhelpful_votes', sa.Integer),
+         sa.Column('created_at', sa.DateTime))
+sa.Table('report', BASELINE,
+         sa.Column('id', sa.Integer, primary_key=True),
+         sa.Column('comment_id', sa.Integer, sa.ForeignKey('comment.id'), nullable=False),
+         sa.Column('user_id', sa.Integer, sa.ForeignKey('user.id'), nullable=False),
+         sa.Column('created_at', sa.DateTime),
+         sa.UniqueConstraint('comment_id', 'user_id', name='unique_user_comment_report'))
+sa.Table('incident', BASELINE,
+         sa.Column('id', sa.Integer, primary_key=True),
+         sa.Column('user_id', sa.Integer, sa.ForeignKey('user.id'), nullable=False),
+         sa.Column('license_plate', sa.String(20), nullable=False),
+         sa.Column('latitude', sa.Float, nullable=False),
+         sa.Column('longitude', sa.Float, nullable=False),
+         sa.Column('incident_type', sa.String(50), nullable=False),
+         sa.Column('description', sa.Text, nullable=False),
+         sa.Column('severity', sa.Integer),
+         sa.Column('is_verified', sa.Boolean),
+         sa.Column('created_at', sa.DateTime))
+sa.Table('user_statistics', BASELINE,
+         sa.Column('id', sa.Integer, primary_key=True),
+         sa.Column('user_id', sa.Integer, sa.ForeignKey('user.id'), unique=True, nullable=False),
+         sa.Column('total_ratings', sa.Integer),
+         sa.Column('total_comments', sa.Integer),
+         sa.Column('total_reports', sa.Integer),
+         sa.Column('total_incidents', sa.Integer),
+         sa.Column('helpful_votes', sa.Integer),
+         sa.Column('reputation_score', sa.Integer),
+         sa.Column('last_updated', sa.DateTime))
+sa.Table('comment_vote', BASELINE,
+         sa.Column('id', sa.Integer, primary_key=True),
+         sa.Column('comment_id', sa.Integer, sa.ForeignKey('comment.id'), nullable=False),
+         sa.Column('user_id', sa.Integer, sa.ForeignKey('user.id'), nullable=False),
+         sa.Column('vote_type', sa.String(10), nullable=False),
+         sa.Column('created_at', sa.DateTime),
+         sa.UniqueConstraint('comment_id', 'user_id', name='unique_user_comment_vote'))
+sa.Table('favorite', BASELINE,
+         sa.Column('id', sa.Integer, primary_key=True),
+         sa.Column('user_id', sa.Integer, sa.ForeignKey('user.id'), nullable=False),
+         sa.Column('vehicle_id', sa.Integer, sa.ForeignKey('vehicle.id'), nullable=False),
+         sa.Column('created_at', sa.DateTime),
+         sa.Column('notes', sa.Text),
+         sa.UniqueConstraint('user_id', 'vehicle_id', name='unique_user_vehicle_favorite'))
+
+CREATED = datetime(2025, 3, 1, 12, 0)
+
+
+@pytest.fixture(params=['sqlite', 'postgresql'])
+def legacy_app(request, tmp_path):
+    """App on a first-release database holding one user with a commented, voted, reported vehicle"""
+    if request.param == 'postgresql':
+        if not POSTGRES_URL:
+            pytest.skip('TEST_DATABASE_URL is not set')
+        url = POSTGRES_URL
+    else:
+        url = f"sqlite:///{tmp_path / 'legacy.db'}"
+    app = make_app(url)
+    with app.app_context():
+        db.drop_all()
+        BASELINE.create_all(db.engine)
+        tables = BASELINE.tables
+        with db.engine.begin() as connection:
+            connection.execute(tables['user'].insert(), [
+                {'id': i, 'username': f'user{i}', 'email': f'user{i}@example.com',
+                 'password_hash': 'x', 'is_admin': False, 'created_at': CREATED}
+                for i in (1, 2)])
+            connection.execute(tables['vehicle'].insert(), {
+                'id': 1, 'license_plate': 'WA12345', 'is_blocked': False, 'created_at': CREATED})
+            connection.execute(tables['comment'].insert(), {
+                'id': 1, 'vehicle_id': 1, 'user_id': 1, 'content': 'Zajechał drogę',
+                'reports': 1, 'helpful_votes': 1, 'unhelpful_votes': 0, 'created_at': CREATED})
+            connection.execute(tables['comment_vote'].insert(), {
+                'comment_id': 1, 'user_id': 2, 'vote_type': 'helpful', 'created_at': CREATED})
+            connection.execute(tables['report'].insert(), {
+                'comment_id': 1, 'user_id': 2, 'created_at': CREATED})
+            connection.execute(tables['incident'].insert(), {
+                'id': 1, 'user_id': 1, 'license_plate': 'WA12345', 'latitude': 52.23,
+                'longitude': 21.01, 'incident_type': 'aggressive_driving',
+                'description': 'Zajechał drogę', 'severity': 2, 'is_verified': False,
+                'created_at': CREATED})
+    yield app
+    with app.app_context():
+        db.session.remove()
+        db.drop_all()
+        db.engine.dispose()
+
+
+def foreign_key_actions(table):
+    return {tuple(fk['constrained_columns']): fk['options'].get('ondelete')
+            for fk in sa.inspect(db.session.connection()).get_foreign_keys(table)}
+
+
+def test_foreign_keys_cascade_after_migration(legacy_app):
+    with legacy_app.app_context():
+        db.create_all()
+        applied = migrate()
+        if db.engine.dialect.name == 'sqlite':
+            # Left as they are, deletes cascade by hand
+            assert CASCADE_FOREIGN_KEYS not in applied
+            assert not is_applied(CASCADE_FOREIGN_KEYS)
+        else:
+            assert applied == [name for name, _ in MIGRATIONS]
+            assert is_applied(CASCADE_FOREIGN_KEYS)
+            assert foreign_key_actions('report') == {
+                ('comment_id',): 'CASCADE', ('user_id',): 'CASCADE'}
+            assert foreign_key_actions('favorite') == {
+                ('user_id',): 'CASCADE', ('vehicle_id',): 'CASCADE'}
+        # Nothing left to do on the next start
+        assert migrate() == []
+
+
+def test_deleting_a_comment_removes_its_votes_and_reports(legacy_app):
+    with legacy_app.app_context():
+        db.create_all()
+        migrate()
+        delete_dependents(Comment.__table__, Comment.id == 1)
+        db.session.execute(sa.delete(Comment).where(Comment.id == 1))
+        db.session.commit()
+        for model in (Comment, CommentVote, Report):
+            assert db.session.scalar(sa.select(sa.func.count()).select_from(model)) == 0
+        assert db.session.scalar(sa.select(sa.func.count()).select_from(User)) == 2
+
+
+def test_fresh_database_records_the_migration(app):
+    with app.app_context():
+        assert is_applied(CASCADE_FOREIGN_KEYS)
+        assert migrate() == []
+
+
+def test_new_columns_are_added_and_filled_in(legacy_app):
+    with legacy_app.app_context():
+        db.create_all()
+        migrate()
+        vehicle = db.session.get(Vehicle, 1)
+        assert vehicle.updated_at == CREATED
+        incident = db.session.get(Incident, 1)
+        assert incident.corroborations == 1
+        assert incident.grid_cell == grid_cell(52.23, 21.01)
+        # One report by a user without statistics: weight 1.0
+        comment = db.session.get(Comment, 1)
+        assert comment.report_priority == pytest.approx(priority_increment(1.0, CREATED))
+        assert db.session.get(User, 1).favorites_seen_at is None
+
+        inspector = sa.inspect(db.session.connection())
+        for table in db.metadata.sorted_tables:
+            existing = {index['name'] for index in inspector.get_indexes(table.name)}
+            assert {index.name for index in table.indexes} <= existing, table.name
+
+
+def test_deleting_a_legacy_user(legacy_app):
+    with legacy_app.app_context():
+        db.create_all()
+        migrate()
+        counts = delete_user(1)
+        assert counts['comment'] == 1 and counts['incident'] == 1
+        for model in (Comment, CommentVote, Report, Incident):
+            assert db.session.scalar(sa.select(sa.func.count()).select_from(model)) == 0
+        assert db.session.scalars(sa.select(User.id)).all() == [2]
@@ -0,0 +1,147 @@
+"""
+Moderation: reports raise a comment's priority by the reporter's weight and
+recency, the queue is ordered by it, and the bulk operations keep counters
+in step
+"""
+
+from datetime import datetime
+
+import pytest
+from sqlalchemy import func, select
+
+from models import db, Comment, CommentVote, Report, User, UserStatistics, Vehicle
+from moderation import (clear_reports, delete_comments, file_report, moderation_queue,
+                        priority_increment, reporter_weight, set_vehicles_blocked,
+                        REPORT_HALF_LIFE)
+
+
+@pytest.fixture
+def users(app):
+    """Author, a reporter without statistics and one with reputation 50"""
+    with app.app_context():
+        users = [User(username=name, email=f'{name}@example.com', password_hash='x')
+                 for name in ('author', 'newcomer', 'veteran')]
+        db.session.add_all(users)
+        db.session.flush()
+        db.session.add(UserStatistics(user_id=users[2].id, reputation_score=50))
+        db.session.add(Vehicle(license_plate='WA12345'))
+        user_ids = [user.id for user in users]
+        db.session.commit()
+    return user_ids
+
+
+def add_comment(author_id, content='Zajechał drogę'):
+    vehicle_id = db.session.scalar(select(Vehicle.id))
+    comment = Comment(vehicle_id=vehicle_id, user_id=author_id, content=content)
+    db.session.add(comment)
+    db.session.commit()
+    return comment.id
+
+
+def count(model):
+    return db.session.scalar(select(func.count()).select_from(model))
+
+
+def test_reporter_weight_follows_reputation(app, users):
+    _, newcomer, veteran = users
+    with app.app_context():
+        assert reporter_weight(newcomer) == 1.0
+        assert reporter_weight(veteran) == 1.5
+        db.session.execute(UserStatistics.__table__.update().values(reputation_score=1000))
+        assert reporter_weight(veteran) == 2.0
+
+
+def test_newer_reports_count_for_more():
+    now = datetime(2025, 6, 1)
+    assert priority_increment(1.0, now + REPORT_HALF_LIFE) == pytest.approx(
+        2 * priority_increment(1.0, now))
+    assert priority_increment(2.0, now) == pytest.approx(2 * priority_increment(1.0, now))
+
+
+def test_report_raises_priority_once_per_user(app, users):
+    author, newcomer, veteran = users
+    with app.app_context():
+        comment_id = add_comment(author)
+        assert file_report(comment_id, newcomer)
+        with pytest.raises(ValueError):
+            file_report(comment_id, newcomer)
+        file_report(comment_id, veteran)
+        db.session.commit()
+
+        comment = db.session.get(Comment, comment_id)
+        assert comment.reports == 2
+        # 1.0 + 1.5 times the current scale
+        assert comment.report_priority == pytest.approx(2.5 * priority_increment(1.0), rel=1e-3)
+        assert file_report(comment_id + 1, newcomer) is False
+
+
+def test_queue_is_ordered_by_priority(app, users):
+    author, newcomer, veteran = users
+    with app.app_context():
+        once, weighted, twice, unreported = (add_comment(author, str(i)) for i in range(4))
+        file_report(once, newcomer)
+        file_report(weighted, veteran)
+        file_report(twice, newcomer)
+        file_report(twice, veteran)
+        db.session.commit()
+
+        page = moderation_queue(page=1, per_page=2)
+        assert page.total == 3
+        assert [comment.id for comment in page.items] == [twice, weighted]
+        assert [comment.id for comment in moderation_queue(page=2, per_page=2).items] == [once]
+
+
+def test_clear_reports_resets_counters(app, users):
+    author, newcomer, veteran = users
+    with app.app_context():
+        comment_ids = [add_comment(author, str(i)) for i in range(3)]
+        for comment_id in comment_ids:
+            file_report(comment_id, veteran)
+        db.session.commit()
+        db.session.execute(UserStatistics.__table__.update().values(total_reports=3))
+
+        assert clear_reports(comment_ids, chunk_size=2) == 3
+        db.session.commit()
+        assert count(Report) == 0
+        assert db.session.execute(select(Comment.reports, Comment.report_priority).distinct()).all() == [(0, 0)]
+        assert db.session.scalar(select(UserStatistics.total_reports)) == 0
+        assert moderation_queue().total == 0
+
+
+def test_delete_comments_releases_statistics(app, users):
+    author, newcomer, veteran = users
+    with app.app_context():
+        db.session.add(UserStatistics(user_id=author, total_comments=3, helpful_votes=1,
+                                      reputation_score=100))
+        db.session.commit()
+        comment_ids = [add_comment(author, str(i)) for i in range(3)]
+        db.session.add(CommentVote(comment_id=comment_ids[0], user_id=newcomer, vote_type='helpful'))
+        db.session.execute(Comment.__table__.update().where(
+            Comment.id == comment_ids[0]).values(helpful_votes=1))
+        file_report(comment_ids[1], veteran)
+        db.session.commit()
+
+        assert delete_comments(comment_ids[:2], chunk_size=1) == 2
+        db.session.commit()
+        assert db.session.scalars(select(Comment.id)).all() == [comment_ids[2]]
+        assert count(CommentVote) == count(Report) == 0
+        stats = db.session.scalars(select(UserStatistics).where(
+            UserStatistics.user_id == author)).one()
+        assert (stats.total_comments, stats.helpful_votes) == (1, 0)
+
+
+def test_set_vehicles_blocked(app, users):
+    with app.app_context():
+        db.session.add(Vehicle(license_plate='KR1234A'))
+        db.session.commit()
+
+        updated, missing = set_vehicles_blocked(['WA12345', 'KR1234A', 'WA12345', 'PO0000'],
+                                                chunk_size=2)
+        db.session.commit()
+        assert (updated, missing) == (2, ['PO0000'])
+        assert set(db.session.scalars(select(Vehicle.is_blocked))) == {True}
+
+        assert set_vehicles_blocked(['KR1234A'], blocked=False) == (1, [])
+        db.session.commit()
+        assert db.session.scalar(select(Vehicle.is_blocked).where(
+            Vehicle.license_plate == 'KR1234A')) is False
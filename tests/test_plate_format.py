@@ -0,0 +1,90 @@
+"""
+Plate canonicalization and classification, and merging vehicles whose
+stored plates only differ in spelling
+"""
+
+import pytest
+from sqlalchemy import func, select
+
+from models import db, Comment, Favorite, Incident, Rating, User, Vehicle
+from plate_format import canonical_plate, classify_plate, is_valid_plate
+from plates import merge_duplicate_plates
+
+
+@pytest.mark.parametrize('typed, canonical', [
+    ('WA12345', 'WA12345'),
+    ('wa12345', 'WA12345'),
+    ('WA 123-45', 'WA12345'),
+    (' wa.12345 ', 'WA12345'),
+    ('KR\t1234A', 'KR1234A'),
+    ('AB', 'AB'),
+    ('ABCDE12345', 'ABCDE12345'),
+])
+def test_canonical_plate(typed, canonical):
+    assert canonical_plate(typed) == canonical
+    assert is_valid_plate(typed)
+
+
+@pytest.mark.parametrize('typed', [
+    None, 12345, '', ' ', 'A', '- -', 'ABCDE123456', 'WA_12345', 'WA12345!', 'ŁDZ12345',
+])
+def test_invalid_plates(typed):
+    assert canonical_plate(typed) is None
+    assert not is_valid_plate(typed)
+
+
+@pytest.mark.parametrize('plate, kind, voivodeship', [
+    ('WA12345', 'standard', 'mazowieckie'),
+    ('KR1234A', 'standard', 'małopolskie'),
+    ('GDA12AB', 'standard', 'pomorskie'),
+    ('W1ABC', 'custom', 'mazowieckie'),
+    ('K2KOT12', 'custom', 'małopolskie'),
+    ('HPA1234', 'service', None),
+    ('UA12345', 'military', None),
+    ('A123456', 'other', None),
+    ('XY12345', 'other', None),
+    ('WA123', 'other', None),
+])
+def test_classify_plate(plate, kind, voivodeship):
+    assert classify_plate(plate) == (plate, kind, voivodeship)
+
+
+def test_merge_duplicate_plates(app):
+    with app.app_context():
+        users = [User(username=f'user{i}', email=f'user{i}@example.com', password_hash='x')
+                 for i in range(2)]
+        spellings = [Vehicle(license_plate='wa 12345'), Vehicle(license_plate='WA12345'),
+                     Vehicle(license_plate='WA-12345', is_blocked=True),
+                     Vehicle(license_plate='kr1234a'), Vehicle(license_plate='???')]
+        db.session.add_all(users + spellings)
+        db.session.flush()
+        first, canonical, blocked = (vehicle.id for vehicle in spellings[:3])
+        db.session.add_all([
+            # user0 rated two spellings: only one rating may survive
+            Rating(user_id=users[0].id, vehicle_id=first, rating=1),
+            Rating(user_id=users[0].id, vehicle_id=blocked, rating=5),
+            Rating(user_id=users[1].id, vehicle_id=canonical, rating=3),
+            Comment(user_id=users[1].id, vehicle_id=first, content='Zajechał drogę'),
+            Favorite(user_id=users[0].id, vehicle_id=first),
+            Favorite(user_id=users[0].id, vehicle_id=canonical),
+            Incident(user_id=users[0].id, license_plate='wa 12345', latitude=52.23,
+                     longitude=21.01, incident_type='other', description='x'),
+        ])
+        db.session.commit()
+
+        assert merge_duplicate_plates(dry_run=True) == {
+            'groups': 2, 'vehicles_removed': 2, 'incidents_updated': 0,
+            'invalid_plates': ['???']}
+        summary = merge_duplicate_plates()
+        assert (summary['groups'], summary['incidents_updated']) == (2, 1)
+
+        assert sorted(db.session.scalars(select(Vehicle.license_plate))) == [
+            '???', 'KR1234A', 'WA12345']
+        survivor = db.session.scalars(select(Vehicle).where(Vehicle.license_plate == 'WA12345')).one()
+        # The row already stored canonically survives, blocked if any was
+        assert (survivor.id, survivor.is_blocked) == (canonical, True)
+        for model, expected in ((Rating, 2), (Comment, 1), (Favorite, 1)):
+            assert db.session.scalar(select(func.count()).select_from(model).where(
+                model.vehicle_id == survivor.id)) == expected
+        assert db.session.scalar(select(Incident.license_plate)) == 'WA12345'
+        assert merge_duplicate_plates()['groups'] == 0
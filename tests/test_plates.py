@@ -0,0 +1,109 @@
+"""
+Plate directory: lookups and autocomplete from memory, kept in step with ORM
+writes, set-based writes and vehicles created elsewhere
+"""
+
+import pytest
+from sqlalchemy import event, select, update
+
+from models import db, Rating, User, Vehicle
+from plates import PlateDirectory
+
+
+@pytest.fixture
+def directory(app):
+    app.config.update(PLATE_DIRECTORY_REFRESH=3600, PLATE_DIRECTORY_FULL_RELOAD=3600)
+    with app.app_context():
+        user = User(username='driver', email='driver@example.com', password_hash='x')
+        vehicles = [Vehicle(license_plate=plate, is_blocked=plate == 'WA10002')
+                    for plate in ('WA10001', 'WA10002', 'WA20001', 'KR12345')]
+        db.session.add_all([user] + vehicles)
+        db.session.flush()
+        db.session.add_all([Rating(user_id=user.id, vehicle_id=vehicles[0].id, rating=4)])
+        db.session.commit()
+    directory = PlateDirectory(app)
+    yield directory
+    # Listeners of an earlier test's directory would take this one's marks
+    for model in (Vehicle, Rating):
+        for name in ('after_insert', 'after_update', 'after_delete'):
+            event.remove(model, name, directory._mark_dirty)
+    event.remove(db.session, 'after_commit', directory._after_commit)
+    event.remove(db.session, 'after_soft_rollback', directory._after_rollback)
+
+
+def rate(plate, rating):
+    user = User(username=f'user{rating}', email=f'user{rating}@example.com', password_hash='x')
+    db.session.add(user)
+    db.session.flush()
+    vehicle_id = db.session.scalar(select(Vehicle.id).where(Vehicle.license_plate == plate))
+    db.session.add(Rating(user_id=user.id, vehicle_id=vehicle_id, rating=rating))
+    db.session.commit()
+
+
+def test_lookup(app, directory):
+    with app.app_context():
+        entry = directory.get('WA10001')
+        assert (entry.rating_count, entry.avg_rating, entry.is_blocked) == (1, 4, False)
+        assert directory.get('WA10002').is_blocked
+        assert directory.get('XX99999') is None
+        assert set(directory.get_many(['WA10001', 'KR12345', 'XX99999'])) == {'WA10001', 'KR12345'}
+        assert len(directory) == 4
+
+
+def test_complete(app, directory):
+    with app.app_context():
+        def plates(prefix, **options):
+            return [plate for plate, _ in directory.complete(prefix, **options)]
+
+        assert plates('WA') == ['WA10001', 'WA20001']
+        assert plates('WA', include_blocked=True) == ['WA10001', 'WA10002', 'WA20001']
+        assert plates('WA1', include_blocked=True, limit=1) == ['WA10001']
+        assert plates('WA3') == []
+        assert plates('') == ['KR12345', 'WA10001', 'WA20001']
+
+
+def test_orm_writes_are_seen_after_commit(app, directory):
+    with app.app_context():
+        directory.get('WA10001')
+        rate('WA10001', 2)
+        assert directory.get('WA10001').rating_count == 2
+        assert directory.get('WA10001').avg_rating == 3
+
+        vehicle = db.session.scalars(select(Vehicle).where(Vehicle.license_plate == 'KR12345')).one()
+        vehicle.license_plate = 'KR54321'
+        db.session.commit()
+        assert [plate for plate, _ in directory.complete('KR')] == ['KR54321']
+        assert directory.get('KR12345') is None
+
+
+def test_rolled_back_writes_are_not_marked(app, directory):
+    with app.app_context():
+        directory.load()
+        db.session.add(Vehicle(license_plate='PO11111'))
+        db.session.flush()
+        db.session.rollback()
+        assert 'dirty_vehicles' not in db.session.info
+        assert directory.complete('PO') == []
+
+
+def test_set_based_writes_are_seen_on_refresh(app, directory):
+    with app.app_context():
+        assert not directory.get('WA20001').is_blocked
+        db.session.execute(update(Vehicle).where(Vehicle.license_plate == 'WA20001').values(
+            is_blocked=True), execution_options={'synchronize_session': False})
+        db.session.commit()
+        assert not directory.get('WA20001').is_blocked
+
+        app.config['PLATE_DIRECTORY_REFRESH'] = 0
+        assert directory.get('WA20001').is_blocked
+
+
+def test_vehicles_created_elsewhere_are_found(app, directory):
+    with app.app_context():
+        directory.load()
+        # Another worker's insert: no ORM event in this process
+        db.session.execute(Vehicle.__table__.insert().values(license_plate='GD77777'))
+        db.session.commit()
+        assert directory.complete('GD') == []
+        assert directory.get('GD77777') is not None
+        assert [plate for plate, _ in directory.complete('GD')] == ['GD77777']
@@ -0,0 +1,117 @@
+"""
+Serialization: schemas dump column query rows as objects or columns, by
+label rather than position, and both encoders write the same JSON
+"""
+
+import json
+from datetime import date, datetime
+from decimal import Decimal
+
+import pytest
+from flask import Flask
+from sqlalchemy import func, select
+
+import serialization
+from models import db, Rating, User, Vehicle
+from serialization import Schema, dumps, json_response
+
+TOP_VEHICLES = Schema('license_plate', ('avg_rating', float), 'rating_count')
+
+
+@pytest.fixture
+def rated(app):
+    with app.app_context():
+        users = [User(username=f'user{i}', email=f'user{i}@example.com', password_hash='x')
+                 for i in range(2)]
+        vehicles = [Vehicle(license_plate='WA12345'), Vehicle(license_plate='KR1234A')]
+        db.session.add_all(users + vehicles)
+        db.session.flush()
+        db.session.add_all([Rating(user_id=users[0].id, vehicle_id=vehicles[0].id, rating=4),
+                            Rating(user_id=users[1].id, vehicle_id=vehicles[0].id, rating=5)])
+        db.session.commit()
+    return app
+
+
+def top_vehicles():
+    # Columns in a different order than the schema, plus one it doesn't use
+    return db.session.execute(
+        select(func.count(Rating.id).label('rating_count'), Vehicle.id,
+               func.avg(Rating.rating).label('avg_rating'), Vehicle.license_plate)
+        .outerjoin(Rating).group_by(Vehicle.id).order_by(Vehicle.license_plate.desc()))
+
+
+def test_dump_objects(rated):
+    with rated.app_context():
+        assert TOP_VEHICLES.dump(top_vehicles()) == [
+            {'license_plate': 'WA12345', 'avg_rating': 4.5, 'rating_count': 2},
+            # The converter is not applied to NULL
+            {'license_plate': 'KR1234A', 'avg_rating': None, 'rating_count': 0},
+        ]
+
+
+def test_dump_columns(rated):
+    with rated.app_context():
+        rows = top_vehicles().all()
+        assert TOP_VEHICLES.dump_columns(rows) == {
+            'fields': ['license_plate', 'avg_rating', 'rating_count'],
+            'rows': [['WA12345', 4.5, 2], ['KR1234A', None, 0]],
+        }
+        # PostgreSQL averages are Decimal; the converter makes them floats
+        assert type(TOP_VEHICLES.dump_columns(rows)['rows'][0][1]) is float
+
+
+def test_empty_results():
+    assert TOP_VEHICLES.dump([]) == []
+    assert TOP_VEHICLES.dump_columns([]) == {
+        'fields': ['license_plate', 'avg_rating', 'rating_count'], 'rows': []}
+
+
+def test_missing_column_is_reported(rated):
+    with rated.app_context():
+        rows = db.session.execute(select(Vehicle.license_plate))
+        with pytest.raises(KeyError, match="no column 'avg_rating'"):
+            TOP_VEHICLES.dump(rows)
+
+
+def test_compiled_per_column_layout(rated):
+    with rated.app_context():
+        TOP_VEHICLES.dump(top_vehicles())
+        TOP_VEHICLES.dump(top_vehicles())
+        rows = db.session.execute(select(
+            Vehicle.license_plate, func.avg(Rating.rating).label('avg_rating'),
+            func.count(Rating.id).label('rating_count')).join(Rating).group_by(Vehicle.id))
+        assert TOP_VEHICLES.dump(rows) == [
+            {'license_plate': 'WA12345', 'avg_rating': 4.5, 'rating_count': 2}]
+        assert len(TOP_VEHICLES._compiled) == 2
+
+
+def test_labels_are_not_code():
+    schema = Schema("x'] or __import__('os') or ['")
+    Row = type('Row', (tuple,), {'_fields': ("x'] or __import__('os') or ['",)})
+    assert schema.dump([Row(('a',))]) == [{"x'] or __import__('os') or ['": 'a'}]
+
+
+PAYLOAD = {'plate': 'ŁDZ 12345', 'avg': Decimal('4.50'), 'day': date(2025, 6, 1),
+           'at': datetime(2025, 6, 1, 12, 30), 'items': [1, None, True]}
+DECODED = {'plate': 'ŁDZ 12345', 'avg': 4.5, 'day': '2025-06-01', 'at': '2025-06-01T12:30:00',
+           'items': [1, None, True]}
+
+
+@pytest.mark.parametrize('encoder', ['orjson', 'json'])
+def test_encoders_agree(monkeypatch, encoder):
+    if encoder == 'orjson' and serialization.orjson is None:
+        pytest.skip('orjson is not installed')
+    if encoder == 'json':
+        monkeypatch.setattr(serialization, 'orjson', None)
+    encoded = dumps(PAYLOAD)
+    assert json.loads(encoded) == DECODED
+    assert b' ' not in encoded.replace('ŁDZ 12345'.encode('utf-8'), b'')
+    with pytest.raises(TypeError):
+        dumps({'value': object()})
+
+
+def test_json_response():
+    with Flask('tests').app_context():
+        response = json_response({'error': 'Nie znaleziono'}, status=404)
+    assert (response.status_code, response.mimetype) == (404, 'application/json')
+    assert response.get_json() == {'error': 'Nie znaleziono'}
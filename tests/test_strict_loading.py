@@ -0,0 +1,73 @@
+"""
+With DB_STRICT_LOADING (on for every test app, see conftest.py) templates
+cannot lazy load relationships or unloaded rating stats; views load them up
+front
+"""
+
+import pytest
+from flask import render_template_string
+from sqlalchemy import select
+from sqlalchemy.orm import joinedload
+
+from database import StrictLoadingError
+from models import db, Rating, User, Vehicle
+
+RATING = '{{ rating.vehicle.license_plate }} {{ rating.rating }}'
+VEHICLE = '{{ vehicle.license_plate }} {{ vehicle.get_rating_count() }}'
+
+
+@pytest.fixture
+def rated(app):
+    with app.app_context():
+        user = User(username='driver', email='driver@example.com', password_hash='x')
+        vehicle = Vehicle(license_plate='WA12345')
+        db.session.add_all([user, vehicle])
+        db.session.flush()
+        db.session.add(Rating(user_id=user.id, vehicle_id=vehicle.id, rating=4))
+        db.session.commit()
+    return app
+
+
+def render(app, template, **context):
+    with app.test_request_context():
+        try:
+            return render_template_string(template, **context)
+        finally:
+            db.session.remove()
+
+
+def test_lazy_load_in_a_template_raises(rated):
+    with rated.app_context():
+        rating = db.session.scalars(select(Rating)).one()
+        with pytest.raises(StrictLoadingError, match='Rating.vehicle'):
+            render(rated, RATING, rating=rating)
+
+
+def test_loading_up_front_renders(rated):
+    with rated.app_context():
+        rating = db.session.scalars(select(Rating).options(joinedload(Rating.vehicle))).one()
+        assert render(rated, RATING, rating=rating) == 'WA12345 4'
+
+
+def test_unloaded_rating_stats_raise(rated):
+    with rated.app_context():
+        vehicle = db.session.scalars(select(Vehicle)).one()
+        with pytest.raises(StrictLoadingError, match='with_rating_stats'):
+            render(rated, VEHICLE, vehicle=vehicle)
+
+        vehicle = db.session.scalars(
+            select(Vehicle).options(*Vehicle.with_rating_stats())
+            .execution_options(populate_existing=True)).one()
+        assert render(rated, VEHICLE, vehicle=vehicle) == 'WA12345 1'
+
+
+def test_lazy_loads_are_allowed_outside_templates_and_when_off(rated):
+    with rated.app_context():
+        rating = db.session.scalars(select(Rating)).one()
+        # The view itself may still load lazily
+        assert rating.vehicle.license_plate == 'WA12345'
+
+        rated.config['DB_STRICT_LOADING'] = False
+        db.session.expire_all()
+        rating = db.session.scalars(select(Rating)).one()
+        assert render(rated, RATING, rating=rating) == 'WA12345 4'
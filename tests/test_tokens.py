@@ -0,0 +1,97 @@
+"""
+API tokens verify only as issued, unexpired and unrevoked, and stop working
+when their user is deleted or demoted
+"""
+
+import time
+
+import pytest
+
+from models import db, User
+from tokens import TokenAuth, _b64decode, _b64encode
+from deletion import delete_user
+
+
+@pytest.fixture
+def tokens(app):
+    app.config.update(SECRET_KEY='test secret', API_TOKEN_TTL=3600)
+    return TokenAuth(app)
+
+
+def make_user(name, is_admin=False):
+    user = User(username=name, email=f'{name}@example.com', password_hash='x', is_admin=is_admin)
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+
+def test_issued_token_verifies(app, tokens):
+    with app.app_context():
+        user = make_user('driver', is_admin=True)
+        token, expires = tokens.issue(user)
+        claims = tokens.verify(token)
+        assert (claims.user_id, claims.is_admin, claims.expires) == (user.id, True, expires)
+
+
+@pytest.mark.parametrize('tamper', ['payload', 'signature', 'format'])
+def test_tampered_token_is_refused(app, tokens, tamper):
+    with app.app_context():
+        user = make_user('driver')
+        token, _ = tokens.issue(user)
+        payload, signature = token.split('.')
+        if tamper == 'payload':
+            # Claim admin rights with the original signature
+            fields = _b64decode(payload).decode('ascii').split(':')
+            fields[1] = '1'
+            token = f"{_b64encode(':'.join(fields).encode('ascii'))}.{signature}"
+        elif tamper == 'signature':
+            token = f"{payload}.{_b64encode(b'x' * TokenAuth.SIGNATURE_BYTES)}"
+        else:
+            token = payload
+        assert tokens.verify(token) is None
+
+
+def test_expired_token_is_refused(app, tokens):
+    with app.app_context():
+        user = make_user('driver')
+        app.config['API_TOKEN_TTL'] = -1
+        token, _ = tokens.issue(user)
+        assert tokens.verify(token) is None
+
+
+def test_revoked_token_is_refused(app, tokens):
+    with app.app_context():
+        user = make_user('driver')
+        token, _ = tokens.issue(user)
+        other, _ = tokens.issue(user)
+        tokens.revoke(tokens.verify(token))
+        db.session.commit()
+        assert tokens.verify(token) is None
+        assert tokens.verify(other) is not None
+
+        # Other workers learn about it on their next reload
+        worker = TokenAuth(app)
+        worker.reload_revocations()
+        assert worker.verify(token) is None
+
+
+def test_deleted_users_token_is_refused(app, tokens):
+    with app.app_context():
+        user = make_user('driver')
+        token, _ = tokens.issue(user)
+        delete_user(user.id)
+        assert tokens.verify(token) is None
+
+
+def test_demoting_an_admin_revokes_their_tokens(app, tokens):
+    with app.app_context():
+        admin = make_user('admin', is_admin=True)
+        token, _ = tokens.issue(admin)
+        admin.is_admin = False
+        db.session.commit()
+        assert tokens.verify(token) is None
+
+        # Tokens issued after the cutoff work again
+        time.sleep(1)
+        token, _ = tokens.issue(admin)
+        assert tokens.verify(token).is_admin is False
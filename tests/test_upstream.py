@@ -0,0 +1,161 @@
+"""
+Upstream protection: the circuit breaker opens after consecutive failures
+and lets one probe through once half-open; the cache serves stale entries
+while a single refresh runs
+"""
+
+import threading
+
+import pytest
+from flask import Flask
+
+from traffic import TrafficFlowClient
+from upstream import CircuitBreaker, StaleCache
+
+BBOX = (20.9, 52.1, 21.1, 52.3)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+def test_breaker_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30, clock=clock)
+    for _ in range(2):
+        breaker.record_failure()
+    breaker.record_success()
+    for _ in range(2):
+        breaker.record_failure()
+    # A success in between resets the count
+    assert breaker.state == CircuitBreaker.CLOSED and breaker.allow()
+
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+    clock.now += 29
+    assert not breaker.allow()
+    assert breaker.snapshot() == {'state': 'open', 'consecutive_failures': 3, 'trips': 1,
+                                  'open_for': 29.0}
+
+
+def test_half_open_breaker_lets_one_probe_through(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30, clock=clock)
+    breaker.record_failure()
+    clock.now += 30
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow()
+    assert not breaker.allow()
+
+    # A failed probe opens it for another full timeout
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    clock.now += 29
+    assert not breaker.allow()
+    clock.now += 1
+    assert breaker.allow()
+
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow() and breaker.allow()
+    assert breaker.snapshot()['trips'] == 2
+
+
+def test_cache_serves_fresh_then_stale_then_nothing(clock):
+    cache = StaleCache(ttl=60, stale_ttl=600, clock=clock)
+    assert cache.get('a') == (None, None)
+    cache.put('a', 1)
+    assert cache.get('a') == (1, StaleCache.FRESH)
+    clock.now += 60
+    assert cache.get('a') == (1, StaleCache.STALE)
+    clock.now += 599
+    assert cache.get('a') == (1, StaleCache.STALE)
+    clock.now += 1
+    assert cache.get('a') == (None, None)
+    assert len(cache) == 0
+
+
+def test_partial_results_are_stored_stale(clock):
+    cache = StaleCache(ttl=60, clock=clock)
+    cache.put('a', 1, stale=True)
+    assert cache.get('a') == (1, StaleCache.STALE)
+
+
+def test_cache_evicts_least_recently_used(clock):
+    cache = StaleCache(max_entries=2, clock=clock)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    cache.get('a')
+    cache.put('c', 3)
+    assert [cache.get(key)[0] for key in 'abc'] == [1, None, 3]
+
+
+def test_one_refresh_per_key():
+    cache = StaleCache()
+    assert cache.begin_refresh('a')
+    assert not cache.begin_refresh('a')
+    assert cache.begin_refresh('b')
+    cache.end_refresh('a')
+    assert cache.begin_refresh('a')
+
+
+@pytest.fixture
+def client(clock):
+    app = Flask('tests')
+    # Nothing listens on the discard port: every point query fails fast
+    app.config.update(TOMTOM_API_KEY='key', TOMTOM_FLOW_URL='http://127.0.0.1:9/{zoom}',
+                      TOMTOM_GRID_POINTS=4, TOMTOM_BREAKER_FAILURES=4, TOMTOM_TIMEOUT=2)
+    client = TrafficFlowClient(app)
+    client.cache = StaleCache(ttl=60, stale_ttl=600, clock=clock)
+    return client
+
+
+def test_open_breaker_spares_the_upstream(client):
+    data = client.viewport_flow(BBOX, 12)
+    assert (data['failed'], data['points'], data['cache']) == (4, 4, 'miss')
+    assert client.breaker.state == CircuitBreaker.OPEN
+
+    data = client.viewport_flow(BBOX, 12)
+    assert data['failed'] == 4
+    metrics = client.metrics.snapshot()
+    assert (metrics['upstream_requests'], metrics['breaker_rejections']) == (4, 4)
+    # All-failed answers are not cached
+    assert len(client.cache) == 0
+
+
+def test_stale_entry_is_served_while_one_refresh_runs(client, clock):
+    release = threading.Event()
+    refreshed = threading.Event()
+    calls = []
+
+    def fetch_viewport(bbox, zoom):
+        calls.append(bbox)
+        if len(calls) > 1:
+            release.wait(5)
+            refreshed.set()
+        return {'segments': [len(calls)], 'points': 4, 'failed': 0, 'simulated': False}
+
+    client.fetch_viewport = fetch_viewport
+    assert client.viewport_flow(BBOX, 12)['cache'] == 'miss'
+    assert client.viewport_flow(BBOX, 12)['cache'] == 'hit'
+
+    clock.now += 61
+    for _ in range(3):
+        data = client.viewport_flow(BBOX, 12)
+        assert (data['segments'], data['cache']) == ([1], 'stale')
+    release.set()
+    assert refreshed.wait(5)
+    client._refresh_pool.shutdown(wait=True)
+
+    assert len(calls) == 2
+    data = client.viewport_flow(BBOX, 12)
+    assert (data['segments'], data['cache']) == ([2], 'hit')
+    assert client.metrics.snapshot()['revalidations'] == 1
@@ -0,0 +1,110 @@
+"""
+Concurrent comment voting: counters, vote rows and the author's reputation
+stay exact while many users vote and switch votes on one comment at once
+"""
+
+import pytest
+from sqlalchemy import func, select
+
+from conftest import run_concurrently
+from models import (db, Comment, CommentVote, User, UserStatistics, Vehicle,
+                    HELPFUL_VOTE_REPUTATION)
+from votes import cast_comment_vote
+
+VOTERS = 50
+
+
+def vote_plan(i):
+    """Votes user ``i`` casts in order; a repeat of the current vote is refused"""
+    return (['helpful'],
+            ['unhelpful', 'helpful'],
+            ['helpful', 'unhelpful', 'unhelpful'],
+            ['unhelpful'])[i % 4]
+
+
+@pytest.fixture
+def comment(app):
+    """A comment, its author (with statistics) and the voters' ids"""
+    with app.app_context():
+        users = [User(username=f'user{i}', email=f'user{i}@example.com', password_hash='x')
+                 for i in range(VOTERS + 1)]
+        vehicle = Vehicle(license_plate='WA12345')
+        db.session.add_all(users + [vehicle])
+        db.session.flush()
+        author = users[0]
+        comment = Comment(vehicle_id=vehicle.id, user_id=author.id, content='Komentarz')
+        stats = UserStatistics(user_id=author.id, helpful_votes=3, reputation_score=40)
+        db.session.add_all([comment, stats])
+        db.session.commit()
+        return {'id': comment.id, 'author_id': author.id,
+                'voter_ids': [user.id for user in users[1:]]}
+
+
+def test_concurrent_votes_and_switches(app, comment):
+    refused = []
+
+    def vote(i):
+        user_id = comment['voter_ids'][i]
+        for vote_type in vote_plan(i):
+            try:
+                cast_comment_vote(comment['id'], user_id, vote_type)
+            except ValueError:
+                db.session.rollback()
+                refused.append(user_id)
+                continue
+            db.session.commit()
+
+    assert run_concurrently(app, vote, VOTERS) == []
+
+    final = [vote_plan(i)[-1] for i in range(VOTERS)]
+    helpful = final.count('helpful')
+    # Only the third plan repeats its last vote
+    assert len(refused) == sum(1 for i in range(VOTERS) if i % 4 == 2)
+
+    with app.app_context():
+        row = db.session.get(Comment, comment['id'])
+        assert (row.helpful_votes, row.unhelpful_votes) == (helpful, VOTERS - helpful)
+
+        votes_per_user = db.session.execute(
+            select(CommentVote.user_id, func.count()).where(
+                CommentVote.comment_id == comment['id']).group_by(CommentVote.user_id)).all()
+        assert len(votes_per_user) == VOTERS
+        assert all(count == 1 for _, count in votes_per_user)
+        stored = dict(db.session.execute(select(CommentVote.user_id, CommentVote.vote_type).where(
+            CommentVote.comment_id == comment['id'])).all())
+        assert stored == dict(zip(comment['voter_ids'], final))
+
+        stats = db.session.execute(select(UserStatistics).where(
+            UserStatistics.user_id == comment['author_id'])).scalar_one()
+        assert stats.helpful_votes == 3 + helpful
+        assert stats.reputation_score == 40 + helpful * HELPFUL_VOTE_REPUTATION
+
+
+def test_everyone_switches_at_once(app, comment):
+    def vote(i, vote_type):
+        cast_comment_vote(comment['id'], comment['voter_ids'][i], vote_type)
+        db.session.commit()
+
+    assert run_concurrently(app, lambda i: vote(i, 'helpful'), VOTERS) == []
+    assert run_concurrently(app, lambda i: vote(i, 'unhelpful'), VOTERS) == []
+
+    with app.app_context():
+        row = db.session.get(Comment, comment['id'])
+        assert (row.helpful_votes, row.unhelpful_votes) == (0, VOTERS)
+        assert db.session.scalar(select(func.count()).select_from(CommentVote)) == VOTERS
+        stats = db.session.execute(select(UserStatistics).where(
+            UserStatistics.user_id == comment['author_id'])).scalar_one()
+        # Every helpful vote was taken back again
+        assert (stats.helpful_votes, stats.reputation_score) == (3, 40)
+
+
+def test_repeated_vote_is_refused(app, comment):
+    with app.app_context():
+        voter = comment['voter_ids'][0]
+        result = cast_comment_vote(comment['id'], voter, 'helpful')
+        db.session.commit()
+        assert (result['helpful_votes'], result['unhelpful_votes']) == (1, 0)
+        with pytest.raises(ValueError):
+            cast_comment_vote(comment['id'], voter, 'helpful')
+        db.session.rollback()
+        assert cast_comment_vote(comment['id'] + 1000, voter, 'helpful') is None
@@ -0,0 +1,186 @@
+"""
+API tokens for the Driver Rating Application
+Compact HMAC-signed bearer tokens carrying user id, admin flag, issue time and
+expiry, so authenticated API calls need no session cookie. Verification looks
+up one user row: tokens of deleted users, and tokens issued before the user's
+``tokens_valid_after`` cutoff (set when an admin is demoted), are refused.
+"""
+
+import base64
+import calendar
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import event, select
+
+from models import db, RevokedToken, User
+
+TokenClaims = namedtuple('TokenClaims', 'user_id is_admin issued expires jti')
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+class TokenAuth:
+    """
+    Issues and verifies tokens of the form ``<payload>.<signature>``.
+
+    The payload is ``user_id:is_admin:issued:expires:jti`` and the signature is a
+    truncated HMAC-SHA256 over it. Revoked token ids are cached in memory and
+    reloaded from the ``revoked_token`` table every
+    ``API_TOKEN_REVOCATION_REFRESH`` seconds; besides that refresh,
+    verification reads only the user's ``tokens_valid_after``.
+    """
+
+    SIGNATURE_BYTES = 16
+
+    def __init__(self, app=None):
+        self.app = None
+        self._key = None
+        self._revoked = frozenset()
+        self._revoked_loaded_at = 0
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Configure token authentication for a Flask application
+        Args:
+            app: Flask application instance
+        """
+        app.config.setdefault('API_TOKEN_TTL', int(os.environ.get('API_TOKEN_TTL', 86400)))
+        app.config.setdefault('API_TOKEN_REVOCATION_REFRESH',
+                              float(os.environ.get('API_TOKEN_REVOCATION_REFRESH', 30)))
+        self.app = app
+        # Derive a dedicated key so tokens can't be confused with session cookies
+        self._key = hmac.new(app.config['SECRET_KEY'].encode('utf-8'),
+                             b'api-token', hashlib.sha256).digest()
+        app.extensions['token_auth'] = self
+
+        event.listen(User.is_admin, 'set', self._admin_changed)
+
+    def _admin_changed(self, user, value, oldvalue, initiator):
+        # Tokens carry the admin flag; a demoted admin's must stop working
+        if oldvalue is True and not value:
+            self.revoke_user(user)
+
+    def _sign(self, payload):
+        return hmac.new(self._key, payload, hashlib.sha256).digest()[:self.SIGNATURE_BYTES]
+
+    def issue(self, user):
+        """
+        Create a token for a user
+        Args:
+            user: User object
+        Returns:
+            tuple: (token string, expiry as unix timestamp)
+        """
+        issued = int(time.time())
+        expires = issued + self.app.config['API_TOKEN_TTL']
+        jti = secrets.token_hex(8)
+        payload = f"{user.id}:{int(bool(user.is_admin))}:{issued}:{expires}:{jti}".encode('ascii')
+        return f"{_b64encode(payload)}.{_b64encode(self._sign(payload))}", expires
+
+    def verify(self, token):
+        """
+        Verify a token
+        Args:
+            token: Token string
+        Returns:
+            TokenClaims, or None if the token is malformed, forged, expired or
+            revoked, or its user was deleted
+        """
+        try:
+            payload_part, signature_part = token.split('.', 1)
+            payload = _b64decode(payload_part)
+            signature = _b64decode(signature_part)
+        except (ValueError, TypeError):
+            return None
+
+        if not hmac.compare_digest(signature, self._sign(payload)):
+            return None
+
+        try:
+            user_id, admin, issued, expires, jti = payload.decode('ascii').split(':')
+            claims = TokenClaims(int(user_id), admin == '1', int(issued), int(expires), jti)
+        except ValueError:
+            return None
+
+        if claims.expires < time.time() or claims.jti in self._revoked_ids():
+            return None
+
+        user = db.session.execute(
+            select(User.tokens_valid_after).where(User.id == claims.user_id)).first()
+        if user is None:
+            return None
+        # Whole seconds, like the issue time: tokens issued in the same second
+        # as the cutoff are refused too, whether before or after it
+        if (user.tokens_valid_after is not None and
+                claims.issued <= calendar.timegm(user.tokens_valid_after.utctimetuple())):
+            return None
+        return claims
+
+    def _revoked_ids(self):
+        refresh = self.app.config['API_TOKEN_REVOCATION_REFRESH']
+        if time.monotonic() - self._revoked_loaded_at > refresh:
+            with self._lock:
+                if time.monotonic() - self._revoked_loaded_at > refresh:
+                    self.reload_revocations()
+        return self._revoked
+
+    def reload_revocations(self):
+        """Reload the ids of revoked, not yet expired tokens"""
+        self._revoked = frozenset(db.session.execute(
+            select(RevokedToken.jti).where(
+                RevokedToken.expires_at > datetime.utcnow())).scalars())
+        self._revoked_loaded_at = time.monotonic()
+
+    def revoke(self, claims):
+        """
+        Revoke a token before its expiry (caller commits)
+        Args:
+            claims: TokenClaims of the token to revoke
+        """
+        revoked = RevokedToken()
+        revoked.jti = claims.jti
+        revoked.user_id = claims.user_id
+        revoked.expires_at = datetime.utcfromtimestamp(claims.expires)
+        db.session.merge(revoked)
+        # Other workers pick this up on their next refresh
+        self._revoked = self._revoked | {claims.jti}
+
+    def revoke_user(self, user):
+        """
+        Revoke every token issued to a user so far (caller commits)
+        Args:
+            user: User object
+        """
+        user.tokens_valid_after = datetime.utcnow()
+
+
+def bearer_token(request):
+    """
+    Extract a bearer token from the Authorization header
+    Returns:
+        str or None
+    """
+    header = request.headers.get('Authorization', '')
+    scheme, _, token = header.partition(' ')
+    if scheme.lower() != 'bearer' or not token:
+        return None
+    return token.strip()
+
+
+token_auth = TokenAuth()
@@ -0,0 +1,477 @@
+"""
+Traffic flow proxy for the Driver Rating Application
+Samples TomTom flow data on a grid of points across the map viewport,
+fetches the points concurrently over one pooled HTTP session and merges
+the returned road segments into a single compact payload, guarded by a
+circuit breaker and a stale-while-revalidate cache
+"""
+
+import asyncio
+import logging
+import math
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from events import parse_bbox
+from upstream import CircuitBreaker, StaleCache, UpstreamMetrics
+
+DEFAULT_FLOW_URL = ('https://api.tomtom.com/traffic/services/4/flowSegmentData/'
+                    'absolute/{zoom}/json')
+
+# Upper bound for TOMTOM_GRID_POINTS, every point is one upstream request
+MAX_GRID_POINTS = 25
+
+# Coordinates are rounded to ~1 m, which also makes duplicate segments
+# returned for neighbouring sample points compare equal
+COORD_PRECISION = 5
+
+HEADERS = {'User-Agent': 'Driver-Rating-App/1.0'}
+
+
+def parse_viewport(args):
+    """
+    Viewport of a traffic request
+    Args:
+        args: Query arguments (bbox and zoom, or lat and lng of older clients)
+    Returns:
+        tuple: (bbox, zoom)
+    Raises:
+        ValueError: With a message for the client
+    """
+    try:
+        zoom = int(args.get('zoom', 12))
+    except ValueError:
+        zoom = 12
+    bbox = parse_bbox(args.get('bbox'))
+    if bbox is None:
+        # Older clients only send the map centre
+        try:
+            lat, lng = float(args['lat']), float(args['lng'])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError('Missing bbox or latitude/longitude')
+        bbox = (lng, lat, lng, lat)
+
+    min_lng, min_lat, max_lng, max_lat = bbox
+    if not (-90 <= min_lat <= max_lat <= 90 and -180 <= min_lng <= max_lng <= 180):
+        raise ValueError('Invalid bbox')
+    return bbox, zoom
+
+
+def grid_points(bbox, points):
+    """
+    Sample points spread evenly over a bounding box
+    Args:
+        bbox: (min_lng, min_lat, max_lng, max_lat)
+        points: Approximate number of points
+    Returns:
+        list: (lat, lng) cell centres, row by row
+    """
+    min_lng, min_lat, max_lng, max_lat = bbox
+    # Aspect ratio in meters, so wide viewports get more columns than rows
+    width = (max_lng - min_lng) * math.cos(math.radians((min_lat + max_lat) / 2))
+    height = max_lat - min_lat
+    if width <= 0 or height <= 0:
+        return [((min_lat + max_lat) / 2, (min_lng + max_lng) / 2)]
+
+    cols = max(1, round(math.sqrt(points * width / height)))
+    rows = max(1, round(points / cols))
+    return [(min_lat + (max_lat - min_lat) * (r + 0.5) / rows,
+             min_lng + (max_lng - min_lng) * (c + 0.5) / cols)
+            for r in range(rows) for c in range(cols)]
+
+
+def compact_segment(data):
+    """
+    Reduce a flowSegmentData response to the fields the map draws
+    Returns:
+        dict or None if the response has no usable geometry
+    """
+    flow = (data or {}).get('flowSegmentData') or {}
+    coordinates = (flow.get('coordinates') or {}).get('coordinate') or []
+    if len(coordinates) < 2:
+        return None
+    return {
+        'coords': [[round(c['latitude'], COORD_PRECISION), round(c['longitude'], COORD_PRECISION)]
+                   for c in coordinates],
+        'speed': flow.get('currentSpeed'),
+        'freeFlowSpeed': flow.get('freeFlowSpeed'),
+        'confidence': flow.get('confidence'),
+        'frc': flow.get('frc'),
+        'closed': bool(flow.get('roadClosure')),
+    }
+
+
+def segment_key(segment):
+    """Identity of a segment: its end points and vertex count"""
+    coords = segment['coords']
+    return tuple(coords[0]), tuple(coords[-1]), len(coords)
+
+
+def snap_bbox(bbox, zoom):
+    """
+    Widen a bounding box to a zoom-dependent grid, so viewports that differ
+    by a small pan share one cache entry
+    Returns:
+        tuple: (min_lng, min_lat, max_lng, max_lat)
+    """
+    step = 360 / 2 ** (zoom + 1)  # half a map tile
+    min_lng, min_lat, max_lng, max_lat = bbox
+    return (max(math.floor(min_lng / step) * step, -180.0),
+            max(math.floor(min_lat / step) * step, -90.0),
+            min(math.ceil(max_lng / step) * step, 180.0),
+            min(math.ceil(max_lat / step) * step, 90.0))
+
+
+class TrafficFlowClient:
+    """
+    Concurrent TomTom flow sampler behind a breaker and a cache.
+
+    One viewport request fans out to ``TOMTOM_GRID_POINTS`` point queries on
+    a pool of ``TOMTOM_MAX_WORKERS`` threads sharing a keep-alive session.
+    Points that fail or miss the ``TOMTOM_TIMEOUT`` deadline are left out;
+    ``TOMTOM_FLOW_URL`` can point at a local fake upstream for benchmarks.
+
+    Upstream protection:
+      * at most ``TOMTOM_MAX_IN_FLIGHT`` point queries may be queued or
+        running per process, the rest are shed instead of waiting;
+      * ``TOMTOM_BREAKER_FAILURES`` failed queries in a row open the circuit
+        breaker for ``TOMTOM_BREAKER_RESET`` seconds, during which requests
+        are answered without touching TomTom;
+      * results are cached per snapped viewport for ``TOMTOM_CACHE_TTL``
+        seconds and served stale for ``TOMTOM_STALE_TTL`` more while a
+        background refresh runs.
+    """
+
+    def __init__(self, app=None):
+        self.api_key = None
+        self.flow_url = DEFAULT_FLOW_URL
+        self.workers = 1
+        self.grid_points = 1
+        self.timeout = None
+        self.breaker = CircuitBreaker()
+        self.cache = StaleCache()
+        self.metrics = UpstreamMetrics()
+        # Callables receiving every list of live segments, see traffic_history.py
+        self.sample_listeners = []
+        self._in_flight = None
+        self.max_in_flight = 0
+        self._tasks = set()
+        self._pool = None
+        self._refresh_pool = None
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Configure the client for a Flask application
+        Args:
+            app: Flask application instance
+        """
+        app.config.setdefault('TOMTOM_API_KEY', os.environ.get('TOMTOM_API_KEY'))
+        app.config.setdefault('TOMTOM_FLOW_URL', os.environ.get('TOMTOM_FLOW_URL', DEFAULT_FLOW_URL))
+        app.config.setdefault('TOMTOM_MAX_WORKERS', int(os.environ.get('TOMTOM_MAX_WORKERS', 8)))
+        app.config.setdefault('TOMTOM_MAX_IN_FLIGHT', int(os.environ.get('TOMTOM_MAX_IN_FLIGHT', 32)))
+        app.config.setdefault('TOMTOM_GRID_POINTS', int(os.environ.get('TOMTOM_GRID_POINTS', 9)))
+        app.config.setdefault('TOMTOM_TIMEOUT', float(os.environ.get('TOMTOM_TIMEOUT', 5)))
+        app.config.setdefault('TOMTOM_BREAKER_FAILURES',
+                              int(os.environ.get('TOMTOM_BREAKER_FAILURES', 5)))
+        app.config.setdefault('TOMTOM_BREAKER_RESET', float(os.environ.get('TOMTOM_BREAKER_RESET', 30)))
+        app.config.setdefault('TOMTOM_CACHE_TTL', float(os.environ.get('TOMTOM_CACHE_TTL', 60)))
+        app.config.setdefault('TOMTOM_STALE_TTL', float(os.environ.get('TOMTOM_STALE_TTL', 600)))
+        app.config.setdefault('TOMTOM_CACHE_SIZE', int(os.environ.get('TOMTOM_CACHE_SIZE', 256)))
+
+        self.api_key = app.config['TOMTOM_API_KEY']
+        self.flow_url = app.config['TOMTOM_FLOW_URL']
+        self.workers = max(1, app.config['TOMTOM_MAX_WORKERS'])
+        self.grid_points = max(1, min(app.config['TOMTOM_GRID_POINTS'], MAX_GRID_POINTS))
+        self.timeout = app.config['TOMTOM_TIMEOUT']
+        self.breaker = CircuitBreaker(app.config['TOMTOM_BREAKER_FAILURES'],
+                                      app.config['TOMTOM_BREAKER_RESET'])
+        self.cache = StaleCache(app.config['TOMTOM_CACHE_SIZE'], app.config['TOMTOM_CACHE_TTL'],
+                                app.config['TOMTOM_STALE_TTL'])
+        self.max_in_flight = app.config['TOMTOM_MAX_IN_FLIGHT']
+        self._in_flight = threading.BoundedSemaphore(self.max_in_flight)
+        app.extensions['traffic_flow'] = self
+
+    @property
+    def configured(self):
+        return bool(self.api_key)
+
+    def _resources(self):
+        # Threads and sockets don't survive a fork, each worker makes its own
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    session = requests.Session()
+                    session.headers.update(HEADERS)
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.workers)
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    self._session = session
+                    self._pool = ThreadPoolExecutor(max_workers=self.workers,
+                                                    thread_name_prefix='tomtom')
+                    # Separate pool: a refresh waits on point queries in _pool
+                    self._refresh_pool = ThreadPoolExecutor(max_workers=2,
+                                                            thread_name_prefix='tomtom-refresh')
+                    self._pid = os.getpid()
+        return self._pool, self._session
+
+    def _params(self, lat, lng):
+        return {'key': self.api_key, 'point': f'{lat:.6f},{lng:.6f}', 'unit': 'KMPH'}
+
+    def _point_failed(self):
+        self.breaker.record_failure()
+        self.metrics.incr('upstream_failures')
+
+    def _fetch_point(self, session, url, lat, lng):
+        self.metrics.incr('upstream_requests')
+        try:
+            response = session.get(url, params=self._params(lat, lng), timeout=self.timeout)
+            if response.status_code != 200:
+                raise requests.HTTPError(f'TomTom API error {response.status_code}')
+            segment = compact_segment(response.json())
+        except Exception:
+            self._point_failed()
+            raise
+        self.breaker.record_success()
+        return segment
+
+    def _point_done(self, future):
+        self._in_flight.release()
+        if future.cancelled():
+            # Never started before the deadline: the upstream is too slow
+            self._point_failed()
+
+    def _admit(self, points):
+        """
+        Points let through the in-flight cap and the circuit breaker; each
+        admitted point holds an in-flight slot the caller must release
+        Returns:
+            tuple: (admitted points, number rejected)
+        """
+        admitted = []
+        rejected = 0
+        for point in points:
+            if not self._in_flight.acquire(blocking=False):
+                self.metrics.incr('shed')
+                rejected += 1
+                continue
+            if not self.breaker.allow():
+                self._in_flight.release()
+                self.metrics.incr('breaker_rejections')
+                rejected += 1
+                continue
+            admitted.append(point)
+        return admitted, rejected
+
+    def _merge(self, results, failed, total):
+        """
+        Combine point results into the viewport payload
+        Args:
+            results: Segments (or None) of the points that answered
+            failed: Points rejected, failed or timed out
+            total: Points sampled
+        """
+        segments = {}
+        for segment in results:
+            if segment is not None:
+                segments.setdefault(segment_key(segment), segment)
+
+        if failed:
+            logging.info(f"TomTom flow: {failed} of {total} points failed")
+        if segments:
+            for listener in self.sample_listeners:
+                try:
+                    listener(list(segments.values()))
+                except Exception as e:
+                    logging.error(f"Traffic sample listener failed: {e}")
+        return {
+            'segments': list(segments.values()),
+            'points': total,
+            'failed': failed,
+            'simulated': False,
+        }
+
+    def fetch_viewport(self, bbox, zoom):
+        """
+        Query TomTom for a viewport, bypassing the cache
+        Args:
+            bbox: (min_lng, min_lat, max_lng, max_lat)
+            zoom: Map zoom level, selects the upstream road detail
+        Returns:
+            dict: segments, number of sampled and failed points
+        """
+        pool, session = self._resources()
+        url = self.flow_url.format(zoom=zoom)
+        points = grid_points(bbox, self.grid_points)
+        admitted, rejected = self._admit(points)
+
+        futures = []
+        for lat, lng in admitted:
+            future = pool.submit(self._fetch_point, session, url, lat, lng)
+            future.add_done_callback(self._point_done)
+            futures.append(future)
+
+        # One deadline for the whole fan-out, not per point
+        done, pending = wait(futures, timeout=self.timeout) if futures else (set(), set())
+        for future in pending:
+            future.cancel()
+
+        results = []
+        failed = rejected + len(pending)
+        for future in futures:
+            if future not in done:
+                continue
+            try:
+                results.append(future.result())
+            except Exception as e:
+                logging.warning(f"TomTom flow point failed: {e}")
+                failed += 1
+        return self._merge(results, failed, len(points))
+
+    async def _fetch_point_async(self, client, url, lat, lng):
+        self.metrics.incr('upstream_requests')
+        try:
+            async with client.get(url, params=self._params(lat, lng)) as response:
+                if response.status != 200:
+                    raise requests.HTTPError(f'TomTom API error {response.status}')
+                segment = compact_segment(await response.json(content_type=None))
+        except BaseException:
+            # Includes cancellation at the deadline
+            self._point_failed()
+            raise
+        finally:
+            self._in_flight.release()
+        self.breaker.record_success()
+        return segment
+
+    async def fetch_viewport_async(self, client, bbox, zoom):
+        """
+        fetch_viewport() for the event loop, see asgi.py
+        Args:
+            client: Shared aiohttp.ClientSession
+            bbox: (min_lng, min_lat, max_lng, max_lat)
+            zoom: Map zoom level
+        """
+        url = self.flow_url.format(zoom=zoom)
+        points = grid_points(bbox, self.grid_points)
+        admitted, rejected = self._admit(points)
+        tasks = [asyncio.ensure_future(self._fetch_point_async(client, url, lat, lng))
+                 for lat, lng in admitted]
+
+        done, pending = await asyncio.wait(tasks, timeout=self.timeout) if tasks else (set(), set())
+        for task in pending:
+            task.cancel()
+
+        results = []
+        failed = rejected + len(pending)
+        for task in tasks:
+            if task not in done:
+                continue
+            try:
+                results.append(task.result())
+            except Exception as e:
+                logging.warning(f"TomTom flow point failed: {e}")
+                failed += 1
+        return self._merge(results, failed, len(points))
+
+    def _store(self, key, data):
+        # Keep anything usable, but partial answers are refreshed on next use;
+        # an all-failed answer must not hide recovery
+        if data['failed'] < data['points']:
+            self.cache.put(key, data, stale=data['failed'] > 0)
+
+    def _lookup(self, bbox, zoom):
+        """
+        Cache lookup shared by the sync and async paths
+        Returns:
+            tuple: (key, snapped bbox, zoom, cached payload or None,
+            whether the caller must start a background refresh)
+        """
+        zoom = max(0, min(zoom, 22))
+        bbox = snap_bbox(bbox, zoom)
+        key = (zoom, bbox)
+
+        data, state = self.cache.get(key)
+        if state == StaleCache.FRESH:
+            self.metrics.incr('hits')
+            return key, bbox, zoom, dict(data, cache='hit'), False
+        if state == StaleCache.STALE:
+            self.metrics.incr('stale')
+            refresh = self.cache.begin_refresh(key)
+            if refresh:
+                self.metrics.incr('revalidations')
+            return key, bbox, zoom, dict(data, cache='stale'), refresh
+
+        self.metrics.incr('misses')
+        return key, bbox, zoom, None, False
+
+    def _refresh(self, key, bbox, zoom):
+        try:
+            self._store(key, self.fetch_viewport(bbox, zoom))
+        except Exception as e:
+            logging.error(f"TomTom flow refresh failed: {e}")
+        finally:
+            self.cache.end_refresh(key)
+
+    def viewport_flow(self, bbox, zoom):
+        """
+        Flow segments covering a viewport, from cache when possible
+        Args:
+            bbox: (min_lng, min_lat, max_lng, max_lat)
+            zoom: Map zoom level
+        Returns:
+            dict: segments, number of sampled and failed points, and the
+            cache outcome (hit, stale or miss)
+        """
+        key, bbox, zoom, cached, refresh = self._lookup(bbox, zoom)
+        if refresh:
+            self._resources()
+            self._refresh_pool.submit(self._refresh, key, bbox, zoom)
+        if cached is not None:
+            return cached
+
+        data = self.fetch_viewport(bbox, zoom)
+        self._store(key, data)
+        return dict(data, cache='miss')
+
+    async def _refresh_async(self, client, key, bbox, zoom):
+        try:
+            self._store(key, await self.fetch_viewport_async(client, bbox, zoom))
+        except Exception as e:
+            logging.error(f"TomTom flow refresh failed: {e}")
+        finally:
+            self.cache.end_refresh(key)
+
+    async def viewport_flow_async(self, client, bbox, zoom):
+        """viewport_flow() for the event loop, see asgi.py"""
+        key, bbox, zoom, cached, refresh = self._lookup(bbox, zoom)
+        if refresh:
+            task = asyncio.ensure_future(self._refresh_async(client, key, bbox, zoom))
+            # The loop only keeps weak references to tasks
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        if cached is not None:
+            return cached
+
+        data = await self.fetch_viewport_async(client, bbox, zoom)
+        self._store(key, data)
+        return dict(data, cache='miss')
+
+    def snapshot(self):
+        """Counters, breaker state and cache size for the metrics endpoint"""
+        return {
+            'counters': self.metrics.snapshot(),
+            'breaker': self.breaker.snapshot(),
+            'cache_entries': len(self.cache),
+        }
+
+
+traffic_flow = TrafficFlowClient()
@@ -0,0 +1,322 @@
+"""
+Traffic flow history for the Driver Rating Application
+Keeps the flow segments sampled from TomTom as a day-keyed time series,
+builds per-segment hour-of-week speed profiles with NumPy and answers
+viewport queries from those profiles when the live upstream is down
+"""
+
+import hashlib
+import json
+import logging
+import os
+import struct
+import threading
+import time
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+try:
+    import numpy as np
+except ImportError:
+    # NumPy is optional; without it samples are still stored but no profiles are built
+    np = None
+
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+
+from models import db, TrafficSample, TrafficSegment
+from jobs import job_queue
+from traffic import segment_key, traffic_flow
+
+HOURS_PER_WEEK = 24 * 7
+
+# Segments need this many samples before a profile is trusted
+MIN_PROFILE_SAMPLES = 3
+
+# Segments returned by one modelled viewport
+MAX_MODEL_SEGMENTS = 500
+
+# Rows written or updated per statement
+CHUNK_SIZE = 1000
+
+
+def segment_id(segment):
+    """Stable 64-bit id of a segment, derived from its geometry"""
+    digest = hashlib.blake2b(repr(segment_key(segment)).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+def hour_of_week(moment):
+    """0 for Monday 00:00-00:59, 167 for Sunday 23:00-23:59"""
+    return moment.weekday() * 24 + moment.hour
+
+
+class TrafficHistory:
+    """
+    Sample store and time-of-day model.
+
+    Live viewport results are buffered in memory by ``record()`` (called from
+    the TomTom client, possibly off the request thread), at most once per
+    segment every ``TRAFFIC_SAMPLE_INTERVAL`` seconds, and written in bulk
+    by ``flush()`` in a transient job, so the traffic API never commits.
+    Samples are keyed by local day so old days
+    can be dropped as a whole after ``TRAFFIC_HISTORY_DAYS``. A background
+    job rebuilds the profiles from the last ``TRAFFIC_PROFILE_WEEKS`` weeks
+    every ``TRAFFIC_PROFILE_INTERVAL`` seconds.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.tz = None
+        self.interval = 0
+        self._buffer = []
+        self._last_recorded = {}
+        self._next_profile_check = 0
+        self._flush_queued = False
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Configure the history store for a Flask application
+        Args:
+            app: Flask application instance
+        """
+        app.config.setdefault('TRAFFIC_TIMEZONE', os.environ.get('TRAFFIC_TIMEZONE', 'Europe/Warsaw'))
+        app.config.setdefault('TRAFFIC_SAMPLE_INTERVAL',
+                              int(os.environ.get('TRAFFIC_SAMPLE_INTERVAL', 300)))
+        app.config.setdefault('TRAFFIC_HISTORY_DAYS', int(os.environ.get('TRAFFIC_HISTORY_DAYS', 56)))
+        app.config.setdefault('TRAFFIC_PROFILE_WEEKS', int(os.environ.get('TRAFFIC_PROFILE_WEEKS', 4)))
+        app.config.setdefault('TRAFFIC_PROFILE_INTERVAL',
+                              int(os.environ.get('TRAFFIC_PROFILE_INTERVAL', 3600)))
+        self.app = app
+        self.interval = app.config['TRAFFIC_SAMPLE_INTERVAL']
+        try:
+            self.tz = ZoneInfo(app.config['TRAFFIC_TIMEZONE'])
+        except (ZoneInfoNotFoundError, ValueError):
+            logging.warning(f"Unknown TRAFFIC_TIMEZONE {app.config['TRAFFIC_TIMEZONE']}, using UTC")
+            self.tz = ZoneInfo('UTC')
+        traffic_flow.sample_listeners.append(self.record)
+        app.extensions['traffic_history'] = self
+
+    def record(self, segments):
+        """
+        Buffer live segments for the next flush
+        Args:
+            segments: Compact segments from the TomTom client
+        """
+        now = time.monotonic()
+        local = datetime.now(self.tz)
+        with self._lock:
+            for segment in segments:
+                if segment.get('speed') is None:
+                    continue
+                sid = segment_id(segment)
+                if now - self._last_recorded.get(sid, -self.interval) < self.interval:
+                    continue
+                self._last_recorded[sid] = now
+                self._buffer.append((sid, segment, local))
+
+            if len(self._last_recorded) > 100000:
+                self._last_recorded = {k: v for k, v in self._last_recorded.items()
+                                       if now - v < self.interval}
+
+            # One flush in the queue at a time collects everything recorded before it runs
+            if not self._buffer or self._flush_queued:
+                return
+            self._flush_queued = True
+        if not job_queue.enqueue_transient('flush_traffic_samples'):
+            with self._lock:
+                self._flush_queued = False
+
+    def flush(self):
+        """
+        Write buffered samples and commit; schedules a profile rebuild when due
+        Returns:
+            int: Number of samples written
+        """
+        with self._lock:
+            buffer, self._buffer = self._buffer, []
+            self._flush_queued = False
+        if not buffer:
+            return 0
+
+        try:
+            segments = {sid: segment for sid, segment, _ in buffer}
+            self._insert_segments(segments)
+            rows = [{
+                'segment_id': sid,
+                'day': local.date(),
+                'hour_of_week': hour_of_week(local),
+                'speed': round(segment['speed']),
+                'free_flow_speed': (round(segment['freeFlowSpeed'])
+                                    if segment.get('freeFlowSpeed') is not None else None),
+                'confidence': (round(segment['confidence'] * 100)
+                               if segment.get('confidence') is not None else None),
+            } for sid, segment, local in buffer]
+            for i in range(0, len(rows), CHUNK_SIZE):
+                db.session.execute(TrafficSample.__table__.insert(), rows[i:i + CHUNK_SIZE])
+            self._schedule_profiles()
+            db.session.commit()
+        except SQLAlchemyError as e:
+            # History is best effort, the live answer must not fail because of it
+            db.session.rollback()
+            logging.error(f"Traffic history flush failed, dropped {len(buffer)} samples: {e}")
+            return 0
+        return len(buffer)
+
+    def _insert_segments(self, segments):
+        """Insert segments not stored yet (another worker may race us)"""
+        for attempt in range(2):
+            known = set(db.session.execute(select(TrafficSegment.id).where(
+                TrafficSegment.id.in_(list(segments)))).scalars())
+            rows = []
+            for sid, segment in segments.items():
+                if sid in known:
+                    continue
+                coords = segment['coords']
+                middle = coords[len(coords) // 2]
+                rows.append({'id': sid, 'coords': json.dumps(coords), 'frc': segment.get('frc'),
+                             'latitude': middle[0], 'longitude': middle[1],
+                             'profile_samples': 0, 'created_at': datetime.utcnow()})
+            if not rows:
+                return
+            try:
+                with db.session.begin_nested():
+                    db.session.execute(TrafficSegment.__table__.insert(), rows)
+                return
+            except IntegrityError:
+                if attempt:
+                    raise
+
+    def _schedule_profiles(self):
+        # Checked at most once per interval per process; the job re-checks
+        now = time.monotonic()
+        if now < self._next_profile_check:
+            return
+        self._next_profile_check = now + self.app.config['TRAFFIC_PROFILE_INTERVAL']
+        if self.profiles_due():
+            job_queue.enqueue('build_traffic_profiles')
+
+    def profiles_due(self):
+        last_built = db.session.execute(select(func.max(TrafficSegment.profile_built_at))).scalar()
+        return last_built is None or last_built < datetime.utcnow() - timedelta(
+            seconds=self.app.config['TRAFFIC_PROFILE_INTERVAL'])
+
+    def build_profiles(self, weeks=None):
+        """
+        Rebuild hour-of-week speed profiles and drop expired samples.
+        Per segment and hour of the week the mean observed speed is taken;
+        hours never observed fall back to the same hour on other days, then
+        to the segment's overall mean.
+        Args:
+            weeks: History window, defaults to TRAFFIC_PROFILE_WEEKS
+        Returns:
+            dict: Counts of samples read, profiles written and samples pruned
+        """
+        if np is None:
+            logging.warning("NumPy is not installed, traffic profiles are not built")
+            return {'samples': 0, 'profiles': 0, 'pruned': 0}
+
+        weeks = weeks or self.app.config['TRAFFIC_PROFILE_WEEKS']
+        today = datetime.now(self.tz).date()
+        rows = db.session.execute(
+            select(TrafficSample.segment_id, TrafficSample.hour_of_week, TrafficSample.speed,
+                   func.coalesce(TrafficSample.free_flow_speed, TrafficSample.speed)).where(
+                TrafficSample.day > today - timedelta(weeks=weeks)).execution_options(
+                    yield_per=50000))
+        # Segment ids are full 64-bit hashes and must not pass through float64
+        id_chunks, value_chunks = [], []
+        for partition in rows.partitions():
+            id_chunks.append(np.array([row[0] for row in partition], dtype=np.int64))
+            value_chunks.append(np.array([row[1:] for row in partition], dtype=np.float64))
+
+        profiles = 0
+        samples = sum(len(chunk) for chunk in id_chunks)
+        if samples:
+            values = np.concatenate(value_chunks)
+            segment_ids, index = np.unique(np.concatenate(id_chunks), return_inverse=True)
+            cells = index * HOURS_PER_WEEK + values[:, 0].astype(np.int64)
+            size = len(segment_ids) * HOURS_PER_WEEK
+
+            counts = np.bincount(cells, minlength=size).reshape(-1, HOURS_PER_WEEK)
+            sums = np.bincount(cells, weights=values[:, 1], minlength=size).reshape(-1, HOURS_PER_WEEK)
+            free_flow = np.bincount(index, weights=values[:, 2]) / np.bincount(index)
+
+            with np.errstate(invalid='ignore', divide='ignore'):
+                profile = sums / counts
+                # Same hour on the other days of the week
+                by_hour = (sums.reshape(-1, 7, 24).sum(axis=1) /
+                           counts.reshape(-1, 7, 24).sum(axis=1))
+                profile = np.where(counts > 0, profile, np.tile(by_hour, 7))
+                overall = sums.sum(axis=1) / counts.sum(axis=1)
+            profile = np.where(np.isnan(profile), overall[:, None], profile).astype('<f4')
+
+            totals = counts.sum(axis=1)
+            built_at = datetime.utcnow()
+            updates = [{
+                'id': int(segment_ids[i]),
+                'profile': profile[i].tobytes(),
+                'profile_samples': int(totals[i]),
+                'free_flow_speed': float(free_flow[i]),
+                'profile_built_at': built_at,
+            } for i in np.flatnonzero(totals >= MIN_PROFILE_SAMPLES)]
+            for i in range(0, len(updates), CHUNK_SIZE):
+                db.session.execute(update(TrafficSegment), updates[i:i + CHUNK_SIZE])
+                db.session.commit()
+            profiles = len(updates)
+
+        cutoff = today - timedelta(days=self.app.config['TRAFFIC_HISTORY_DAYS'])
+        pruned = db.session.execute(
+            delete(TrafficSample).where(TrafficSample.day < cutoff),
+            execution_options={'synchronize_session': False}).rowcount
+        db.session.commit()
+        return {'samples': samples, 'profiles': profiles, 'pruned': pruned}
+
+    def model_query(self, bbox):
+        """SELECT of the profiled segments in a viewport, see model_segments()"""
+        min_lng, min_lat, max_lng, max_lat = bbox
+        return select(TrafficSegment.coords, TrafficSegment.frc, TrafficSegment.free_flow_speed,
+                      TrafficSegment.profile).where(
+            TrafficSegment.latitude.between(min_lat, max_lat),
+            TrafficSegment.longitude.between(min_lng, max_lng),
+            TrafficSegment.profile.isnot(None)).order_by(
+                TrafficSegment.profile_samples.desc()).limit(MAX_MODEL_SEGMENTS)
+
+    def model_segments(self, rows, at=None):
+        """
+        Expected flow of profiled segments at a moment
+        Args:
+            rows: Result rows of model_query()
+            at: Aware datetime to model, defaults to now
+        Returns:
+            list: Compact segments, like the live client returns
+        """
+        how = hour_of_week((at or datetime.now(self.tz)).astimezone(self.tz))
+        segments = []
+        for coords, frc, free_flow_speed, profile in rows:
+            speed = struct.unpack_from('<f', profile, how * 4)[0]
+            segments.append({
+                'coords': json.loads(coords),
+                'speed': round(speed),
+                'freeFlowSpeed': round(free_flow_speed) if free_flow_speed else None,
+                'confidence': None,
+                'frc': frc,
+                'closed': False,
+            })
+        return segments
+
+    def model_flow(self, bbox, at=None):
+        """
+        Expected flow in a viewport from the hour-of-week profiles
+        Args:
+            bbox: (min_lng, min_lat, max_lng, max_lat)
+            at: Aware datetime to model, defaults to now
+        Returns:
+            list: Compact segments, like the live client returns
+        """
+        return self.model_segments(db.session.execute(self.model_query(bbox)).all(), at)
+
+
+traffic_history = TrafficHistory()
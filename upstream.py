@@ -0,0 +1,181 @@
+"""
+Upstream API protection for the Driver Rating Application
+Circuit breaker, stale-while-revalidate cache and counters shared by the
+clients of external services, so a slow or failing upstream costs a web
+worker milliseconds instead of its full timeout
+"""
+
+import collections
+import threading
+import time
+
+
+class CircuitBreaker:
+    """
+    Consecutive-failure circuit breaker.
+
+    Closed: calls pass, ``failure_threshold`` failures in a row open it.
+    Open: calls are rejected until ``reset_timeout`` seconds have passed.
+    Half-open: a single probe call is let through; its success closes the
+    breaker, its failure opens it for another ``reset_timeout``.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._trips = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self):
+        if self._state == self.OPEN and self._clock() - self._opened_at >= self.reset_timeout:
+            self._state = self.HALF_OPEN
+            self._probing = False
+        return self._state
+
+    def allow(self):
+        """
+        Ask for permission to call the upstream
+        Returns:
+            bool: False while open, or while a half-open probe is in flight
+        """
+        with self._lock:
+            state = self._current_state()
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            state = self._current_state()
+            self._failures += 1
+            if state == self.HALF_OPEN or (state == self.CLOSED and
+                                           self._failures >= self.failure_threshold):
+                self._state = self.OPEN
+                self._opened_at = self._clock()
+                self._probing = False
+                self._trips += 1
+
+    def snapshot(self):
+        """Breaker state for metrics"""
+        with self._lock:
+            state = self._current_state()
+            return {
+                'state': state,
+                'consecutive_failures': self._failures,
+                'trips': self._trips,
+                'open_for': (round(self._clock() - self._opened_at, 1)
+                             if state != self.CLOSED and self._opened_at is not None else None),
+            }
+
+
+class StaleCache:
+    """
+    Bounded LRU cache with stale-while-revalidate semantics.
+
+    Entries are fresh for ``ttl`` seconds and may then still be served for
+    ``stale_ttl`` more seconds while one background refresh per key runs.
+    """
+
+    FRESH = 'fresh'
+    STALE = 'stale'
+
+    def __init__(self, max_entries=256, ttl=60, stale_ttl=600, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._clock = clock
+        self._entries = collections.OrderedDict()
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Look up a key
+        Returns:
+            tuple: (value, FRESH or STALE), or (None, None) on a miss
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None, None
+            value, stored_at = entry
+            age = self._clock() - stored_at
+            if age >= self.ttl + self.stale_ttl:
+                del self._entries[key]
+                return None, None
+            self._entries.move_to_end(key)
+            return value, self.FRESH if age < self.ttl else self.STALE
+
+    def put(self, key, value, stale=False):
+        """
+        Store a value
+        Args:
+            key: Cache key
+            value: Value to store
+            stale: Store it as already stale, so the next read serves it but
+                also triggers a refresh (for partial results)
+        """
+        with self._lock:
+            stored_at = self._clock() - (self.ttl if stale else 0)
+            self._entries[key] = (value, stored_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def begin_refresh(self, key):
+        """
+        Claim the background refresh of a key
+        Returns:
+            bool: False if another refresh of the key is already running
+        """
+        with self._lock:
+            if key in self._refreshing:
+                return False
+            self._refreshing.add(key)
+            return True
+
+    def end_refresh(self, key):
+        with self._lock:
+            self._refreshing.discard(key)
+
+
+class UpstreamMetrics:
+    """Thread-safe named counters"""
+
+    def __init__(self):
+        self._counts = collections.Counter()
+        self._lock = threading.Lock()
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self._counts[name] += amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counts)
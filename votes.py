@@ -0,0 +1,118 @@
+"""
+Comment voting for the Driver Rating Application
+Applies votes with atomic SQL so concurrent voters never lose updates
+"""
+
+from datetime import datetime
+
+from sqlalchemy import literal_column, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+
+from models import db, Comment, CommentVote, UserStatistics, HELPFUL_VOTE_REPUTATION
+
+VOTE_TYPES = ('helpful', 'unhelpful')
+
+
+def _upsert_vote(comment_id, user_id, vote_type):
+    """
+    Insert a vote or switch its direction
+    Returns:
+        str: 'inserted', 'switched' or None if the same vote already existed
+    """
+    table = CommentVote.__table__
+    now = datetime.utcnow()
+    dialect = db.session.get_bind().dialect.name
+
+    if dialect == 'postgresql':
+        # Single statement; xmax is 0 only for freshly inserted rows
+        stmt = postgresql.insert(table).values(comment_id=comment_id,
+                                               user_id=user_id,
+                                               vote_type=vote_type,
+                                               created_at=now)
+        stmt = stmt.on_conflict_do_update(
+            constraint='unique_user_comment_vote',
+            set_={'vote_type': stmt.excluded.vote_type,
+                  'created_at': stmt.excluded.created_at},
+            where=table.c.vote_type != stmt.excluded.vote_type
+        ).returning(literal_column('(xmax = 0)').label('inserted'))
+        row = db.session.execute(stmt).first()
+        if row is None:
+            return None
+        return 'inserted' if row.inserted else 'switched'
+
+    # Other databases: a conditional UPDATE followed by an insert that
+    # ignores the unique constraint, both atomic on their own
+    switched = db.session.execute(
+        update(table).where(table.c.comment_id == comment_id,
+                            table.c.user_id == user_id,
+                            table.c.vote_type != vote_type).values(
+                                vote_type=vote_type, created_at=now)).rowcount
+    if switched:
+        return 'switched'
+
+    values = dict(comment_id=comment_id, user_id=user_id,
+                  vote_type=vote_type, created_at=now)
+    if dialect == 'sqlite':
+        inserted = db.session.execute(
+            sqlite.insert(table).values(**values).on_conflict_do_nothing()).rowcount
+        return 'inserted' if inserted else None
+
+    try:
+        with db.session.begin_nested():
+            db.session.execute(table.insert().values(**values))
+        return 'inserted'
+    except IntegrityError:
+        return None
+
+
+def cast_comment_vote(comment_id, user_id, vote_type):
+    """
+    Record a user's vote on a comment and adjust all counters atomically
+    Args:
+        comment_id: Comment ID
+        user_id: Voting user's ID
+        vote_type: 'helpful' or 'unhelpful'
+    Returns:
+        dict with the new vote counts, or None if the comment does not exist
+    Raises:
+        ValueError: If the vote type is invalid or the same vote was already cast
+    """
+    if vote_type not in VOTE_TYPES:
+        raise ValueError("Nieprawidłowy typ głosu")
+
+    author_id = db.session.execute(
+        select(Comment.user_id).where(Comment.id == comment_id)).scalar()
+    if author_id is None:
+        return None
+
+    outcome = _upsert_vote(comment_id, user_id, vote_type)
+    if outcome is None:
+        raise ValueError("Już oddałeś ten głos")
+
+    helpful_delta = 1 if vote_type == 'helpful' else 0
+    unhelpful_delta = 1 - helpful_delta
+    if outcome == 'switched':
+        # Votes are binary, so a switch always takes one from the other side
+        helpful_delta = helpful_delta or -1
+        unhelpful_delta = unhelpful_delta or -1
+
+    counts = db.session.execute(
+        update(Comment).where(Comment.id == comment_id).values(
+            helpful_votes=Comment.helpful_votes + helpful_delta,
+            unhelpful_votes=Comment.unhelpful_votes + unhelpful_delta).returning(
+                Comment.helpful_votes, Comment.unhelpful_votes)).first()
+
+    # Apply the author's reputation delta without recounting their votes
+    stats_updated = db.session.execute(
+        update(UserStatistics).where(UserStatistics.user_id == author_id).values(
+            helpful_votes=UserStatistics.helpful_votes + helpful_delta,
+            reputation_score=UserStatistics.reputation_score +
+            helpful_delta * HELPFUL_VOTE_REPUTATION)).rowcount
+
+    return {
+        'author_id': author_id,
+        'author_stats_missing': not stats_updated,
+        'helpful_votes': counts.helpful_votes,
+        'unhelpful_votes': counts.unhelpful_votes
+    }